@@ -1,60 +1,382 @@
 #!/usr/bin/env python
+"""
+python -m flakenews setup table_config.yml
+python -m flakenews plan table_rules.json
+python -m flakenews load table_rules.json
+python -m flakenews verify table_rules.json
+
+Each command only imports the backends it uses: plan needs neither SQL Server
+nor Snowflake, setup no Snowflake, pandas or pyarrow. The -c and -r flags of earlier versions still work.
+"""
 import sys
 import logging
 import argparse
 from contextlib import closing
-from . import mssql
-from . import snowflake as sf
+from typing import TYPE_CHECKING, List
+from .rules import (
+    STAGES,
+    COMPRESSIONS,
+    TARGET_FILE_MB,
+    ISOLATION_LEVELS,
+    LOAD_MODES,
+    APPEND,
+    BATCH_SIZE,
+    MAX_BATCH_MB,
+    new_table_rules,
+    new_table_rules_from_config,
+)
+from .state import STATE_FILE
+from .manifest import MANIFEST_FILE
+from .metadata_cache import MetadataCache, METADATA_CACHE_FILE
+
+if TYPE_CHECKING:
+    from . import runner
 
 
 APP_NAME = "FlakeNews"
 
+COMMANDS = ("setup", "plan", "load", "verify")
+
 
 def run_parquet_files(rules_file: str) -> None:
     """
     A WIP function that writes parquet files locally
     TODO: files to s3, cleanup local files
     """
-    rules = mssql.new_table_rules(rules_file)
+    from . import mssql
+
+    rules = new_table_rules(rules_file)
     with closing(mssql.new_conn()) as conn:
         for db, sch, tbl, path in mssql.write_parquet(rules, conn):
             pass
 
 
-def run_to_snowflake(rules_file: str) -> None:
-    rules = mssql.new_table_rules(rules_file)
-    with closing(mssql.new_conn()) as ms_conn, closing(sf.new_conn()) as sf_conn:
-        for db, sch, tbl, df in mssql.to_pandas(rules, ms_conn):
-            sf.write_df(df, tbl, sf_conn)
+def run_to_snowflake(
+    rules_file: str, config: "runner.RunConfig" = None, tables: List[str] = None
+) -> bool:
+    """
+    Load all the tables in table_rules.json, or those matching `tables`,
+    `workers` tables or chunks at a time.
+    Returns False if any table failed.
+    """
+    from . import runner
+
+    rules = new_table_rules(rules_file, tables)
+    results = runner.run_to_snowflake(rules, config)
+    runner.print_summary(results)
+    return all(result.success for result in results)
+
+
+def run_plan(
+    rules_file: str,
+    workers: int = 1,
+    tables: List[str] = None,
+    max_batch_mb: int = MAX_BATCH_MB,
+    lob_max_bytes: int = 0,
+    hints: List[str] = (),
+    sql: bool = False,
+) -> None:
+    """
+    Print the estimated load plan of the tables in table_rules.json, without loading
+    or connecting to anything
+    """
+    from . import plan
 
+    rules = new_table_rules(rules_file, tables)
+    plan.print_plan(rules, workers, max_batch_mb, lob_max_bytes, hints, sql)
 
-def run_rules_setup(config_file: str) -> None:
+
+def run_verify(rules_file: str, workers: int = 1, tables: List[str] = None) -> bool:
+    """
+    Compare row counts and checksums of the tables in table_rules.json with Snowflake.
+    Returns False if any chunk differs.
+    """
+    from . import verify
+
+    rules = new_table_rules(rules_file, tables)
+    return verify.print_verify(verify.verify_tables(rules, workers))
+
+
+def run_rules_setup(
+    config_file: str, cache_file: str = METADATA_CACHE_FILE, refresh: bool = False
+) -> None:
     """
     Using a basic list of tables from table_config.yml, enrich with metadata from
-    the source database and output a detailed table_rules.yml file and table_ddl.sql file.
+    the source databases and output a detailed table_rules.yml file and table_ddl.sql file.
+    Databases on different servers are set up in parallel.
+    Column and primary key metadata is cached in cache_file, and only queried again
+    for tables whose definition changed, or for all of them with refresh.
     """
-    rules = mssql.new_table_rules_from_config(config_file)
-    with closing(mssql.new_conn()) as conn:
-        rules.set_tables_metadata(conn)
+    from . import source
+
+    rules = new_table_rules_from_config(config_file)
+    with closing(MetadataCache(cache_file, refresh)) as cache:
+        source.set_servers_metadata(rules, cache)
 
     rules.output_ddl("./table_ddl.sql")
     rules.output_rules("./table_rules.json")
 
 
+def _hints(args: argparse.Namespace) -> List[str]:
+    return args.query_hints + ([f"maxdop {args.maxdop}"] if args.maxdop else [])
+
+
+def _run_config(args: argparse.Namespace) -> "runner.RunConfig":
+    from . import runner
+
+    return runner.RunConfig(
+        workers=args.workers,
+        retries=args.retries,
+        queue_depth=args.queue_depth,
+        max_batch_mb=args.max_batch_mb,
+        stage=args.stage,
+        compression=args.compression,
+        file_mb=args.file_mb,
+        state_file=args.state_file,
+        manifest_file=args.manifest_file,
+        resume=args.resume,
+        metrics_file=args.metrics_file,
+        profile_dir=args.profile or "",
+        isolation=args.isolation,
+        query_hints=_hints(args),
+        max_source_queries=args.max_source_queries,
+        max_rows_per_sec=args.max_rows_per_sec,
+        max_mb_per_sec=args.max_mb_per_sec,
+        mode=args.mode,
+        lob_max_bytes=args.lob_max_bytes,
+        spill_dir=args.spill_dir or "",
+    )
+
+
 def main(args: argparse.Namespace):
-    if args.table_config:
-        run_rules_setup(args.table_config)
-    if args.table_rules:
-        run_to_snowflake(args.table_rules)
+    command = args.command
+    if command is None:
+        # the flags of earlier versions: -c sets up the rules, then -r loads, plans or verifies
+        if args.table_config:
+            run_rules_setup(args.table_config, args.metadata_cache, args.refresh_metadata)
+        if not args.table_rules:
+            return
+        command = "plan" if args.plan else "verify" if args.verify else "load"
+    elif command == "setup":
+        run_rules_setup(args.table_config, args.metadata_cache, args.refresh_metadata)
+        return
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+    if command == "plan":
+        run_plan(
+            args.table_rules, args.workers, args.tables, args.max_batch_mb,
+            args.lob_max_bytes, _hints(args), getattr(args, "sql", False),
+        )
+    elif command == "verify":
+        if not run_verify(args.table_rules, args.workers, args.tables):
+            sys.exit(1)
+    elif not run_to_snowflake(args.table_rules, _run_config(args), args.tables):
+        sys.exit(1)
+
+
+def _options(*adders, defaults: bool = True) -> argparse.ArgumentParser:
+    """
+    A parent parser of options shared by the commands and the legacy flags.
+    Without defaults, an option left out after a command keeps the value given
+    before it, e.g. the 8 of `-w 8 load`, instead of being reset to its default
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    for add in adders:
+        add(parser)
+    if not defaults:
+        for action in parser._actions:
+            action.default = argparse.SUPPRESS
+    return parser
+
+
+def _add_logging(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
         "-l",
         "--log-level",
         default="INFO",
         help="default is INFO, other options include DEBUG, WARNING, ERROR, CRITICAL",
     )
+
+
+def _add_setup(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--metadata-cache",
+        default=METADATA_CACHE_FILE,
+        help="with --table-config, caches the columns and primary key of each table and only"
+        f" queries them again for tables whose definition changed, default is {METADATA_CACHE_FILE}",
+    )
+    parser.add_argument(
+        "--refresh-metadata",
+        action="store_true",
+        help="with --table-config, ignore the metadata cache and query every table again",
+    )
+
+
+def _add_tables(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "-t",
+        "--tables",
+        action="append",
+        metavar="PATTERN",
+        help="only the tables whose db.schema.table name matches this shell pattern, case"
+        " insensitive, e.g. 'sales.dbo.*'. Repeat it for more patterns: -t 'sales.*' -t 'hr.*'",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of tables or chunks to load concurrently, default is 1",
+    )
+
+
+def _add_extract(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--max-batch-mb",
+        type=int,
+        default=MAX_BATCH_MB,
+        help="memory budget of each fetched batch in MB, sized per table and capped at its"
+        f" row_split_size, 0 for fixed batches of {BATCH_SIZE} rows, default is {MAX_BATCH_MB}",
+    )
+    parser.add_argument(
+        "--maxdop",
+        type=int,
+        default=0,
+        help="add a maxdop query hint to the source queries, e.g. 1 for a single thread",
+    )
+    parser.add_argument(
+        "--query-hints",
+        nargs="+",
+        default=[],
+        help="more OPTION hints for the source queries, e.g. 'recompile'. Tables can set their own",
+    )
+    parser.add_argument(
+        "--lob-max-bytes",
+        type=int,
+        default=0,
+        help="truncate the values of varchar(max), nvarchar(max), varbinary(max), text, ntext,"
+        " image and xml columns to this many bytes on the source, default loads them whole."
+        " Tables can set their own lob_max_bytes",
+    )
+
+
+def _add_load(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="times to retry a failed chunk before failing its table, default is 2",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=2,
+        help="batches fetched ahead of the Snowflake upload, 0 disables, default is 2",
+    )
+    parser.add_argument(
+        "--spill-dir",
+        help="write fetched batches to Arrow files in this directory and load them from there,"
+        " so the source query finishes as fast as SQL Server can serve it however slow"
+        " Snowflake is. Needs disk space for whatever the load falls behind by",
+    )
+    parser.add_argument(
+        "--isolation",
+        choices=ISOLATION_LEVELS,
+        default="",
+        help="transaction isolation level of the source queries, e.g. snapshot or read uncommitted"
+        " to read without taking shared locks, default is read committed. Tables can set their own",
+    )
+    parser.add_argument(
+        "--max-source-queries",
+        type=int,
+        default=0,
+        help="most extraction queries to run on the source at once, default is one per worker",
+    )
+    parser.add_argument(
+        "--max-rows-per-sec",
+        type=int,
+        default=0,
+        help="fetch no more than this many rows a second over the whole run, default is no limit",
+    )
+    parser.add_argument(
+        "--max-mb-per-sec",
+        type=float,
+        default=0.0,
+        help="fetch no more than this many MB of data a second over the whole run, default is no limit",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=LOAD_MODES,
+        default=APPEND,
+        help="append rows to the tables, or merge them on the primary key through a transient"
+        " staging table to refresh only the rows extracted, default is append."
+        " Tables can set their own load_mode",
+    )
+    parser.add_argument(
+        "--stage",
+        choices=STAGES,
+        default="",
+        help="stage Parquet files on the Snowflake table stage or S3 and load each table"
+        " with one COPY INTO, default appends each batch with write_pandas",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=COMPRESSIONS,
+        default="snappy",
+        help="Parquet codec for staged files, default is snappy",
+    )
+    parser.add_argument(
+        "--file-mb",
+        type=int,
+        default=TARGET_FILE_MB,
+        help=f"target size of staged files in MB, default is {TARGET_FILE_MB}",
+    )
+    parser.add_argument(
+        "--state-file",
+        default=STATE_FILE,
+        help=f"high-watermarks of incremental tables, default is {STATE_FILE}",
+    )
+    parser.add_argument(
+        "--manifest-file",
+        default=MANIFEST_FILE,
+        help=f"records the progress of the run, default is {MANIFEST_FILE}",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip the tables and chunks the last run completed and restart only the rest",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default="",
+        help="write per-stage timings and counters as JSON lines, or a Prometheus textfile if it ends in .prom",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="./flakenews_profile",
+        help="write cProfile and tracemalloc output for every chunk to this directory,"
+        " default is ./flakenews_profile",
+    )
+
+
+def new_parser() -> argparse.ArgumentParser:
+    # the defaults are set by the top level parser, the commands only set what they are given
+    logs = _options(_add_logging, defaults=False)
+    setup = _options(_add_setup, defaults=False)
+    tables = _options(_add_tables, defaults=False)
+    extract = _options(_add_extract, defaults=False)
+    load = _options(_add_load, defaults=False)
+    rules_help = (
+        "e.g. table_rules.json, or a rules catalog ending in .sqlite made with"
+        " python -m flakenews.catalog"
+    )
+
+    parser = argparse.ArgumentParser(
+        prog="python -m flakenews",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        parents=[_options(_add_logging, _add_setup, _add_tables, _add_extract, _add_load)],
+    )
     parser.add_argument(
         "-c",
         "--table-config",
@@ -63,8 +385,55 @@ if __name__ == "__main__":
     parser.add_argument(
         "-r",
         "--table-rules",
-        help="e.g. table_rules.json, cannot be used with --table-config",
+        help=rules_help + ", cannot be used with --table-config",
     )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="print the tables in the order they would load, largest first, with their"
+        " expected chunks and size, and exit without loading",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="compare the row count and checksum of every chunk with Snowflake, computed on"
+        " both servers, print the chunks that differ and exit without loading",
+    )
+
+    commands = parser.add_subparsers(dest="command", metavar="{" + ",".join(COMMANDS) + "}")
+    command = commands.add_parser(
+        "setup",
+        parents=[logs, setup],
+        help="query the source for the metadata of the tables in table_config.yml"
+        " and write table_rules.json and table_ddl.sql",
+    )
+    command.add_argument("table_config", help="e.g. table_config.yml")
+    command = commands.add_parser(
+        "plan",
+        parents=[logs, tables, extract],
+        help="print the tables in the order they would load, largest first, with their expected"
+        " chunks, batches and size, without connecting to anything",
+    )
+    command.add_argument("table_rules", help=rules_help)
+    command.add_argument(
+        "--sql", action="store_true", help="print the extraction query of every table as well"
+    )
+    command = commands.add_parser(
+        "load", parents=[logs, tables, extract, load], help="load the tables into Snowflake"
+    )
+    command.add_argument("table_rules", help=rules_help)
+    command = commands.add_parser(
+        "verify",
+        parents=[logs, tables],
+        help="compare the row count and checksum of every chunk with Snowflake, computed on"
+        " both servers, and print the chunks that differ",
+    )
+    command.add_argument("table_rules", help=rules_help)
+    return parser
+
+
+if __name__ == "__main__":
+    parser = new_parser()
     args = parser.parse_args()
 
     try:
@@ -77,9 +446,9 @@ if __name__ == "__main__":
         parser.print_help(sys.stderr)
         sys.exit(1)
 
-    if bool(args.table_config) == bool(args.table_rules):
+    if args.command is None and bool(args.table_config) == bool(args.table_rules):
         logging.error(
-            "\n\nProvide either --table-config or --table-rules and not both\n"
+            "\n\nGive a command, or either --table-config or --table-rules and not both\n"
         )
         parser.print_help(sys.stderr)
         sys.exit(1)
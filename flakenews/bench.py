@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Offline benchmark of the extraction code paths, no SQL Server or Snowflake needed.
+
+A fake pymssql cursor generates realistic typed rows for the columns of a table
+in table_rules.json, and each code path runs in its own process so that its
+peak RSS can be measured on its own:
+
+    python -m flakenews.bench -r table_rules.json --rows 2000000 --save baseline.json
+    python -m flakenews.bench -r table_rules.json --rows 2000000 --baseline baseline.json
+"""
+
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from uuid import UUID
+from pathlib import Path
+from decimal import Decimal
+from datetime import date, datetime, time as dtime, timedelta
+from typing import List
+from . import mssql
+from . import metrics
+from .mssql import Column, Table, TableRules
+from .delimited import csv_compression
+
+logger = logging.getLogger(__name__)
+
+PATHS = ("to_pandas", "write_parquet", "write_csv", "write_df")
+
+# distinct generated rows that are cycled through, so generating is cheap next to the code under test
+POOL_SIZE = 4096
+
+
+def _value_factory(col: Column, str_len: int, rnd: random.Random):
+    """ A function that returns a random value for a column of this SQL Server type, as the extraction query returns it """
+    t = col.data_type
+    letters = "abcdefghijklmnopqrstuvwxyz ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    if t in ("varchar", "char", "text"):
+        return lambda: "".join(rnd.choices(letters, k=rnd.randint(1, str_len)))
+    if t in ("nvarchar", "nchar", "ntext"):
+        wide = letters + "éüß漢字かなカナ"
+        return lambda: "".join(rnd.choices(wide, k=rnd.randint(1, str_len)))
+    if t == "bigint":
+        return lambda: rnd.randint(-(2 ** 62), 2 ** 62)
+    if t == "int":
+        return lambda: rnd.randint(-(2 ** 31), 2 ** 31 - 1)
+    if t == "smallint":
+        return lambda: rnd.randint(-(2 ** 15), 2 ** 15 - 1)
+    if t == "tinyint":
+        return lambda: rnd.randint(0, 255)
+    if t == "bit":
+        return lambda: rnd.random() < 0.5
+    if t in ("float", "real"):
+        return lambda: rnd.uniform(-1e6, 1e6)
+    if t in ("decimal", "numeric", "money", "smallmoney"):
+        precision = col.numeric_precision or 19
+        scale = col.numeric_scale if col.numeric_scale is not None else 4
+        top = 10 ** min(precision - scale, 12) - 1
+        return lambda: Decimal(rnd.randint(-top, top)) + Decimal(rnd.randint(0, 10 ** scale - 1)).scaleb(-scale)
+    # the types below come back as converted by mssql.SELECT_EXPRESSIONS
+    if t in ("datetime", "datetime2", "smalldatetime", "datetimeoffset"):
+        start = datetime(2000, 1, 1)
+        suffix = "Z" if t == "datetimeoffset" else ""
+        return lambda: (
+            start + timedelta(microseconds=rnd.randint(0, 25 * 365 * 86400 * 10 ** 6))
+        ).isoformat() + suffix
+    if t == "date":
+        start = date(2000, 1, 1)
+        return lambda: (start + timedelta(days=rnd.randint(0, 25 * 365))).isoformat()
+    if t == "time":
+        return lambda: dtime(rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+    if t == "uniqueidentifier":
+        return lambda: str(UUID(int=rnd.getrandbits(128)))
+    if t in ("binary", "varbinary", "image", "rowversion", "timestamp"):
+        return lambda: rnd.getrandbits(8 * str_len).to_bytes(str_len, "big").hex().upper()
+    return lambda: "".join(rnd.choices(letters, k=str_len))
+
+
+def _row_pool(tbl: Table, str_len: int, seed: int = 42) -> List[tuple]:
+    """ POOL_SIZE distinct random rows of the extracted columns of a table, about 5% of the values NULL """
+    rnd = random.Random(seed)
+    factories = [_value_factory(col, str_len, rnd) for col in tbl.selected_cols()]
+    return [
+        tuple(None if rnd.random() < 0.05 else f() for f in factories)
+        for _ in range(POOL_SIZE)
+    ]
+
+
+class FakeCursor:
+    """
+    Stands in for a pymssql cursor, returning `rows` rows cycled from a pool
+    of generated rows. The first pk column counts up from 1.
+    """
+
+    def __init__(self, tbl: Table, rows: int, pool: List[tuple]):
+        self.pk_pos = next(
+            (
+                i for i, col in enumerate(tbl.selected_cols())
+                if tbl.pk and col.name.lower() == tbl.pk[0].lower()
+            ),
+            None,
+        )
+        self.pool = pool
+        self.rows = rows
+        self.pos = 0
+
+    def execute(self, qry: str, params: tuple = None) -> None:
+        self.pos = 0
+
+    def fetchmany(self, size: int) -> List[tuple]:
+        end = min(self.pos + size, self.rows)
+        batch = [self.pool[i % POOL_SIZE] for i in range(self.pos, end)]
+        if self.pk_pos is not None:
+            p = self.pk_pos
+            batch = [row[:p] + (self.pos + i + 1,) + row[p + 1:] for i, row in enumerate(batch)]
+        self.pos = end
+        return batch
+
+    def fetchone(self):
+        batch = self.fetchmany(1)
+        return batch[0] if batch else None
+
+    def close(self) -> None:
+        pass
+
+
+class FakeConnection:
+    """
+    Stands in for a pymssql connection of a single table,
+    the rows are generated up front so that generating them is not timed
+    """
+
+    def __init__(self, tbl: Table, rows: int, str_len: int = 32):
+        self.tbl, self.rows = tbl, rows
+        self.pool = _row_pool(tbl, str_len)
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self.tbl, self.rows, self.pool)
+
+    def close(self) -> None:
+        pass
+
+
+def _widen(tbl: Table, widen: int) -> None:
+    """ Repeat the extracted columns of a table to make it `widen` times as wide """
+    base = list(tbl.selected_cols())
+    for n in range(2, widen + 1):
+        for col in base:
+            if tbl.include_cols:
+                tbl.include_cols.append(f"{col.name}_{n}")
+            tbl.cols.append(
+                Column(
+                    name=f"{col.name}_{n}",
+                    ordinal_position=len(tbl.cols) + 1,
+                    data_type=col.data_type,
+                    numeric_precision=col.numeric_precision,
+                    numeric_scale=col.numeric_scale,
+                )
+            )
+
+
+def _local_write_pandas(conn, df, table_name, **kwargs):
+    """
+    Local stand-in for snowflake's write_pandas, doing the client side of
+    its work: a gzip Parquet file per call, which it would then PUT and COPY
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        df.to_parquet(Path(tmp) / "chunk.parquet", compression="gzip")
+    return True, 1, len(df), []
+
+
+def _run_path(path: str, args: argparse.Namespace, out) -> None:
+    """ Runs one code path in this process and sends its results back """
+    logging.basicConfig(level=logging.WARNING)
+    rules = mssql.new_table_rules(args.table_rules)
+    target = None
+    for db, sch, tbl in rules._all_tables():
+        if args.table in (None, tbl.name):
+            target = (db, sch, tbl)
+            break
+    if target is None:
+        raise ValueError(f"Table {args.table} not found in {args.table_rules}")
+    db, sch, tbl = target
+    _widen(tbl, args.widen)
+    rules = TableRules(
+        [{"name": db.name, "schemas": [{"name": sch.name, "tables": []}]}]
+    )
+    rules.databases[0].schemas[0].tables.append(tbl)
+
+    conn = FakeConnection(tbl, args.rows, args.str_len)
+    recorder = metrics.configure()
+    start = time.perf_counter()
+    rows = built = 0
+    if path == "to_pandas":
+        for *_, df in mssql.to_pandas(rules, conn, args.max_batch_mb):
+            rows += len(df)
+    elif path == "write_parquet":
+        with tempfile.TemporaryDirectory() as tmp:
+            for *_, part in mssql.write_parquet(
+                rules, conn, tmp, args.compression, max_batch_mb=args.max_batch_mb
+            ):
+                rows += part.rows
+                part.path.unlink()
+    elif path == "write_csv":
+        with tempfile.TemporaryDirectory() as tmp:
+            for *_, part in mssql.write_csv(rules, conn, tmp, csv_compression(args.compression)):
+                rows += part.rows
+                built += part.size
+                part.path.unlink()
+    elif path == "write_df":
+        from . import snowflake as sf
+
+        sf.write_pandas = _local_write_pandas
+        for *_, df in mssql.to_pandas(rules, conn, args.max_batch_mb):
+            sf.write_df(df, tbl, None)
+            rows += len(df)
+    seconds = time.perf_counter() - start
+    # MB/sec of the Arrow batches built, or of the CSV files written, which are never built
+    built += sum(t["bytes"] for (_, stage), t in recorder.totals().items() if stage == "build")
+    out.send(
+        {
+            "path": path,
+            "rows": rows,
+            "cols": len(tbl.selected_cols()),
+            "seconds": seconds,
+            "rows_per_sec": rows / seconds if seconds else 0.0,
+            "mb_per_sec": built / 1024 / 1024 / seconds if seconds else 0.0,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    )
+
+
+def run(args: argparse.Namespace) -> List[dict]:
+    """ Runs every requested code path in a fresh process, returns their results """
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for path in args.paths:
+        receiver, sender = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_run_path, args=(path, args, sender))
+        proc.start()
+        # only the child holds the sending end, so the pipe ends if it dies
+        sender.close()
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = None
+        proc.join()
+        if proc.exitcode != 0 or result is None:
+            raise RuntimeError(f"Benchmark of {path} failed with exit code {proc.exitcode}")
+        results.append(result)
+    return results
+
+
+def print_results(results: List[dict], baseline: List[dict] = ()) -> None:
+    before = {r["path"]: r for r in baseline}
+    print(f"\n{'path':<14}{'rows':>12}{'cols':>6}{'seconds':>10}{'rows/s':>12}{'MB/s':>9}{'peak RSS MB':>13}")
+    for r in results:
+        line = (
+            f"{r['path']:<14}{r['rows']:>12,}{r['cols']:>6}{r['seconds']:>10.2f}"
+            f"{r['rows_per_sec']:>12,.0f}{r['mb_per_sec']:>9.1f}{r['peak_rss_mb']:>13.0f}"
+        )
+        old = before.get(r["path"])
+        if old and old["rows_per_sec"]:
+            change = r["rows_per_sec"] / old["rows_per_sec"] - 1
+            line += f"  {change:+.1%} rows/s, {r['peak_rss_mb'] - old['peak_rss_mb']:+.0f} MB vs baseline"
+        print(line)
+    print()
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m flakenews.bench", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-r", "--table-rules", default="table_rules.json")
+    parser.add_argument("-t", "--table", help="table to benchmark, default is the first one")
+    parser.add_argument("--rows", type=int, default=1000000, help="rows to generate, default 1000000")
+    parser.add_argument("--widen", type=int, default=1, help="repeat the columns this many times")
+    parser.add_argument("--str-len", type=int, default=32, help="max length of generated strings and binaries")
+    parser.add_argument("--max-batch-mb", type=int, default=mssql.MAX_BATCH_MB,
+                        help="memory budget of a batch, 0 for fixed batches of BATCH_SIZE rows")
+    parser.add_argument("--compression", default="snappy",
+                        help="Parquet codec for write_parquet, write_csv uses gzip in place of snappy")
+    parser.add_argument("--paths", nargs="+", choices=PATHS, default=list(PATHS))
+    parser.add_argument("--save", help="save the results as JSON, e.g. as a baseline")
+    parser.add_argument("--baseline", help="compare with results saved earlier with --save")
+    args = parser.parse_args(argv)
+
+    baseline = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    results = run(args)
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
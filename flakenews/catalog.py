@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+A SQLite catalog of table rules, for table_rules files too large to load as JSON.
+
+One indexed row per table, its columns kept as JSON and only parsed when a
+table is loaded, so a run over a few tables of a catalog of tens of thousands
+starts at once. The catalog converts from and to the table_rules.json format:
+
+    python -m flakenews.catalog import table_rules.json table_rules.sqlite
+    python -m flakenews.catalog export table_rules.sqlite table_rules.json
+"""
+
+import sys
+import json
+import sqlite3
+import logging
+import argparse
+import threading
+from pathlib import Path
+from fnmatch import fnmatchcase
+from itertools import groupby
+from operator import itemgetter
+from dataclasses import asdict
+from typing import Iterable, List, Tuple, Union
+from .rules import TableRules, Database, Schema, Table, Column
+
+logger = logging.getLogger(__name__)
+
+# files with these suffixes are read and written as catalogs instead of JSON
+CATALOG_SUFFIXES = (".sqlite", ".db")
+
+_SCHEMA = """
+create table if not exists tables (
+    key text primary key
+    , db text not null
+    , sch text not null
+    , name text not null
+    , rules text not null
+    , cols text not null
+    , server text not null default ''
+);
+"""
+
+
+def table_key(db: str, sch: str, tbl: str, server: str = "") -> str:
+    """
+    The case insensitive db.schema.table name that tables are looked up and filtered on,
+    prefixed by the server profile of the database if it has one
+    """
+    key = f"{db}.{sch}.{tbl}".lower()
+    return f"{server.lower()}.{key}" if server else key
+
+
+def matches(key: str, patterns: Union[Iterable[str], None], server: str = "") -> bool:
+    """
+    Whether a table_key matches any of the --tables shell patterns, or there are none.
+    A table on a server profile matches with or without the server in front
+    """
+    if not patterns:
+        return True
+    keys = [key, key[len(server) + 1:]] if server else [key]
+    return any(fnmatchcase(k, pattern.lower()) for pattern in patterns for k in keys)
+
+
+def _matches_one(key: str, server: str, pattern: str) -> bool:
+    return matches(key, [pattern], server)
+
+
+def filter_databases(databases: List[dict], patterns: Union[Iterable[str], None]) -> List[dict]:
+    """ Databases in the table_rules.json format cut down to the tables matching any of the patterns """
+    if not patterns:
+        return databases
+    return [
+        {**db, "schemas": [
+            {**sch, "tables": [
+                table for table in sch.get("tables") or []
+                if matches(
+                    table_key(db["name"], sch["name"], table["name"], db.get("server") or ""),
+                    patterns,
+                    db.get("server") or "",
+                )
+            ]}
+            for sch in db.get("schemas") or []
+        ]}
+        for db in databases
+    ]
+
+
+def is_catalog(path: Union[Path, str]) -> bool:
+    return Path(path).suffix.lower() in CATALOG_SUFFIXES
+
+
+class CatalogTable(Table):
+    """
+    A Table read from a RulesCatalog, its columns are fetched from the
+    catalog the first time they are used
+    """
+
+    _catalog = None
+
+    @property
+    def cols(self) -> List[Column]:
+        if self.__dict__.get("_cols") is None:
+            self._cols = [Column(**col) for col in self._catalog.columns(self._key)]
+        return self._cols
+
+    @cols.setter
+    def cols(self, value: List[Column]) -> None:
+        self._cols = value
+
+
+class RulesCatalog:
+    """
+    The table rules in a local SQLite file, keyed on the lowercase db.schema.table,
+    prefixed by the server profile of tables on one.
+    Can be shared by the worker threads, which fetch the columns of their tables lazily.
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.executescript(_SCHEMA)
+        # catalogs written before databases could name a server
+        if "server" not in (row[1] for row in self.conn.execute("pragma table_info(tables)")):
+            self.conn.execute("alter table tables add column server text not null default ''")
+        self.conn.create_function("matches", 3, _matches_one, deterministic=True)
+        self._lock = threading.Lock()
+
+    def _add(self, db: str, sch: str, table: dict, server: str = "") -> tuple:
+        table = dict(table)
+        name = table.pop("name")
+        cols = table.pop("cols", None) or []
+        return (
+            table_key(db, sch, name, server),
+            db,
+            sch,
+            name,
+            json.dumps(table),
+            json.dumps(cols),
+            server,
+        )
+
+    def write(self, databases: List[dict]) -> int:
+        """
+        Add or replace the tables of databases in the table_rules.json format,
+        returns how many tables were written
+        """
+        rows = [
+            self._add(db["name"], sch["name"], table, db.get("server") or "")
+            for db in databases
+            for sch in db.get("schemas") or []
+            for table in sch.get("tables") or []
+        ]
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "insert or replace into tables (key, db, sch, name, rules, cols, server)"
+                " values (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        logger.info(f"Wrote {len(rows)} tables to the catalog {self.path.resolve()}")
+        return len(rows)
+
+    def columns(self, key: str) -> List[dict]:
+        with self._lock:
+            row = self.conn.execute("select cols from tables where key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(f"Table {key} is not in the catalog {self.path}")
+        return json.loads(row[0])
+
+    def _table(self, key: str, name: str, rules: str) -> CatalogTable:
+        tbl = CatalogTable(name=name, **json.loads(rules))
+        tbl._key, tbl._catalog, tbl._cols = key, self, None
+        return tbl
+
+    def get(
+        self, db: str, sch: str, tbl: str, server: str = ""
+    ) -> Union[Tuple[Database, Schema, Table], None]:
+        """ Look up one table by its 3 part name and server profile, case insensitive """
+        with self._lock:
+            row = self.conn.execute(
+                "select key, db, sch, name, rules, server from tables where key = ?",
+                (table_key(db, sch, tbl, server),),
+            ).fetchone()
+        if row is None:
+            return None
+        return Database(row[1], [], row[5]), Schema(row[2], []), self._table(row[0], row[3], row[4])
+
+    def _select(self, patterns: Union[List[str], None]) -> List[tuple]:
+        qry = "select key, db, sch, name, rules, server from tables"
+        params = []
+        if patterns:
+            # names without wildcards are looked up on the key, with every server
+            # in front as well, the rest are matched one by one
+            exact = [p.lower() for p in patterns if not any(c in p for c in "*?[")]
+            globs = [p.lower() for p in patterns if any(c in p for c in "*?[")]
+            if exact:
+                with self._lock:
+                    servers = [row[0] for row in self.conn.execute("select distinct server from tables")]
+                exact += [f"{server.lower()}.{p}" for server in servers if server for p in exact]
+            where = []
+            if exact:
+                where.append(f"key in ({', '.join('?' * len(exact))})")
+                params += exact
+            where += ["matches(key, server, ?)"] * len(globs)
+            params += globs
+            qry += " where " + " or ".join(where)
+        with self._lock:
+            return self.conn.execute(qry + " order by rowid", params).fetchall()
+
+    def rules(self, patterns: Union[List[str], None] = None) -> TableRules:
+        """
+        TableRules of the tables matching any of the patterns, or of all of them,
+        without parsing any columns yet
+        """
+        rules = TableRules([])
+        databases, schemas = {}, {}
+        for key, db_name, sch_name, name, table_rules, server in self._select(patterns):
+            db = databases.get((server, db_name))
+            if db is None:
+                db = databases[(server, db_name)] = Database(db_name, [], server)
+                rules.databases.append(db)
+            sch = schemas.get((server, db_name, sch_name))
+            if sch is None:
+                sch = schemas[(server, db_name, sch_name)] = Schema(sch_name, [])
+                db.schemas.append(sch)
+            sch.tables.append(self._table(key, name, table_rules))
+        return rules
+
+    def export(self, f: Union[Path, str]) -> int:
+        """
+        Write the catalog out in the table_rules.json format, one table at a time,
+        returns how many tables were written
+        """
+        count = 0
+        with self._lock, open(f, "w") as out:
+            rows = self.conn.execute(
+                "select server, db, sch, name, rules, cols from tables order by"
+                " min(rowid) over (partition by server, db), min(rowid) over (partition by server, db, sch), rowid"
+            )
+            out.write('{"databases": [')
+            for i, ((server, db), db_rows) in enumerate(groupby(rows, key=itemgetter(0, 1))):
+                out.write((", " if i else "") + f'{{"name": {json.dumps(db)}, ')
+                if server:
+                    out.write(f'"server": {json.dumps(server)}, ')
+                out.write('"schemas": [')
+                for j, (sch, sch_rows) in enumerate(groupby(db_rows, key=itemgetter(2))):
+                    out.write((", " if j else "") + f'{{"name": {json.dumps(sch)}, "tables": [')
+                    for k, (_, _, _, name, table_rules, cols) in enumerate(sch_rows):
+                        table = {"name": name, "cols": json.loads(cols), **json.loads(table_rules)}
+                        out.write((", " if k else "") + json.dumps(table))
+                        count += 1
+                    out.write("]}")
+                out.write("]}")
+            out.write("]}\n")
+        logger.info(f"Exported {count} tables to {Path(f).resolve()}")
+        return count
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def import_json(infile: Union[Path, str], catalog: Union[Path, str]) -> int:
+    """ Add the tables of a table_rules.json file to a catalog """
+    with open(infile) as stream:
+        databases = json.load(stream).get("databases") or []
+    rules_catalog = RulesCatalog(catalog)
+    try:
+        return rules_catalog.write(databases)
+    finally:
+        rules_catalog.close()
+
+
+def save_rules(rules: TableRules, catalog: Union[Path, str]) -> int:
+    """ Add the tables of TableRules to a catalog, replacing any already in it """
+    rules_catalog = RulesCatalog(catalog)
+    try:
+        return rules_catalog.write(asdict(rules)["databases"])
+    finally:
+        rules_catalog.close()
+
+
+def load_rules(catalog: Union[Path, str], patterns: Union[List[str], None] = None) -> TableRules:
+    """ TableRules of the tables in a catalog that match any of the patterns """
+    if not Path(catalog).exists():
+        raise FileNotFoundError(f"No rules catalog at {catalog}")
+    return RulesCatalog(catalog).rules(patterns)
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m flakenews.catalog", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("source", help="table_rules.json to import, or the catalog to export")
+    parser.add_argument("target", help="the catalog to import into, or the JSON file to export to")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.action == "import":
+        import_json(args.source, args.target)
+    else:
+        rules_catalog = RulesCatalog(args.source)
+        try:
+            rules_catalog.export(args.target)
+        finally:
+            rules_catalog.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
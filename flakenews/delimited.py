@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+import io
+import csv
+import gzip
+import logging
+from pathlib import Path
+from typing import Callable, List, Tuple, Union
+from .parquet import ParquetPart, TARGET_FILE_MB
+from .rules import SELECT_EXPRESSIONS
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+CSV_COMPRESSIONS = ("gzip", "zstd", "none")
+
+EXTENSIONS = {"gzip": ".csv.gz", "zstd": ".csv.zst", "none": ".csv"}
+
+# gzip level 1 compresses several times faster than the default 9, for files a little larger
+GZIP_LEVEL = 1
+
+# Snowflake's default NULL_IF, written unquoted so that it cannot be mistaken for a string
+NULL_MARKER = "\\N"
+
+# the Snowflake file format that reads the files back, columns are matched by position
+FILE_FORMAT = (
+    "type = csv compression = auto field_delimiter = ','"
+    " field_optionally_enclosed_by = '\"' null_if = ('\\\\N')"
+    " empty_field_as_null = false encoding = 'utf8'"
+)
+
+
+class _Null:
+    """
+    Stands in for NULL in a row. csv.QUOTE_NONNUMERIC quotes everything
+    that is not a number, so this passes for a number to be written unquoted
+    """
+
+    def __float__(self) -> float:
+        return 0.0
+
+    def __str__(self) -> str:
+        return NULL_MARKER
+
+
+NULL = _Null()
+
+# types the driver returns as strings or numbers, besides those SELECT_EXPRESSIONS converts.
+# Others, e.g. sql_variant or hierarchyid, can come back as bytes
+PLAIN_TYPES = (
+    "bigint", "int", "smallint", "tinyint", "decimal", "numeric", "float", "real",
+    "char", "varchar", "nchar", "nvarchar", "text", "ntext",
+)
+
+
+def csv_compression(codec: str) -> str:
+    """ The CSV compression for a --compression option, gzip in place of Parquet only codecs """
+    return codec if codec in CSV_COMPRESSIONS else "gzip"
+
+
+def _formatter(data_type: str) -> Union[Callable, None]:
+    """
+    A function formatting the values of a SQL Server type for Snowflake,
+    None for values that the csv module writes as they are. Dates, guids
+    and binaries already come from the extraction query as ISO, guid and hex strings,
+    bytes of any other type are written in hex as well
+    """
+    if data_type == "time":
+        return lambda v: v.isoformat()
+    if data_type == "bit":
+        return int
+    if data_type in PLAIN_TYPES or data_type in SELECT_EXPRESSIONS:
+        return None
+    return lambda v: v.hex().upper() if isinstance(v, (bytes, bytearray)) else v
+
+
+def _open_compressed(raw, compression: str):
+    """ A binary stream compressing into `raw`, that leaves `raw` open when it is closed """
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=GZIP_LEVEL)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compressed CSV files need the zstandard package") from None
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    return None
+
+
+class CsvSink:
+    """
+    Streams the rows of one table into compressed CSV files that Snowflake can
+    COPY with FILE_FORMAT, without building a DataFrame. NULL is written as an
+    unquoted \\N, strings are quoted with embedded quotes doubled, and dates and
+    times are ISO 8601, mostly converted by the extraction query already.
+    A new file is started once the current one reaches target_bytes of
+    compressed output.
+
+    types: the SQL Server data type of every column, in the order of the rows
+    out_dir: directory to write the files to, created if missing.
+        None writes each file to an in-memory buffer instead of local disk.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        types: List[str],
+        out_dir: Union[Path, str, None] = None,
+        compression: str = "gzip",
+        target_bytes: int = TARGET_FILE_MB * 1024 * 1024,
+    ):
+        if compression not in CSV_COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}, use one of {CSV_COMPRESSIONS}")
+        self.name = name
+        self.formatters = [_formatter(t) for t in types]
+        self.out_dir = Path(out_dir) if out_dir is not None else None
+        self.compression = compression
+        self.target_bytes = target_bytes
+        self._seq = 0
+        self._raw = None
+        self._stream = None
+        self._part = None
+        if self.out_dir is not None:
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+
+    def _open(self) -> None:
+        part = ParquetPart(name=f"{self.name}_{self._seq:05d}{EXTENSIONS[self.compression]}")
+        self._seq += 1
+        if self.out_dir is None:
+            self._raw = io.BytesIO()
+        else:
+            part.path = self.out_dir / part.name
+            self._raw = open(part.path, "wb")
+        self._stream = _open_compressed(self._raw, self.compression) or self._raw
+        self._part = part
+
+    def _finish(self) -> ParquetPart:
+        if self._stream is not self._raw:
+            self._stream.close()
+        part, self._part = self._part, None
+        part.size = self._raw.tell()
+        if part.path is None:
+            part.buffer = self._raw
+            part.buffer.seek(0)
+        else:
+            self._raw.close()
+            logger.info(f"File created: {part.path.resolve()}")
+        self._raw = self._stream = None
+        return part
+
+    def _encode(self, rows: List[Tuple]) -> bytes:
+        # format the whole batch in memory and hand it to the compressor in one write
+        formatters = self.formatters
+        text = io.StringIO()
+        csv.writer(text, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n").writerows(
+            [NULL if v is None else v if f is None else f(v) for v, f in zip(row, formatters)]
+            for row in rows
+        )
+        return text.getvalue().encode("utf-8")
+
+    def write(self, rows: List[Tuple]) -> List[ParquetPart]:
+        """
+        Add a batch of cursor rows to the current file,
+        returns the files that were finished by it
+        """
+        with metrics.timer("csv") as written:
+            if self._stream is None:
+                self._open()
+            size = self._raw.tell()
+            self._stream.write(self._encode(rows))
+            self._part.rows += len(rows)
+            written["rows"], written["bytes"] = len(rows), self._raw.tell() - size
+        if self._raw.tell() >= self.target_bytes:
+            return [self._finish()]
+        return []
+
+    def close(self) -> List[ParquetPart]:
+        """ Finish the file in progress, if there is one """
+        if self._stream is None:
+            return []
+        return [self._finish()]
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import json
+import sqlite3
+import logging
+from uuid import uuid4
+from pathlib import Path
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import List, Union
+from .rules import Chunk, Watermark
+from .state import encode_value, decode_value
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "./flakenews_manifest.sqlite"
+
+# chunk and table statuses
+STARTED = "started"
+DONE = "done"
+
+_SCHEMA = """
+create table if not exists run (
+    name text primary key
+    , value text
+);
+create table if not exists tables (
+    key text primary key
+    , status text not null
+    , mark text
+    , rows integer not null default 0
+    , updated_at text
+    , stage text
+);
+create table if not exists chunks (
+    key text not null
+    , idx integer not null
+    , lower text
+    , upper text
+    , status text
+    , rows integer not null default 0
+    , updated_at text
+    , primary key (key, idx)
+);
+"""
+
+
+def _dump(value) -> str:
+    return json.dumps(encode_value(value))
+
+
+def _load(text: str):
+    return decode_value(json.loads(text))
+
+
+@dataclass()
+class TablePlan:
+    """
+    What the manifest knows about a table from an earlier run
+    stage: the stage its chunks were written to, empty if they were appended
+        straight to the table, None in manifests from before it was recorded
+    """
+
+    key: str
+    status: str
+    rows: int = 0
+    mark: Union[Watermark, None] = None
+    chunks: List[Chunk] = field(default_factory=list)
+    done: dict = field(default_factory=dict)
+    started: set = field(default_factory=set)
+    stage: Union[str, None] = None
+
+
+class RunManifest:
+    """
+    Records in a local SQLite file which tables have been planned and loaded,
+    and which of their chunks are done, so that a failed run can be resumed.
+    Only used from the thread that schedules the work.
+
+    Without resume the manifest is cleared and a new run id is issued.
+    With resume the run id, the chunk boundaries and the watermark ranges of
+    the earlier run are kept, so staged files and chunks line up again.
+    """
+
+    def __init__(self, path: Union[Path, str] = MANIFEST_FILE, resume: bool = False):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.executescript(_SCHEMA)
+        # manifests written before the stage of each table was recorded
+        if "stage" not in (row[1] for row in self.conn.execute("pragma table_info(tables)")):
+            self.conn.execute("alter table tables add column stage text")
+        if not resume:
+            with self.conn:
+                self.conn.execute("delete from run")
+                self.conn.execute("delete from tables")
+                self.conn.execute("delete from chunks")
+        self.run_id = self._get("run_id")
+        if self.run_id is None:
+            self.run_id = datetime.utcnow().strftime("%Y%m%dT%H%M%S") + "_" + uuid4().hex[:8]
+            self._set("run_id", self.run_id)
+        logger.info(f"Run {self.run_id}, manifest {self.path.resolve()}")
+
+    def _get(self, name: str):
+        row = self.conn.execute("select value from run where name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set(self, name: str, value: str) -> None:
+        with self.conn:
+            self.conn.execute(
+                "insert or replace into run (name, value) values (?, ?)", (name, value)
+            )
+
+    def check_stage(self, stage: str) -> None:
+        """
+        Staged chunks can only be resumed through the same kind of stage,
+        and chunks appended straight to their table only without one
+        """
+        previous = self._get("stage")
+        if previous is not None and previous != stage:
+            raise ValueError(
+                f"Run {self.run_id} was started with stage '{previous or 'none'}',"
+                f" resume it with the same --stage"
+            )
+        self._set("stage", stage)
+
+    def get_table(self, key: str) -> Union[TablePlan, None]:
+        row = self.conn.execute(
+            "select status, rows, mark, stage from tables where key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        plan = TablePlan(key=key, status=row[0], rows=row[1], stage=row[3])
+        if row[2]:
+            plan.mark = Watermark(**{k: _load(v) for k, v in json.loads(row[2]).items()})
+        for idx, lower, upper, status, rows in self.conn.execute(
+            "select idx, lower, upper, status, rows from chunks where key = ? order by idx",
+            (key,),
+        ):
+            plan.chunks.append(Chunk(index=idx, lower=_load(lower), upper=_load(upper)))
+            if status == DONE:
+                plan.done[idx] = rows
+            elif status == STARTED:
+                plan.started.add(idx)
+        return plan
+
+    def plan_table(
+        self, key: str, mark: Union[Watermark, None], chunks: List[Chunk], stage: str = ""
+    ) -> None:
+        now = datetime.utcnow().isoformat()
+        mark_doc = None
+        if mark is not None:
+            mark_doc = json.dumps({"low": _dump(mark.low), "high": _dump(mark.high)})
+        with self.conn:
+            self.conn.execute("delete from chunks where key = ?", (key,))
+            self.conn.execute(
+                "insert or replace into tables (key, status, mark, updated_at, stage)"
+                " values (?, 'planned', ?, ?, ?)",
+                (key, mark_doc, now, stage),
+            )
+            self.conn.executemany(
+                "insert into chunks (key, idx, lower, upper, updated_at) values (?, ?, ?, ?, ?)",
+                [(key, c.index, _dump(c.lower), _dump(c.upper), now) for c in chunks],
+            )
+
+    def _chunk_status(self, key: str, chunk: Chunk, status: str, rows: int = 0) -> None:
+        with self.conn:
+            self.conn.execute(
+                "update chunks set status = ?, rows = ?, updated_at = ? where key = ? and idx = ?",
+                (status, rows, datetime.utcnow().isoformat(), key, chunk.index),
+            )
+
+    def chunk_pending(self, key: str, chunk: Chunk) -> None:
+        self._chunk_status(key, chunk, None)
+
+    def chunk_started(self, key: str, chunk: Chunk) -> None:
+        self._chunk_status(key, chunk, STARTED)
+
+    def chunk_done(self, key: str, chunk: Chunk, rows: int) -> None:
+        self._chunk_status(key, chunk, DONE, rows)
+
+    def table_done(self, key: str, rows: int) -> None:
+        with self.conn:
+            self.conn.execute(
+                "update tables set status = ?, rows = ?, updated_at = ? where key = ?",
+                (DONE, rows, datetime.utcnow().isoformat(), key),
+            )
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import json
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Dict, List, Union
+
+logger = logging.getLogger(__name__)
+
+METADATA_CACHE_FILE = "./flakenews_metadata.sqlite"
+
+_SCHEMA = """
+create table if not exists tables (
+    key text primary key
+    , modify_date text not null
+    , pk text not null
+    , cols text not null
+    , sf_ddl text not null
+    , updated_at text
+    , projection text
+);
+"""
+
+
+def cache_key(server: str, db: str, sch: str, tbl: str) -> str:
+    return f"{server}.{db}.{sch}.{tbl}".lower()
+
+
+@dataclass()
+class CachedTable:
+    """
+    The metadata of a table as of its last rules setup
+    modify_date: latest sys.objects modify_date of the table and its primary key
+    cols: the columns as dicts of Column fields
+    projection: names of the columns sf_ddl was generated for, None if not known
+    """
+
+    modify_date: str
+    pk: List[str] = field(default_factory=list)
+    cols: List[dict] = field(default_factory=list)
+    sf_ddl: str = ""
+    projection: Union[List[str], None] = None
+
+
+class MetadataCache:
+    """
+    Column and primary key metadata of source tables in a local SQLite file,
+    keyed by server.db.schema.table, so that a rules setup only queries the
+    catalog views for tables whose definition changed since the last one.
+    With refresh the cache is cleared and every table is queried again.
+    Can be shared by the threads setting up the rules of several servers.
+    """
+
+    def __init__(self, path: Union[Path, str] = METADATA_CACHE_FILE, refresh: bool = False):
+        self.path = Path(path)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._lock = threading.Lock()
+        self.conn.executescript(_SCHEMA)
+        # caches written before the projection was recorded
+        if "projection" not in (row[1] for row in self.conn.execute("pragma table_info(tables)")):
+            self.conn.execute("alter table tables add column projection text")
+        if refresh:
+            with self.conn:
+                self.conn.execute("delete from tables")
+
+    def get_many(self, keys: List[str]) -> Dict[str, CachedTable]:
+        """ The cached tables among keys, missing keys are left out """
+        found = {}
+        for key in keys:
+            with self._lock:
+                row = self.conn.execute(
+                    "select modify_date, pk, cols, sf_ddl, projection from tables where key = ?", (key,)
+                ).fetchone()
+            if row is not None:
+                found[key] = CachedTable(
+                    row[0], json.loads(row[1]), json.loads(row[2]), row[3],
+                    json.loads(row[4]) if row[4] is not None else None,
+                )
+        return found
+
+    def put_many(self, tables: Dict[str, CachedTable]) -> None:
+        now = datetime.utcnow().isoformat()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "insert or replace into tables (key, modify_date, pk, cols, sf_ddl, updated_at, projection)"
+                " values (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        key, t.modify_date, json.dumps(t.pk), json.dumps(t.cols), t.sf_ddl, now,
+                        json.dumps(t.projection) if t.projection is not None else None,
+                    )
+                    for key, t in tables.items()
+                ],
+            )
+        logger.info(f"Cached the metadata of {len(tables)} tables in {self.path.resolve()}")
+
+    def close(self) -> None:
+        self.conn.close()
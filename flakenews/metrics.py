@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import json
+import time
+import cProfile
+import logging
+import threading
+import tracemalloc
+from pathlib import Path
+from contextvars import ContextVar
+from contextlib import contextmanager
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+# labels like table and chunk for the work running in the current context,
+# copied into the fetch thread by pipeline.prefetch
+_labels = ContextVar("flakenews_metrics_labels", default={})
+
+
+class MetricsRecorder:
+    """
+    Collects timings and counters for each stage of extracting and loading.
+    Every event is written straight away as a JSON line, and totals per
+    table and stage are kept for the end of the run.
+    A path ending in .prom is written as a Prometheus textfile of the totals instead.
+    With no path only the totals are kept, for logging.
+    """
+
+    def __init__(self, path: Union[Path, str, None] = None):
+        self.path = Path(path) if path else None
+        self.prometheus = self.path is not None and self.path.suffix == ".prom"
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._file = None
+        if self.path is not None and not self.prometheus:
+            self._file = open(self.path, "a")
+
+    def record(
+        self, stage: str, seconds: float, rows: int = 0, nbytes: int = 0, **labels
+    ) -> None:
+        labels = {**_labels.get(), **labels}
+        table = labels.get("table", "")
+        with self._lock:
+            total = self._totals.setdefault(
+                (table, stage), {"events": 0, "seconds": 0.0, "rows": 0, "bytes": 0}
+            )
+            total["events"] += 1
+            total["seconds"] += seconds
+            total["rows"] += rows
+            total["bytes"] += nbytes
+            if self._file is not None:
+                event = {
+                    "ts": time.time(),
+                    "stage": stage,
+                    "seconds": round(seconds, 6),
+                    "rows": rows,
+                    "bytes": nbytes,
+                    **labels,
+                }
+                self._file.write(json.dumps(event, default=str) + "\n")
+
+    def totals(self) -> dict:
+        """ Totals keyed on (table, stage), with rows/sec per stage """
+        with self._lock:
+            totals = {key: dict(total) for key, total in self._totals.items()}
+        for total in totals.values():
+            seconds = total["seconds"]
+            total["rows_per_sec"] = total["rows"] / seconds if seconds else 0.0
+            total["bytes_per_sec"] = total["bytes"] / seconds if seconds else 0.0
+        return totals
+
+    def _write_prometheus(self, totals: dict) -> None:
+        metrics = {
+            "seconds": ("flakenews_stage_seconds_total", "counter", "Seconds spent in each stage"),
+            "events": ("flakenews_stage_events_total", "counter", "Batches or calls per stage"),
+            "rows": ("flakenews_stage_rows_total", "counter", "Rows through each stage"),
+            "bytes": ("flakenews_stage_bytes_total", "counter", "Bytes through each stage"),
+            "rows_per_sec": ("flakenews_stage_rows_per_second", "gauge", "Rows per second of stage time"),
+        }
+        lines = []
+        for field, (name, kind, help_text) in metrics.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (table, stage), total in sorted(totals.items()):
+                lines.append(f'{name}{{table="{table}",stage="{stage}"}} {total[field]}')
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        tmp.replace(self.path)
+
+    def close(self) -> None:
+        totals = self.totals()
+        for (table, stage), total in sorted(totals.items()):
+            logger.info(
+                f"{table or '-'} {stage}: {total['rows']} rows, {total['bytes']} bytes"
+                f" in {total['seconds']:.2f}s, {total['rows_per_sec']:.0f} rows/s"
+            )
+        if self.prometheus:
+            self._write_prometheus(totals)
+        with self._lock:
+            if self._file is not None:
+                for (table, stage), total in sorted(totals.items()):
+                    event = {"ts": time.time(), "stage": stage, "table": table, "total": True}
+                    self._file.write(json.dumps({**event, **total}) + "\n")
+                self._file.close()
+                self._file = None
+
+
+_recorder = MetricsRecorder()
+
+
+def configure(path: Union[Path, str, None] = None) -> MetricsRecorder:
+    """ Start recording to a new metrics file, closing the current recorder """
+    global _recorder
+    _recorder.close()
+    _recorder = MetricsRecorder(path)
+    return _recorder
+
+
+def get_recorder() -> MetricsRecorder:
+    return _recorder
+
+
+def record(stage: str, seconds: float, rows: int = 0, nbytes: int = 0, **labels) -> None:
+    _recorder.record(stage, seconds, rows, nbytes, **labels)
+
+
+@contextmanager
+def labelled(**labels):
+    """ Attach labels, e.g. table and chunk, to every event recorded inside the block """
+    token = _labels.set({**_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+@contextmanager
+def timer(stage: str, **labels):
+    """
+    Time a block and record it as one event of a stage,
+    set "rows" and "bytes" on the yielded dict to count them too
+    """
+    counts = {"rows": 0, "bytes": 0}
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        record(stage, time.perf_counter() - start, counts["rows"], counts["bytes"], **labels)
+
+
+@contextmanager
+def profiled(name: str, out_dir: Union[Path, str, None] = None):
+    """
+    Profile a block with cProfile into out_dir/<name>.prof, and if tracemalloc
+    is tracing, save its top allocations to out_dir/<name>.tracemalloc.txt.
+    cProfile only sees the calling thread, run with --queue-depth 0 to
+    include fetching. Does nothing without an out_dir.
+
+    The memory recorded is what is traced once the block ends. tracemalloc
+    traces the whole process, so with more than one worker it includes the
+    other chunks loading at the time. The peak in the file is that of the
+    block only on Python 3.9 and later, which can reset it, and of the run
+    before that
+    """
+    if out_dir is None:
+        yield
+        return
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(str(out_dir / f"{name}.prof"))
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            record("memory", 0.0, nbytes=current)
+            snapshot = tracemalloc.take_snapshot()
+            with open(out_dir / f"{name}.tracemalloc.txt", "w") as f:
+                f.write(f"current {current} bytes, peak {peak} bytes\n\n")
+                for stat in snapshot.statistics("lineno")[:25]:
+                    f.write(f"{stat}\n")
@@ -1,496 +1,399 @@
 #!/usr/bin/env python
 
-from os import getenv
-import yaml
-import json
-import csv
 import pymssql
 import logging
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from pathlib import Path
-from tempfile import NamedTemporaryFile
 from contextlib import closing
-from dataclasses import dataclass, field, asdict, astuple
-from typing import Generator, Tuple, List, Union
-from textwrap import dedent
+from operator import itemgetter
+from typing import Generator, Iterable, Tuple, List, Union
+from .parquet import ParquetSink, ParquetPart, TARGET_FILE_MB
+from .delimited import CsvSink
+from .throttle import RateLimiter, data_bytes, needs_bytes
+from . import metrics
+
+# the connection and metadata queries used to live here, and are still imported from here
+from .source import (
+    MSConfig,
+    new_conn,
+    set_servers_metadata,
+    set_isolation,
+    get_watermark,
+    get_chunks,
+    get_checksum,
+)
+
+# the rules used to live here, and are still imported from here
+from .rules import (
+    BATCH_SIZE,
+    MAX_BATCH_MB,
+    MIN_BATCH_ROWS,
+    CSV_BATCH_SIZE,
+    PARQUET,
+    CSV,
+    EXTRACT_FORMATS,
+    APPEND,
+    MERGE,
+    LOAD_MODES,
+    ISOLATION_LEVELS,
+    SELECT_EXPRESSIONS,
+    CHECKSUM_EXPRESSIONS,
+    SPLITTABLE_TYPES,
+    Column,
+    Chunk,
+    Watermark,
+    Table,
+    Schema,
+    Database,
+    TableRules,
+    BatchSizer,
+    new_table_rules_from_config,
+    new_table_rules,
+    qualified_name,
+    with_hints,
+    checksum_cols,
+)
 
 logger = logging.getLogger(__name__)
 
-# size of batches for query download
-BATCH_SIZE = 500000
+# Arrow types the ISO strings of SELECT_EXPRESSIONS are parsed as,
+# dates as timestamps because pyarrow before 7.0 cannot cast strings to date32
+ISO_TYPES = {
+    "datetime": pa.timestamp("us"),
+    "datetime2": pa.timestamp("us"),
+    "smalldatetime": pa.timestamp("us"),
+    "datetimeoffset": pa.timestamp("us", tz="UTC"),
+    "date": pa.timestamp("us"),
+}
 
 
-@dataclass()
-class MSConfig:
-    """ Connection to MSSQL """
-
-    server: str = ""
-    user: str = ""
-    password: str = ""
-    port: int = 0
-    appname: str = ""
-
-    def __post_init__(self):
-        self.server = getenv("FN_SQL_SERVER")
-        self.user = getenv("FN_SQL_USER")
-        self.password = getenv("FN_SQL_PASSWORD")
-        self.port = getenv("FN_SQL_PORT", 1433)
-        self.appname = "flakenews"
-
-
-@dataclass()
-class Column:
+def get_batch(
+    cur: pymssql.Cursor,
+    batch_size: int = BATCH_SIZE,
+    sizer: Union[BatchSizer, None] = None,
+    limiters: List[RateLimiter] = (),
+) -> Generator[Tuple, None, None]:
     """
-    Part of TableRules Class
+    Generate batches of batch_size rows, or as many as the sizer asks for,
+    no faster than the rate limiters allow.
+        Would have been nice to use cursor.rownumber,
+        but it does not increment; it is stuck at -1
+        due to this: https://github.com/pymssql/pymssql/issues/141
+
+        So the offset is counted here, the number of rows fetched so far.
     """
+    limiters = [limiter for limiter in limiters if limiter]
+    count_bytes = needs_bytes(limiters)
+    offset = 0
+    while True:
+        with metrics.timer("fetch") as fetched:
+            batch = cur.fetchmany(sizer.rows if sizer is not None else batch_size)
+            fetched["rows"] = len(batch)
+        if not batch:
+            break
+        offset += len(batch)
+        nbytes = data_bytes(batch) if count_bytes else 0
+        for limiter in limiters:
+            limiter.acquire(len(batch), nbytes)
+        yield batch, offset
 
-    name: str
-    ordinal_position: int
-    data_type: str
-    numeric_precision: int
-    numeric_scale: int
 
-    def clean_name(self):
-        return self.name.replace(" ", "_")
-    def caps_name(self):
-        return self.clean_name().upper()
+# nullable pandas dtypes, so integer and boolean columns with nulls keep their type
+PANDAS_DTYPES = {
+    pa.int64(): pd.Int64Dtype(),
+    pa.int32(): pd.Int32Dtype(),
+    pa.int16(): pd.Int16Dtype(),
+    pa.bool_(): pd.BooleanDtype(),
+}
 
 
-@dataclass()
-class Table:
+def _map_arrow_type(col: Column) -> Union[pa.DataType, None]:
     """
-    Part of TableRules Class
-    name: of the table
-    pk: list of 1 or more columns comprising the primary key of the table
-    cols: ordered list of the columns in the table
-    row_split_size: number of rows to query and upload to destination - for huge tables
-
+    Map a SQL Server data type to the Arrow type that extracted batches are built with
+    None means the type is inferred from the values
     """
 
-    name: str
-    cols: List[str] = field(default_factory=list)
-    pk: List[str] = field(default_factory=list)
-    row_split_size: int = 500000
-    sf_ddl: str = ""
-
-    def __post_init__(self):
-        if self.cols:
-            self.cols = [Column(**col) for col in self.cols]
-
-
-@dataclass
-class Schema:
-    """ Part of TableRules Class """
-
-    name: str
-    tables: List[Table]
-
-    def __post_init__(self):
-        self.tables = [Table(**table) for table in self.tables]
-
-
-@dataclass
-class Database:
-    """ Part of TableRules Class """
-
-    name: str
-    schemas: List[Schema]
-
-    def __post_init__(self):
-        self.schemas = [Schema(**schema) for schema in self.schemas]
-
-
-@dataclass
-class TableRules:
+    if col.data_type in ("numeric", "decimal"):
+        return pa.decimal128(col.numeric_precision or 38, col.numeric_scale or 0)
+
+    type_mapping = {
+        "varchar": pa.string(),
+        "char": pa.string(),
+        "nvarchar": pa.string(),
+        "nchar": pa.string(),
+        "ntext": pa.string(),
+        "text": pa.string(),
+        "uniqueidentifier": pa.string(),
+        "bigint": pa.int64(),
+        "int": pa.int32(),
+        "smallint": pa.int16(),
+        "tinyint": pa.int16(),
+        "float": pa.float64(),
+        "real": pa.float32(),
+        "money": pa.decimal128(19, 4),
+        "smallmoney": pa.decimal128(10, 4),
+        "bit": pa.bool_(),
+        "datetime": pa.timestamp("us", tz="UTC"),
+        "datetime2": pa.timestamp("us", tz="UTC"),
+        "smalldatetime": pa.timestamp("us", tz="UTC"),
+        "datetimeoffset": pa.timestamp("us", tz="UTC"),
+        "time": pa.time64("us"),
+        "date": pa.date32(),
+        # hex strings, see SELECT_EXPRESSIONS
+        "varbinary": pa.string(),
+        "binary": pa.string(),
+        "rowversion": pa.string(),
+        "timestamp": pa.string(),
+        "image": pa.string(),
+        "xml": pa.string(),
+    }
+    return type_mapping.get(col.data_type)
+
+
+def _parse_iso(values: List, col: Column) -> pa.Array:
     """
-    Initialized with basic table_config.yml
-    Later enhanced with metadata from the source database(s) to fill out Table Rules
+    Parse the ISO strings of a date or time column with an Arrow cast, or with
+    numpy on pyarrow before 2.0, which only casts whole seconds without a timezone
     """
+    try:
+        return pa.array(values, type=pa.string()).cast(ISO_TYPES[col.data_type])
+    except pa.ArrowInvalid:
+        if col.data_type == "datetimeoffset":
+            # already UTC, see SELECT_EXPRESSIONS
+            values = [None if v is None else v.rstrip("Z") for v in values]
+        return pa.array(np.array(values, dtype="datetime64[us]"), from_pandas=True)
 
-    databases: List[Database]
-
-    def __post_init__(self):
-        self.databases = [Database(**database) for database in self.databases]
-
-    def _all_tables(self) -> Tuple[Database, Schema, Table]:
-        """
-        Iterates through all of the 3-part-namespaces that uniquely identify tables.
-        """
-        for db in self.databases:
-            for sch in db.schemas:
-                for tbl in sch.tables:
-                    yield db, sch, tbl
-
-    def _pk_sql(self) -> str:
-        """
-        Return a metadata query to get the primary keys for tables
-        """
-
-        qry = """
-            ;with pks as ("""
-        qry += """
-
-                union all
-            """.join(
-            f"""
-                select
-                    lower(constr.constraint_catalog) collate sql_latin1_general_cp1_ci_as as table_catalog
-                    , lower(constr.constraint_schema) collate sql_latin1_general_cp1_ci_as as table_schema
-                    , lower(kcu.table_name) collate sql_latin1_general_cp1_ci_as as table_name
-                    , lower(kcu.column_name) collate sql_latin1_general_cp1_ci_as as column_name
-                    , kcu.ordinal_position
-                from [{db.name}].[information_schema].[table_constraints] as constr
-                join [{db.name}].[information_schema].[key_column_usage] as kcu
-                    on constr.constraint_name = kcu.constraint_name
-                where constraint_type = 'primary key'"""
-            for db in self.databases
-        )
-        qry += """
-            )    
-            select
-                table_catalog
-                , table_schema
-                , table_name
-                , stuff(
-                    (select 
-                        ',' + pk1.column_name
-                    from pks as pk1
-                    where pk1.table_catalog = pk2.table_catalog
-                        and  pk1.table_schema = pk2.table_schema
-                        and pk1.table_name = pk2.table_name
-                    order by pk1.ordinal_position
-                    for xml path(''), type
-                    ).value('.', 'varchar(max)'), 1, 1, ''
-                ) as primary_key_columns
-            from pks as pk2
-            group by
-                pk2.table_catalog
-                , pk2.table_schema
-                , pk2.table_name
-            """
-        qry = dedent(qry)
-        logger.debug(qry)
-        return qry
-
-    def _cols_sql(self):
-        """
-        Return an ordered metadata query to get the columns, their types, and their order within tables
-        """
-
-        qry = """
-            ;with cols as ("""
-        qry += """
-
-                union all
-            """.join(
-            f"""
-            select 
-                lower(table_catalog) collate sql_latin1_general_cp1_ci_as as table_catalog 
-                , lower(table_schema) collate sql_latin1_general_cp1_ci_as as table_schema
-                , lower(table_name) collate sql_latin1_general_cp1_ci_as as table_name
-                , lower(column_name) collate sql_latin1_general_cp1_ci_as as column_name
-                , ordinal_position
-                , lower(data_type) collate sql_latin1_general_cp1_ci_as as data_type
-                , numeric_precision
-                , numeric_scale
-            from [{db.name}].information_schema.columns"""
-            for db in self.databases
-        )
-        qry += """
-            )    
-            select
-                table_catalog
-                , table_schema
-                , table_name
-                , column_name
-                , ordinal_position
-                , data_type
-                , numeric_precision
-                , numeric_scale
-            from cols
-            order by table_catalog, table_schema, table_name, ordinal_position
-            """
-        qry = dedent(qry)
-        logger.debug(qry)
-        return qry
-
-    def _match_results_to_tables(self, cur: pymssql.Cursor, qry: str) -> None:
-
-        cur.execute(qry)
-        results = cur.fetchall()
-
-        for row in results:
-            for db, sch, tbl in self._all_tables():
-                if row[0] == db.name and row[1] == sch.name and row[2] == tbl.name:
-                    yield row, tbl
-
-    def _set_primary_keys(self, cur: pymssql.Cursor) -> None:
-        """
-        Enriches this TableRules instance with Primary Keys for each table
-
-        Requires a pymssql.Cursor
-        """
-        qry = self._pk_sql()
-        for row, tbl in self._match_results_to_tables(cur, qry):
-            tbl.pk = row[3].split(",")
-            break
-
-    def _set_cols(self, cur: pymssql.Cursor) -> None:
-        """
-        Enriches this TableRules instance with Column metadata for each table,
-        including name, datatype, order, precision and scale.
-
-        Requires a pymssql.Cursor
-        """
-
-        qry = self._cols_sql()
-
-        for row, tbl in self._match_results_to_tables(cur, qry):
-            tbl.cols.append(
-                Column(
-                    name=row[3],
-                    ordinal_position=row[4],
-                    data_type=row[5],
-                    numeric_precision=row[6],
-                    numeric_scale=row[7],
-                )
-            )
-
-    def _check_metadata(self) -> str:
-        table_errors = ""
-        for db, sch, tbl in self._all_tables():
-            if not tbl.cols:
-                table_errors += (
-                    f"\nTable not found, or no permission: {db.name}.{sch.name}.{tbl.name}"
-                )
-        if table_errors:
-            table_errors = "\nCheck your config or SQL Server permissions\n" + table_errors
-            logger.error(table_errors)
-
-    def _map_datatype(self, col: Column) -> str:
-        """
-        Map a SQL Server data type to the Snowflake equivalent
-        """
-
-        def _qualify_precision_and_scale(col: Column) -> str:
-            return (
-                "number("
-                + str(col.numeric_precision)
-                + ", "
-                + str(col.numeric_scale)
-                + ")"
-            )
-
-        type_mapping = {
-            "varchar": "varchar",
-            "char": "varchar",
-            "nvarchar": "varchar",
-            "nchar": "varchar",
-            "ntext": "varchar",
-            "text": "varchar",
-            "uniqueidentifier": "varchar",
-            "bigint": "number",
-            "int": "number",
-            "smallint": "number",
-            "tinyint": "number",
-            "float": col.data_type,
-            "real": "float",
-            "numeric": _qualify_precision_and_scale(col),
-            "decimal": _qualify_precision_and_scale(col),
-            "money": _qualify_precision_and_scale(col),
-            "smallmoney": _qualify_precision_and_scale(col),
-            "bit": "boolean",
-            "datetime": "timestamp",
-            "datetime2": "timestamp",
-            "smalldatetime": "timestamp",
-            "time": col.data_type,
-            "date": col.data_type,
-            "varbinary": "binary",
-            "binary": "variant", #col.data_type, ideally these should be binary but sql -> pandas -> snowflake doesn't like it
-            "rowversion": "variant", #"binary",
-            "image": "variant", #"binary",
-        }
-        return type_mapping.get(col.data_type, "variant")
-
-    def _set_sf_ddl(self, use_pk: bool = True):
-        """
-        Generates a `create or replace table` statement valid for snowflake
-        Expects the cols to be set already on the Table
-        """
-
-        def _with_pk(use_pk: bool, tbl: Table) -> str:
-            if use_pk and tbl.pk:
-                return (
-                    "    , constraint pk_"
-                    + tbl.name
-                    + " primary key ("
-                    + ", ".join(tbl.pk)
-                    + ")\n"
-                )
-            return ""
-
-        for _, _, tbl in self._all_tables():
-            tbl.sf_ddl = (
-                "create or replace table "
-                + tbl.name
-                + " (\n    "
-                + "    , ".join(
-                    col.clean_name() + " " + self._map_datatype(col) + "\n"
-                    for col in tbl.cols
-                )
-                + _with_pk(use_pk, tbl)
-                + ");"
-            )
 
-    def set_tables_metadata(self, conn: pymssql.Connection) -> None:
-        """
-        Enriches this TableRules instance with Primary Key and Column metadata for each table
-
-        Requires a pymssql.Connection handle
-        """
-        with closing(conn.cursor()) as cur:
-            self._set_primary_keys(cur)
-            self._set_cols(cur)
-            self._check_metadata()
-            self._set_sf_ddl()
-
-    def output_ddl(self, f: Path) -> None:
-        with open(f, "w") as f:
-            for _, _, tbl in self._all_tables():
-                if not tbl.sf_ddl:
-                    raise ValueError("The Snowflake DDL has not been set")
-                f.write(tbl.sf_ddl + "\n\n")
-
-    def output_rules(self, f: Path) -> None:
-        with open(f, "w") as f:
-            d = asdict(self)
-            logger.debug(d)
-            doc = json.dump(d, f, indent=2)
-
-    def get_basic_sql(self) -> Generator[Tuple, None, None]:
-        for db, sch, tbl in self._all_tables():
-            yield db, sch, tbl, f"""select {",".join(["[" + col.name + "]" for col in tbl.cols])} from [{db.name}].[{sch.name}].[{tbl.name}]"""
-
-
-def new_table_rules_from_config(infile: str) -> TableRules:
+def _to_arrow(values: List, col: Column) -> pa.Array:
     """
-    Constructs a TableRules object stub from a table_config.yml file
-    The infile expects a specific format.
+    Convert the values of one column to a typed Arrow array
+    Timestamps come from the query as ISO strings without a timezone, they are
+    parsed by Arrow and stored as UTC, a workaround for
+    https://github.com/snowflakedb/snowflake-connector-python/issues/319
     """
-    with open(infile, "r") as stream:
+    arrow_type = _map_arrow_type(col)
+    if col.data_type in ISO_TYPES:
+        return _parse_iso(values, col).cast(arrow_type)
+    if arrow_type is None:
         try:
-            table_config = yaml.safe_load(stream)
-        except yaml.YAMLError as e:
-            print(e)
-            sys.exit(1)
-        rules = TableRules(table_config.get("databases"))
-        logger.debug(rules)
-        return rules
+            return pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.array([None if v is None else str(v) for v in values])
+    return pa.array(values, type=arrow_type)
 
 
-def new_table_rules(infile: str) -> TableRules:
+def build_batch(batch: List[Tuple], tbl: Table) -> pa.Table:
     """
-    Constructs a TableRules object stub from a table_rules.json file
-    The infile expects a specific format.
+    Build a typed Arrow table from a batch of cursor rows,
+    filling one column buffer at a time so that only a single column of
+    intermediate Python values exists alongside the rows
     """
-    with open(infile, "r") as stream:
-        try:
-            table_config = json.load(stream)
-        except json.JSONDecodeError as e:
-            print(e)
-            sys.exit(1)
-        rules = TableRules(table_config.get("databases"))
-        logger.debug(rules)
-        return rules
-
-
-def new_conn(config: Union[MSConfig, None] = None) -> pymssql.Connection:
+    cols = tbl.selected_cols()
+    arrays = [
+        _to_arrow(list(map(itemgetter(i), batch)), col)
+        for i, col in enumerate(cols)
+    ]
+    return pa.Table.from_arrays(arrays, names=[col.caps_name() for col in cols])
+
+
+def query_to_arrow(
+    cur: pymssql.Cursor,
+    tbl: Table,
+    qry: str,
+    params: tuple = (),
+    max_batch_mb: int = MAX_BATCH_MB,
+    limiters: List[RateLimiter] = (),
+    lob_max_bytes: int = 0,
+) -> Generator[pa.Table, None, None]:
     """
-    Creates a DBAPI connection object for MSSQL Server
+    Run the extraction query for a single table and batch the results out
+    into typed Arrow tables of about max_batch_mb each,
+    or of BATCH_SIZE rows when max_batch_mb is 0. Tables with large object
+    columns are always sized, within MAX_BATCH_MB when max_batch_mb is 0
     """
-    if config is None:
-        config = MSConfig()
-
-    return pymssql.connect(**asdict(config))
-
-
-def get_batch(
-    cur: pymssql.Cursor, batch_size: int = BATCH_SIZE
-) -> Generator[Tuple, None, None]:
+    sizer = None
+    if max_batch_mb > 0 or tbl.lob_cols():
+        sizer = BatchSizer(tbl, (max_batch_mb or MAX_BATCH_MB) * 1024 * 1024, lob_max_bytes=lob_max_bytes)
+    with metrics.timer("execute"):
+        cur.execute(qry, params or None)
+    for batch, rownum in get_batch(cur, sizer=sizer, limiters=limiters):
+        with metrics.timer("build") as built:
+            table = build_batch(batch, tbl)
+            built["rows"], built["bytes"] = table.num_rows, table.nbytes
+        if sizer is not None:
+            sizer.observe(batch, table)
+        del batch
+        yield table
+
+
+def query_to_pandas(
+    cur: pymssql.Cursor,
+    tbl: Table,
+    qry: str,
+    params: tuple = (),
+    max_batch_mb: int = MAX_BATCH_MB,
+    limiters: List[RateLimiter] = (),
+    lob_max_bytes: int = 0,
+) -> Generator[pd.DataFrame, None, None]:
     """
-    Generate batches of BATCH_SIZE rows.
-        Would have been nice to use cursor.rownumber,
-        but it does not increment; it is stuck at -1
-        due to this: https://github.com/pymssql/pymssql/issues/141
-
-        So, the offset for the final batch is probably overestimated,
-        at least it provides a unique file-split name.
+    Run the extraction query for a single table and batch the results out
+    into pandas dataframes
     """
-    offset = 0
-    while True:
-        batch = cur.fetchmany(BATCH_SIZE)
-        if not batch:
-            break
-        offset += BATCH_SIZE
-        yield batch, offset
+    for table in query_to_arrow(cur, tbl, qry, params, max_batch_mb, limiters, lob_max_bytes):
+        yield table_to_pandas(table)
 
 
-def fix_date_cols(df: pd.DataFrame, tz: str = 'UTC') -> None:
+def _to_pandas_by_column(table: pa.Table) -> pd.DataFrame:
     """
-    Workaround adds timezone to timestamps for this issue with datetimes
-    https://github.com/snowflakedb/snowflake-connector-python/issues/319
+    Convert an extracted batch one column at a time, timestamps that pandas
+    cannot hold in nanoseconds, e.g. a 9999-12-31 sentinel, as objects
     """
-    cols = df.select_dtypes(include=['datetime64[ns]']).columns
-    for col in cols:
-        df[col] = df[col].dt.tz_localize(tz)
-
-
-def to_pandas(rules: TableRules, conn: pymssql.Connection):
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        try:
+            single = pa.Table.from_arrays([column], [name])
+            columns[name] = single.to_pandas(types_mapper=PANDAS_DTYPES.get)[name]
+        except pa.ArrowInvalid:
+            if not pa.types.is_timestamp(column.type):
+                raise
+            columns[name] = pd.Series(column.to_pylist(), dtype=object, name=name)
+    return pd.DataFrame(columns)
+
+
+def table_to_pandas(table: pa.Table) -> pd.DataFrame:
+    """ Convert an extracted batch to a pandas dataframe with nullable dtypes """
+    with metrics.timer("to_pandas") as converted:
+        try:
+            df = table.to_pandas(types_mapper=PANDAS_DTYPES.get)
+        except pa.ArrowInvalid:
+            df = _to_pandas_by_column(table)
+        converted["rows"] = len(df)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(df.head(1))
+    return df
+
+
+def to_pandas(
+    rules: TableRules, conn: pymssql.Connection, max_batch_mb: int = MAX_BATCH_MB
+):
     """
-    Batch out the data into pandas dataframes
-    TODO: Consider specifying the dt_types() in the pandas constructor
-          so that datetime64[ns] has UTC by default.
-          That would require a full SQL -> pd dtype mapping
+    Batch out the data for every table into pandas dataframes
     """
     with closing(conn.cursor()) as cur:
         for db, sch, tbl, qry in rules.get_basic_sql():
-            cur.execute(qry)
             logger.info(f"Querying table: {db.name}.{sch.name}.{tbl.name}")
-
-            for batch, rownum in get_batch(cur):
-                df = pd.DataFrame(
-                    data=batch, columns=[col.caps_name() for col in tbl.cols]
-                )
-                logger.info(df.head(1))
-                fix_date_cols(df)
+            for df in query_to_pandas(cur, tbl, qry, max_batch_mb=max_batch_mb):
                 yield db, sch, tbl, df
 
 
-def write_parquet(rules: TableRules, conn: pymssql.Connection):
+def query_to_parquet(
+    cur: pymssql.Cursor,
+    tbl: Table,
+    qry: str,
+    sink: ParquetSink,
+    params: tuple = (),
+    max_batch_mb: int = MAX_BATCH_MB,
+    limiters: List[RateLimiter] = (),
+    lob_max_bytes: int = 0,
+) -> Generator[ParquetPart, None, None]:
+    """
+    Stream the extraction query for a single table into a ParquetSink,
+    yielding each file as it is finished
+    """
+    yield from arrow_to_parquet(
+        query_to_arrow(cur, tbl, qry, params, max_batch_mb, limiters, lob_max_bytes), sink
+    )
+
+
+def arrow_to_parquet(tables: Iterable[pa.Table], sink: ParquetSink) -> Generator[ParquetPart, None, None]:
+    """ Write extracted batches into a ParquetSink, yielding each file as it is finished """
+    for table in tables:
+        yield from sink.write(table)
+    yield from sink.close()
+
+
+def write_parquet(
+    rules: TableRules,
+    conn: pymssql.Connection,
+    out_dir: Union[Path, str, None] = "./temp",
+    compression: str = "snappy",
+    target_mb: int = TARGET_FILE_MB,
+    max_batch_mb: int = MAX_BATCH_MB,
+):
+    """
+    Batch out the data into parquet files of about target_mb each,
+    one open writer per table with a row group per batch.
+    With out_dir None the files are kept in memory, e.g. for passing to boto3 s3
     """
-    Batch out the data into parquet files
-
-    Consider a buffer and passing that to boto3 s3
-    import io
-    f = io.BytesIO()
-    df.to_parquet(f)
-    f.seek(0)
-    content = f.read()
+    with closing(conn.cursor()) as cur:
+        for db, sch, tbl, qry in rules.get_basic_sql():
+            logger.info(f"Querying table: {db.name}.{sch.name}.{tbl.name}")
+            sink = ParquetSink(
+                f"{db.name}.{sch.name}.{tbl.name}",
+                out_dir,
+                compression,
+                target_mb * 1024 * 1024,
+            )
+            for part in query_to_parquet(cur, tbl, qry, sink, max_batch_mb=max_batch_mb):
+                yield db, sch, tbl, part
+
+
+def query_to_csv(
+    cur: pymssql.Cursor,
+    tbl: Table,
+    qry: str,
+    sink: CsvSink,
+    params: tuple = (),
+    limiters: List[RateLimiter] = (),
+    max_batch_mb: int = MAX_BATCH_MB,
+    lob_max_bytes: int = 0,
+) -> Generator[ParquetPart, None, None]:
+    """
+    Stream the extraction query for a single table straight from the cursor
+    into a CsvSink, CSV_BATCH_SIZE rows at a time, yielding each file as it is finished.
+    Tables with large object columns are fetched in batches of about max_batch_mb instead
+    """
+    sizer = None
+    if tbl.lob_cols():
+        sizer = BatchSizer(
+            tbl, (max_batch_mb or MAX_BATCH_MB) * 1024 * 1024, CSV_BATCH_SIZE, lob_max_bytes
+        )
+    with metrics.timer("execute"):
+        cur.execute(qry, params or None)
+    for batch, rownum in get_batch(cur, CSV_BATCH_SIZE, sizer, limiters):
+        yield from sink.write(batch)
+        if sizer is not None:
+            sizer.observe(batch)
+    yield from sink.close()
+
+
+def write_csv(
+    rules: TableRules,
+    conn: pymssql.Connection,
+    out_dir: Union[Path, str, None] = "./temp",
+    compression: str = "gzip",
+    target_mb: int = TARGET_FILE_MB,
+):
+    """
+    Stream the data into compressed CSV files of about target_mb each,
+    without building DataFrames.
+    With out_dir None the files are kept in memory, e.g. for passing to boto3 s3
     """
     with closing(conn.cursor()) as cur:
         for db, sch, tbl, qry in rules.get_basic_sql():
-            cur.execute(qry)
             logger.info(f"Querying table: {db.name}.{sch.name}.{tbl.name}")
+            sink = CsvSink(
+                f"{db.name}.{sch.name}.{tbl.name}",
+                [col.data_type for col in tbl.selected_cols()],
+                out_dir,
+                compression,
+                target_mb * 1024 * 1024,
+            )
+            for part in query_to_csv(cur, tbl, qry, sink):
+                yield db, sch, tbl, part
 
-            for batch, rownum in get_batch(cur):
-                df = pd.DataFrame(
-                    data=batch, columns=[col.caps_name() for col in tbl.cols]
-                )
-                logger.info(df.head(1))
-                path = Path(f"./temp/{tbl.name}_{str(rownum)}.parquet.gzip")
-                df.to_parquet(path, compression="gzip")
-                logger.info(f"File created: {path.resolve()}")
-                yield db, sch, tbl, path
 
 def head_parquet(f: Path) -> None:
     """
@@ -500,4 +403,4 @@ def head_parquet(f: Path) -> None:
     df = pd.read_parquet(f)
     logger.info(df.head())
     logger.info(df.dtypes)
-    logger.info(df.info(verbose=True))
\ No newline at end of file
+    logger.info(df.info(verbose=True))
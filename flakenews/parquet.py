@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import io
+import logging
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from dataclasses import dataclass
+from typing import List, Union
+from . import metrics
+from .rules import TARGET_FILE_MB, COMPRESSIONS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass()
+class ParquetPart:
+    """
+    A finished Parquet or CSV file
+    path: where the file was written, None when it was written in memory
+    buffer: the file contents when it was written in memory
+    """
+
+    name: str
+    rows: int = 0
+    size: int = 0
+    path: Union[Path, None] = None
+    buffer: Union[io.BytesIO, None] = None
+
+
+class ParquetSink:
+    """
+    Streams the batches of one table into Parquet files, keeping a single
+    writer open and adding every batch as a row group. A new file is started
+    once the current one reaches target_bytes.
+
+    out_dir: directory to write the files to, created if missing.
+        None writes each file to an in-memory buffer instead of local disk.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        out_dir: Union[Path, str, None] = None,
+        compression: str = "snappy",
+        target_bytes: int = TARGET_FILE_MB * 1024 * 1024,
+    ):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression {compression}, use one of {COMPRESSIONS}")
+        self.name = name
+        self.out_dir = Path(out_dir) if out_dir is not None else None
+        self.compression = compression
+        self.target_bytes = target_bytes
+        self._seq = 0
+        self._writer = None
+        self._sink = None
+        self._part = None
+        if self.out_dir is not None:
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+
+    def _open(self, schema: pa.Schema) -> None:
+        part = ParquetPart(name=f"{self.name}_{self._seq:05d}.parquet")
+        self._seq += 1
+        if self.out_dir is None:
+            self._sink = pa.BufferOutputStream()
+        else:
+            part.path = self.out_dir / part.name
+            self._sink = pa.OSFile(str(part.path), "wb")
+        self._writer = pq.ParquetWriter(
+            self._sink, schema, compression=self.compression
+        )
+        self._part = part
+
+    def _finish(self) -> ParquetPart:
+        self._writer.close()
+        part, self._part = self._part, None
+        part.size = self._sink.tell()
+        if part.path is None:
+            part.buffer = io.BytesIO(self._sink.getvalue().to_pybytes())
+        else:
+            self._sink.close()
+            logger.info(f"File created: {part.path.resolve()}")
+        self._writer = self._sink = None
+        return part
+
+    def write(self, table: pa.Table) -> List[ParquetPart]:
+        """
+        Add a batch to the current file as a row group,
+        returns the files that were finished by it
+        """
+        with metrics.timer("parquet") as written:
+            if self._writer is None:
+                self._open(table.schema)
+            size = self._sink.tell()
+            self._writer.write_table(table)
+            self._part.rows += table.num_rows
+            written["rows"], written["bytes"] = table.num_rows, self._sink.tell() - size
+        if self._sink.tell() >= self.target_bytes:
+            return [self._finish()]
+        return []
+
+    def close(self) -> List[ParquetPart]:
+        """ Finish the file in progress, if there is one """
+        if self._writer is None:
+            return []
+        return [self._finish()]
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import queue
+import logging
+import threading
+import contextvars
+from typing import Generator, Iterable
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks for a stopped consumer while the queue is full
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class _Failure:
+    """ Carries an exception raised on the fetch thread over to the consumer """
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def prefetch(items: Iterable, depth: int = 2, name: str = "fetch") -> Generator:
+    """
+    Iterate over `items` on a separate fetch thread, handing them over through a
+    queue bounded at `depth` items. While the caller uploads one batch, the next
+    ones are already being fetched, and memory stays capped at the queue depth.
+
+    Exceptions from the fetch thread are re-raised in the caller. Closing this
+    generator stops the fetch thread and waits for it, so the source cursor is
+    no longer in use once it returns; use it with contextlib.closing.
+    A depth below 1 iterates in the calling thread without a queue.
+    """
+    if depth < 1:
+        yield from items
+        return
+
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce() -> None:
+        try:
+            for item in items:
+                if not _put(item):
+                    return
+        except BaseException as e:
+            _put(_Failure(e))
+            return
+        finally:
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+        _put(_DONE)
+
+    # run in a copy of the caller's context, so metrics labels carry over
+    thread = threading.Thread(
+        target=contextvars.copy_context().run,
+        args=(_produce,),
+        name=f"{threading.current_thread().name}-{name}",
+        daemon=True,
+    )
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import logging
+from typing import List
+from .rules import (
+    TableRules,
+    Table,
+    BatchSizer,
+    BATCH_SIZE,
+    CSV_BATCH_SIZE,
+    CSV,
+    MAX_BATCH_MB,
+    qualified_name,
+    with_hints,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def size_key(tbl: Table) -> tuple:
+    """ Sorts the largest tables first, by reserved bytes then rows """
+    return -(tbl.reserved_bytes or 0), -(tbl.row_count or 0)
+
+
+def batch_rows(tbl: Table, max_batch_mb: int = MAX_BATCH_MB, lob_max_bytes: int = 0) -> int:
+    """
+    Rows in the first batch fetched of a table, as mssql.query_to_arrow and
+    mssql.query_to_csv size them before any batch has been measured
+    """
+    if tbl.extract_format == CSV and not tbl.lob_cols():
+        return CSV_BATCH_SIZE
+    if max_batch_mb <= 0 and not tbl.lob_cols():
+        return BATCH_SIZE
+    max_rows = CSV_BATCH_SIZE if tbl.extract_format == CSV else 0
+    return BatchSizer(tbl, (max_batch_mb or MAX_BATCH_MB) * 1024 * 1024, max_rows, lob_max_bytes).rows
+
+
+def print_plan(
+    rules: TableRules,
+    workers: int = 1,
+    max_batch_mb: int = MAX_BATCH_MB,
+    lob_max_bytes: int = 0,
+    hints: List[str] = (),
+    sql: bool = False,
+) -> None:
+    """
+    The estimated load plan from the table sizes collected by the rules setup:
+    every table in the order it will start, with its expected chunks, batches
+    and size, and how evenly the chunks spread over the workers.
+    With sql, the extraction query of every table as well
+    """
+    tables = sorted(rules._all_tables(), key=lambda table: size_key(table[2]))
+    width = max((len(qualified_name(*table)) for table in tables), default=0)
+    loads = [0] * max(workers, 1)
+    print("\nLoad plan, largest tables first")
+    for db, sch, tbl in tables:
+        chunks = tbl.expected_chunks()
+        rows = batch_rows(tbl, max_batch_mb, tbl.lob_max_bytes or lob_max_bytes)
+        batches = chunks * -(-(tbl.row_count or 0) // chunks // rows) if tbl.row_count else 0
+        line = (
+            f"  {qualified_name(db, sch, tbl):<{width}}  rows {tbl.row_count:>14,}  chunks {chunks:>6}"
+            f"  batches {batches:>7,} of {rows:>7,}  {tbl.reserved_bytes / 1024 ** 2:>12,.1f} MB"
+        )
+        if not tbl.reserved_bytes and not tbl.row_count:
+            line += "  size unknown, set up the rules again to collect it"
+        print(line)
+        if sql:
+            qry = rules.table_sql(db, sch, tbl, lob_max_bytes=lob_max_bytes)
+            print(f"    {with_hints(qry, tbl.query_hints or hints)}")
+        # hand each chunk to the least loaded worker, like the scheduler does
+        for _ in range(chunks):
+            loads[loads.index(min(loads))] += tbl.reserved_bytes / chunks
+    print(
+        f"{len(tables)} tables, {sum(tbl.expected_chunks() for *_, tbl in tables)} chunks,"
+        f" {sum(tbl.reserved_bytes for *_, tbl in tables) / 1024 ** 2:,.1f} MB"
+        f" over {len(loads)} workers, the busiest worker loads about {max(loads) / 1024 ** 2:,.1f} MB\n"
+    )
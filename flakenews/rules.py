@@ -0,0 +1,1196 @@
+#!/usr/bin/env python
+"""
+The table rules: which tables to load and how, their columns and primary keys,
+and the SQL that extracts, splits and checks them.
+
+Only needs the standard library, so that planning, filtering and printing rules
+starts at once. The SQL Server, Arrow and Snowflake backends import these from
+flakenews.mssql, flakenews.parquet and flakenews.snowflake.
+"""
+
+import sys
+import json
+import logging
+from pathlib import Path
+from contextlib import closing
+from dataclasses import dataclass, field, asdict
+from typing import TYPE_CHECKING, Dict, Generator, Tuple, List, Union
+from textwrap import dedent
+from .metadata_cache import CachedTable, cache_key
+
+if TYPE_CHECKING:
+    import pymssql
+    import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+# staged Parquet and CSV files roll over to a new file once they reach this size, suits Snowflake COPY
+TARGET_FILE_MB = 128
+
+# Parquet codecs, and the stages tables can be loaded from with COPY INTO
+COMPRESSIONS = ("snappy", "zstd", "gzip", "none")
+STAGES = ("internal", "s3")
+
+# size of batches for query download, when not sized by a memory budget
+BATCH_SIZE = 500000
+
+# memory budget of a batch, the fetched rows together with their Arrow table
+MAX_BATCH_MB = 256
+
+# never size a batch below this many rows, however wide the table
+MIN_BATCH_ROWS = 1000
+
+# rough bytes per value of each type in a fetched batch: the Arrow value plus its Python object
+TYPE_BYTES = {
+    "bit": 25,
+    "tinyint": 30,
+    "smallint": 30,
+    "int": 32,
+    "bigint": 36,
+    "float": 32,
+    "real": 28,
+    "decimal": 120,
+    "numeric": 120,
+    "money": 120,
+    "smallmoney": 120,
+    "date": 36,
+    "time": 40,
+    "datetime": 56,
+    "datetime2": 56,
+    "smalldatetime": 56,
+    "datetimeoffset": 64,
+    "uniqueidentifier": 120,
+}
+
+# a Python string or bytes object, plus the Arrow offset
+VAR_BYTES_OVERHEAD = 60
+
+# assumed length of max and text columns until a batch has been measured
+MAX_LENGTH_GUESS = 8000
+
+# large object columns: the types below, and max length varchar, nvarchar and varbinary.
+# Without a lob_max_bytes each value is assumed to be LOB_LENGTH_GUESS bytes until a
+# batch has been measured, and their batches may go down to MIN_LOB_BATCH_ROWS rows
+LOB_TYPES = ("text", "ntext", "image", "xml")
+LOB_LENGTH_GUESS = 1024 * 1024
+MIN_LOB_BATCH_ROWS = 10
+
+# rows fetched at a time when streaming to CSV, memory stays flat whatever the table's width
+CSV_BATCH_SIZE = 10000
+
+# how tables can be extracted, set per table as extract_format in table_rules.json
+PARQUET = "parquet"
+CSV = "csv"
+EXTRACT_FORMATS = (PARQUET, CSV)
+
+# how rows are written to Snowflake, set per run or per table as load_mode
+APPEND = "append"
+MERGE = "merge"
+LOAD_MODES = (APPEND, MERGE)
+
+# transaction isolation levels tables can be extracted under, set per table or per run.
+# snapshot needs allow_snapshot_isolation on the database
+ISOLATION_LEVELS = ("read committed", "read uncommitted", "snapshot")
+
+# columns that SQL Server converts in the extraction query, into values that are
+# cheaper to fetch and to build batches from than the Python objects pymssql makes
+# of them: guids as strings, binaries as hex, dates and times as ISO 8601 strings
+# that Arrow parses in bulk, truncated to microseconds. {} is the quoted column
+SELECT_EXPRESSIONS = {
+    "uniqueidentifier": "lower(convert(char(36), {}))",
+    "money": "convert(decimal(19, 4), {})",
+    "smallmoney": "convert(decimal(10, 4), {})",
+    "datetime": "convert(varchar(26), {}, 126)",
+    "datetime2": "convert(varchar(26), {}, 126)",
+    "smalldatetime": "convert(varchar(26), {}, 126)",
+    "datetimeoffset": "convert(varchar(26), convert(datetime2, switchoffset({}, '+00:00')), 126) + 'Z'",
+    "date": "convert(char(10), {}, 23)",
+    "binary": "convert(varchar(max), {}, 2)",
+    "varbinary": "convert(varchar(max), {}, 2)",
+    "image": "convert(varchar(max), convert(varbinary(max), {}), 2)",
+    "rowversion": "convert(varchar(max), {}, 2)",
+    "timestamp": "convert(varchar(max), {}, 2)",
+    "xml": "convert(nvarchar(max), {})",
+}
+
+# large object columns cut down to {n} bytes on the server when a table has a lob_max_bytes,
+# binaries before they are converted to hex, unicode text to {n} / 2 characters
+LOB_TRUNCATE_EXPRESSIONS = {
+    "varchar": "left(convert(varchar(max), {}), {n})",
+    "text": "left(convert(varchar(max), {}), {n})",
+    "nvarchar": "left(convert(nvarchar(max), {}), {n} / 2)",
+    "ntext": "left(convert(nvarchar(max), {}), {n} / 2)",
+    "xml": "left(convert(nvarchar(max), {}), {n} / 2)",
+    "varbinary": "convert(varchar(max), substring(convert(varbinary(max), {}), 1, {n}), 2)",
+    "image": "convert(varchar(max), substring(convert(varbinary(max), {}), 1, {n}), 2)",
+}
+
+# text of a column for the --verify checksums, that snowflake.CHECKSUM_EXPRESSIONS
+# renders the same from the loaded values. Timestamps are compared as epoch
+# microseconds of the ISO strings that were loaded, time to the second.
+# Floats, and types that are not listed, are left out of the checksum
+_TIMESTAMP_CHECKSUM = "convert(nvarchar(20), datediff_big(microsecond, '19700101', convert(datetime2, {})))"
+CHECKSUM_EXPRESSIONS = {
+    **{t: "convert(nvarchar(max), {})" for t in ("bigint", "int", "smallint", "tinyint", "decimal", "numeric")},
+    **{t: "convert(nvarchar(max), {})" for t in ("varchar", "char", "nvarchar", "nchar", "text", "ntext")},
+    "money": "convert(nvarchar(max), convert(decimal(19, 4), {}))",
+    "smallmoney": "convert(nvarchar(max), convert(decimal(10, 4), {}))",
+    "bit": "convert(nvarchar(1), {})",
+    "uniqueidentifier": "lower(convert(nchar(36), {}))",
+    "date": "convert(nchar(10), {}, 23)",
+    "time": "convert(nchar(8), {}, 108)",
+    **{
+        t: _TIMESTAMP_CHECKSUM.format(SELECT_EXPRESSIONS[t])
+        for t in ("datetime", "datetime2", "smalldatetime")
+    },
+    "datetimeoffset": _TIMESTAMP_CHECKSUM.format(
+        "convert(varchar(26), convert(datetime2, switchoffset({}, '+00:00')), 126)"
+    ),
+    **{t: "convert(nvarchar(max), {}, 2)" for t in ("binary", "varbinary", "rowversion", "timestamp")},
+    "image": "convert(nvarchar(max), convert(varbinary(max), {}), 2)",
+}
+
+# rows fetched at a time from the metadata queries
+METADATA_BATCH_SIZE = 10000
+
+# most names the metadata queries list in their IN filters, longer lists can fail
+# to compile on SQL Server with error 8623 so fewer names are listed, see _tables_filter
+METADATA_FILTER_MAX_NAMES = 1000
+
+# primary key types that can be split into ranges for chunked extraction
+SPLITTABLE_TYPES = {
+    "bigint",
+    "int",
+    "smallint",
+    "tinyint",
+    "numeric",
+    "decimal",
+    "date",
+    "datetime",
+    "datetime2",
+    "smalldatetime",
+}
+
+
+def _quote(name: str) -> str:
+    """ A lowercase string literal of a name, for the metadata queries """
+    return "'" + name.lower().replace("'", "''") + "'"
+
+
+@dataclass()
+class Column:
+    """
+    Part of TableRules Class
+    character_maximum_length: declared length of string and binary columns, -1 for max
+    """
+
+    name: str
+    ordinal_position: int
+    data_type: str
+    numeric_precision: int
+    numeric_scale: int
+    character_maximum_length: Union[int, None] = None
+
+    def clean_name(self):
+        return self.name.replace(" ", "_")
+    def is_lob(self):
+        return self.data_type in LOB_TYPES or (
+            self.data_type in ("varchar", "nvarchar", "varbinary") and self.character_maximum_length == -1
+        )
+    def caps_name(self):
+        return self.clean_name().upper()
+
+
+@dataclass()
+class Chunk:
+    """
+    A primary key range of a Table, extracted and loaded as one unit of work
+    lower: inclusive lower bound of the pk, None for the first chunk
+    upper: exclusive upper bound of the pk, None for the last chunk
+    """
+
+    index: int = 0
+    lower: object = None
+    upper: object = None
+
+    def is_bounded(self) -> bool:
+        return self.lower is not None or self.upper is not None
+
+
+@dataclass()
+class Watermark:
+    """
+    The range of an incremental load on a Table's watermark column
+    low: exclusive, the high-watermark of the last successful load, None for a first load
+    high: inclusive, the maximum value of the column when this load started
+    """
+
+    low: object = None
+    high: object = None
+
+    def has_rows(self) -> bool:
+        return self.high is not None and self.high != self.low
+
+
+@dataclass()
+class Table:
+    """
+    Part of TableRules Class
+    name: of the table
+    pk: list of 1 or more columns comprising the primary key of the table
+    cols: ordered list of the columns in the table
+    row_split_size: number of rows to query and upload to destination - for huge tables
+        with a single numeric or date pk the table is extracted in pk ranges of this many rows
+    watermark: optional rowversion, identity or modified date column for incremental loads,
+        only rows above the value saved by the last successful load are extracted
+    row_count: rows in the table when the rules were set up, from sys.dm_db_partition_stats
+    reserved_bytes: space reserved by the table and its indexes when the rules were set up,
+        the largest tables are loaded first
+    extract_format: parquet, or csv to stream the rows into compressed CSV files
+        without building DataFrames, cheaper for tables of mostly text. csv tables
+        are always loaded through a stage, the internal one if no --stage is given
+    isolation: transaction isolation level of the extraction, one of ISOLATION_LEVELS,
+        empty for the level of the run
+    query_hints: OPTION hints of the extraction queries, e.g. ["maxdop 1"],
+        empty for the hints of the run
+    max_rows_per_sec, max_mb_per_sec: limits on how fast the table is fetched,
+        over all its chunks together, 0 for no limit besides that of the run
+    include_cols: only extract and create these columns, empty for all of them
+    exclude_cols: leave these columns out. The pk and watermark columns are always kept
+    where: a SQL Server predicate limiting the rows extracted, e.g. "created >= '2020-01-01'"
+    load_mode: append, or merge to upsert the rows on the pk through a transient staging
+        table, empty for the mode of the run. merge tables are always loaded through a stage
+    lob_max_bytes: cut the values of large object columns down to this many bytes on the
+        server, 0 for the limit of the run. Such tables are fetched in smaller batches
+
+    """
+
+    name: str
+    cols: List[str] = field(default_factory=list)
+    pk: List[str] = field(default_factory=list)
+    row_count: int = 0
+    reserved_bytes: int = 0
+    row_split_size: int = 500000
+    sf_ddl: str = ""
+    watermark: str = ""
+    extract_format: str = PARQUET
+    isolation: str = ""
+    query_hints: List[str] = field(default_factory=list)
+    max_rows_per_sec: int = 0
+    max_mb_per_sec: float = 0.0
+    include_cols: List[str] = field(default_factory=list)
+    exclude_cols: List[str] = field(default_factory=list)
+    where: str = ""
+    load_mode: str = ""
+    lob_max_bytes: int = 0
+
+    def __post_init__(self):
+        if self.cols:
+            self.cols = [Column(**col) for col in self.cols]
+        if self.extract_format not in EXTRACT_FORMATS:
+            raise ValueError(
+                f"Unknown extract_format {self.extract_format} for table {self.name},"
+                f" use one of {EXTRACT_FORMATS}"
+            )
+        if self.isolation and self.isolation not in ISOLATION_LEVELS:
+            raise ValueError(
+                f"Unknown isolation {self.isolation} for table {self.name},"
+                f" use one of {ISOLATION_LEVELS}"
+            )
+        if self.load_mode and self.load_mode not in LOAD_MODES:
+            raise ValueError(
+                f"Unknown load_mode {self.load_mode} for table {self.name},"
+                f" use one of {LOAD_MODES}"
+            )
+
+    def split_col(self) -> Union[Column, None]:
+        """
+        The column to split the table into chunks on, only for a single column
+        primary key of a numeric or date type, otherwise None
+        """
+        if len(self.pk) != 1 or self.row_split_size < 1:
+            return None
+        for col in self.cols:
+            if col.name == self.pk[0] and col.data_type in SPLITTABLE_TYPES:
+                return col
+        return None
+
+    def selected_cols(self) -> List[Column]:
+        """
+        The columns that are extracted and created on Snowflake, after include_cols
+        and exclude_cols, names compared case insensitively
+        """
+        if not self.include_cols and not self.exclude_cols:
+            return self.cols
+        keep = {name.lower() for name in self.pk}
+        if self.watermark:
+            keep.add(self.watermark.lower())
+        include = {name.lower() for name in self.include_cols}
+        exclude = {name.lower() for name in self.exclude_cols}
+        return [
+            col for col in self.cols
+            if col.name.lower() in keep
+            or ((not include or col.name.lower() in include) and col.name.lower() not in exclude)
+        ]
+
+    def lob_cols(self) -> List[Column]:
+        """ The selected columns holding large objects, see Column.is_lob """
+        return [col for col in self.selected_cols() if col.is_lob()]
+
+    def expected_chunks(self) -> int:
+        """ How many pk range chunks the table will be split into, going by its row count """
+        if self.split_col() is None or not self.row_count:
+            return 1
+        return -(-self.row_count // self.row_split_size)
+
+
+@dataclass
+class Schema:
+    """ Part of TableRules Class """
+
+    name: str
+    tables: List[Table]
+
+    def __post_init__(self):
+        self.tables = [Table(**table) for table in self.tables]
+
+
+@dataclass
+class Database:
+    """
+    Part of TableRules Class
+    server: the profile of the SQL Server the database is on, see MSConfig,
+        empty for the one in FN_SQL_SERVER. The same database can be listed once per server
+    """
+
+    name: str
+    schemas: List[Schema]
+    server: str = ""
+
+    def __post_init__(self):
+        self.schemas = [Schema(**schema) for schema in self.schemas]
+
+
+@dataclass
+class TableRules:
+    """
+    Initialized with basic table_config.yml
+    Later enhanced with metadata from the source database(s) to fill out Table Rules
+    """
+
+    databases: List[Database]
+
+    def __post_init__(self):
+        self.databases = [Database(**database) for database in self.databases]
+
+    def _all_tables(self) -> Tuple[Database, Schema, Table]:
+        """
+        Iterates through all of the 3-part-namespaces that uniquely identify tables.
+        """
+        for db in self.databases:
+            for sch in db.schemas:
+                for tbl in sch.tables:
+                    yield db, sch, tbl
+
+    def _table_index(self) -> dict:
+        """
+        All the tables keyed on their lowercase (db, schema, table) names,
+        matching the names returned by the metadata queries
+        """
+        return {
+            (db.name.lower(), sch.name.lower(), tbl.name.lower()): tbl
+            for db, sch, tbl in self._all_tables()
+        }
+
+    def _tables_filter(self, db: Database, schema_col: str, table_col: str) -> str:
+        """
+        Return a predicate limiting a metadata query to the configured tables of a database.
+        With more than METADATA_FILTER_MAX_NAMES tables in the rules it only lists their
+        schemas, and with that many schemas nothing; _match_results_to_tables drops the
+        rows of the tables that are not in the rules either way
+        """
+        schemas = [sch for sch in db.schemas if sch.tables]
+        if not schemas:
+            return "1 = 0"
+        tables = sum(len(sch.tables) for d in self.databases for sch in d.schemas)
+        if tables <= METADATA_FILTER_MAX_NAMES:
+            return " or ".join(
+                f"(lower({schema_col}) = {_quote(sch.name)} and lower({table_col}) in ("
+                + ", ".join(_quote(tbl.name) for tbl in sch.tables)
+                + "))"
+                for sch in schemas
+            )
+        if sum(len(d.schemas) for d in self.databases) <= METADATA_FILTER_MAX_NAMES:
+            return f"lower({schema_col}) in (" + ", ".join(_quote(sch.name) for sch in schemas) + ")"
+        return "1 = 1"
+
+    def _pk_sql(self) -> str:
+        """
+        Return a metadata query to get the primary keys for tables
+        """
+
+        qry = """
+            ;with pks as ("""
+        qry += """
+
+                union all
+            """.join(
+            f"""
+                select
+                    lower(constr.constraint_catalog) collate sql_latin1_general_cp1_ci_as as table_catalog
+                    , lower(constr.constraint_schema) collate sql_latin1_general_cp1_ci_as as table_schema
+                    , lower(kcu.table_name) collate sql_latin1_general_cp1_ci_as as table_name
+                    , lower(kcu.column_name) collate sql_latin1_general_cp1_ci_as as column_name
+                    , kcu.ordinal_position
+                from [{db.name}].[information_schema].[table_constraints] as constr
+                join [{db.name}].[information_schema].[key_column_usage] as kcu
+                    on constr.constraint_name = kcu.constraint_name
+                    and constr.constraint_schema = kcu.constraint_schema
+                where constraint_type = 'primary key'
+                    and ({self._tables_filter(db, "kcu.table_schema", "kcu.table_name")})"""
+            for db in self.databases
+        )
+        qry += """
+            )    
+            select
+                table_catalog
+                , table_schema
+                , table_name
+                , stuff(
+                    (select 
+                        ',' + pk1.column_name
+                    from pks as pk1
+                    where pk1.table_catalog = pk2.table_catalog
+                        and  pk1.table_schema = pk2.table_schema
+                        and pk1.table_name = pk2.table_name
+                    order by pk1.ordinal_position
+                    for xml path(''), type
+                    ).value('.', 'varchar(max)'), 1, 1, ''
+                ) as primary_key_columns
+            from pks as pk2
+            group by
+                pk2.table_catalog
+                , pk2.table_schema
+                , pk2.table_name
+            """
+        qry = dedent(qry)
+        logger.debug(qry)
+        return qry
+
+    def _cols_sql(self):
+        """
+        Return an ordered metadata query to get the columns, their types, and their order within tables
+        """
+
+        qry = """
+            ;with cols as ("""
+        qry += """
+
+                union all
+            """.join(
+            f"""
+            select 
+                lower(table_catalog) collate sql_latin1_general_cp1_ci_as as table_catalog 
+                , lower(table_schema) collate sql_latin1_general_cp1_ci_as as table_schema
+                , lower(table_name) collate sql_latin1_general_cp1_ci_as as table_name
+                , lower(column_name) collate sql_latin1_general_cp1_ci_as as column_name
+                , ordinal_position
+                , lower(data_type) collate sql_latin1_general_cp1_ci_as as data_type
+                , numeric_precision
+                , numeric_scale
+                , character_maximum_length
+            from [{db.name}].information_schema.columns
+            where {self._tables_filter(db, "table_schema", "table_name")}"""
+            for db in self.databases
+        )
+        qry += """
+            )    
+            select
+                table_catalog
+                , table_schema
+                , table_name
+                , column_name
+                , ordinal_position
+                , data_type
+                , numeric_precision
+                , numeric_scale
+                , character_maximum_length
+            from cols
+            order by table_catalog, table_schema, table_name, ordinal_position
+            """
+        qry = dedent(qry)
+        logger.debug(qry)
+        return qry
+
+    def _stats_sql(self) -> str:
+        """
+        Return a metadata query to get the row count and reserved bytes of tables,
+        the rows from the heap or clustered index and the pages from every index
+        """
+        qry = """
+
+            union all
+        """.join(
+            f"""
+            select
+                {_quote(db.name)} collate sql_latin1_general_cp1_ci_as as table_catalog
+                , lower(s.name) collate sql_latin1_general_cp1_ci_as as table_schema
+                , lower(o.name) collate sql_latin1_general_cp1_ci_as as table_name
+                , sum(case when ps.index_id in (0, 1) then ps.row_count else 0 end) as row_count
+                , sum(ps.reserved_page_count) * 8192 as reserved_bytes
+            from [{db.name}].sys.dm_db_partition_stats as ps
+            join [{db.name}].sys.objects as o
+                on o.object_id = ps.object_id
+            join [{db.name}].sys.schemas as s
+                on s.schema_id = o.schema_id
+            where o.type = 'U'
+                and ({self._tables_filter(db, "s.name", "o.name")})
+            group by s.name, o.name"""
+            for db in self.databases
+        )
+        qry = dedent(qry)
+        logger.debug(qry)
+        return qry
+
+    def _modify_dates_sql(self) -> str:
+        """
+        Return a metadata query to get when the definition of each table last changed,
+        the latest modify_date of the table and of its primary key constraint
+        """
+        qry = """
+
+            union all
+        """.join(
+            f"""
+            select
+                {_quote(db.name)} collate sql_latin1_general_cp1_ci_as as table_catalog
+                , lower(s.name) collate sql_latin1_general_cp1_ci_as as table_schema
+                , lower(t.name) collate sql_latin1_general_cp1_ci_as as table_name
+                , convert(varchar(23), max(o.modify_date), 121) as modify_date
+            from [{db.name}].sys.tables as t
+            join [{db.name}].sys.schemas as s
+                on s.schema_id = t.schema_id
+            join [{db.name}].sys.objects as o
+                on o.object_id = t.object_id
+                or (o.parent_object_id = t.object_id and o.type = 'PK')
+            where {self._tables_filter(db, "s.name", "t.name")}
+            group by s.name, t.name"""
+            for db in self.databases
+        )
+        qry = dedent(qry)
+        logger.debug(qry)
+        return qry
+
+    def _subset(self, keys: set) -> "TableRules":
+        """
+        TableRules of the same Table objects, only those whose lowercase
+        (db, schema, table) names are in keys
+        """
+        subset = TableRules([])
+        for db in self.databases:
+            schemas = []
+            for sch in db.schemas:
+                tables = [
+                    tbl for tbl in sch.tables
+                    if (db.name.lower(), sch.name.lower(), tbl.name.lower()) in keys
+                ]
+                if tables:
+                    schemas.append(Schema(sch.name, []))
+                    schemas[-1].tables = tables
+            if schemas:
+                subset.databases.append(Database(db.name, [], db.server))
+                subset.databases[-1].schemas = schemas
+        return subset
+
+    def by_server(self) -> Dict[str, "TableRules"]:
+        """ TableRules of the same Database objects for each server profile """
+        servers = {}
+        for db in self.databases:
+            servers.setdefault(db.server, TableRules([])).databases.append(db)
+        return servers
+
+    def _match_results_to_tables(
+        self, cur: "pymssql.Cursor", qry: str
+    ) -> Generator[Tuple[Tuple, Table], None, None]:
+        """
+        Stream the rows of a metadata query, paired with the table each row
+        belongs to via a lookup on (db, schema, table)
+        """
+        index = self._table_index()
+        cur.execute(qry)
+        while True:
+            rows = cur.fetchmany(METADATA_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                tbl = index.get((row[0], row[1], row[2]))
+                if tbl is not None:
+                    yield row, tbl
+
+    def _set_primary_keys(self, cur: "pymssql.Cursor") -> None:
+        """
+        Enriches this TableRules instance with Primary Keys for each table
+
+        Requires a pymssql.Cursor
+        """
+        qry = self._pk_sql()
+        for row, tbl in self._match_results_to_tables(cur, qry):
+            tbl.pk = row[3].split(",")
+
+    def _set_cols(self, cur: "pymssql.Cursor") -> None:
+        """
+        Enriches this TableRules instance with Column metadata for each table,
+        including name, datatype, order, precision and scale.
+
+        Requires a pymssql.Cursor
+        """
+
+        qry = self._cols_sql()
+
+        for row, tbl in self._match_results_to_tables(cur, qry):
+            tbl.cols.append(
+                Column(
+                    name=row[3],
+                    ordinal_position=row[4],
+                    data_type=row[5],
+                    numeric_precision=row[6],
+                    numeric_scale=row[7],
+                    character_maximum_length=row[8],
+                )
+            )
+
+    def _set_stats(self, cur: "pymssql.Cursor") -> None:
+        """
+        Enriches this TableRules instance with the row count and reserved bytes of each table.
+        The stats only order the load, so without VIEW DATABASE STATE permission
+        they are skipped with a warning
+
+        Requires a pymssql.Cursor
+        """
+        import pymssql
+
+        qry = self._stats_sql()
+        try:
+            for row, tbl in self._match_results_to_tables(cur, qry):
+                tbl.row_count, tbl.reserved_bytes = int(row[3]), int(row[4])
+        except pymssql.Error as e:
+            logger.warning(f"Could not read table sizes from sys.dm_db_partition_stats: {e}")
+
+    def _check_metadata(self) -> str:
+        table_errors = ""
+        for db, sch, tbl in self._all_tables():
+            if not tbl.cols:
+                table_errors += (
+                    f"\nTable not found, or no permission: {qualified_name(db, sch, tbl)}"
+                )
+            elif tbl.watermark and tbl.watermark.lower() not in (col.name.lower() for col in tbl.cols):
+                table_errors += (
+                    f"\nWatermark column {tbl.watermark} not found: {qualified_name(db, sch, tbl)}"
+                )
+            else:
+                names = {col.name.lower() for col in tbl.cols}
+                for name in tbl.include_cols + tbl.exclude_cols:
+                    if name.lower() not in names:
+                        table_errors += (
+                            f"\nColumn {name} in include_cols or exclude_cols not found:"
+                            f" {qualified_name(db, sch, tbl)}"
+                        )
+        if table_errors:
+            table_errors = "\nCheck your config or SQL Server permissions\n" + table_errors
+            logger.error(table_errors)
+
+    def _map_datatype(self, col: Column) -> str:
+        """
+        Map a SQL Server data type to the Snowflake equivalent
+        """
+
+        def _qualify_precision_and_scale(col: Column) -> str:
+            return (
+                "number("
+                + str(col.numeric_precision)
+                + ", "
+                + str(col.numeric_scale)
+                + ")"
+            )
+
+        type_mapping = {
+            "varchar": "varchar",
+            "char": "varchar",
+            "nvarchar": "varchar",
+            "nchar": "varchar",
+            "ntext": "varchar",
+            "text": "varchar",
+            "uniqueidentifier": "varchar",
+            "bigint": "number",
+            "int": "number",
+            "smallint": "number",
+            "tinyint": "number",
+            "float": col.data_type,
+            "real": "float",
+            "numeric": _qualify_precision_and_scale(col),
+            "decimal": _qualify_precision_and_scale(col),
+            "money": _qualify_precision_and_scale(col),
+            "smallmoney": _qualify_precision_and_scale(col),
+            "bit": "boolean",
+            "datetime": "timestamp",
+            "datetime2": "timestamp",
+            "smalldatetime": "timestamp",
+            "datetimeoffset": "timestamp_tz",
+            "time": col.data_type,
+            "date": col.data_type,
+            # extracted as hex strings, which Snowflake loads into binary
+            "varbinary": "binary",
+            "binary": "binary",
+            "rowversion": "binary",
+            "timestamp": "binary",
+            "image": "binary",
+            "xml": "varchar",
+        }
+        return type_mapping.get(col.data_type, "variant")
+
+    def _set_sf_ddl(self, use_pk: bool = True):
+        """
+        Generates a `create or replace table` statement valid for snowflake
+        Expects the cols to be set already on the Table
+        """
+
+        def _with_pk(use_pk: bool, tbl: Table) -> str:
+            if use_pk and tbl.pk:
+                return (
+                    "    , constraint pk_"
+                    + tbl.name
+                    + " primary key ("
+                    + ", ".join(tbl.pk)
+                    + ")\n"
+                )
+            return ""
+
+        for _, _, tbl in self._all_tables():
+            tbl.sf_ddl = (
+                "create or replace table "
+                + tbl.name
+                + " (\n    "
+                + "    , ".join(
+                    col.clean_name() + " " + self._map_datatype(col) + "\n"
+                    for col in tbl.selected_cols()
+                )
+                + _with_pk(use_pk, tbl)
+                + ");"
+            )
+
+    def _apply_cache(
+        self, cur: "pymssql.Cursor", cache
+    ) -> Tuple["TableRules", "TableRules", dict]:
+        """
+        Fill in the primary key, columns and DDL of every table whose definition has
+        not changed since it was cached. Returns TableRules of the tables that still
+        need their metadata queried, TableRules of those and of the tables whose
+        selected columns changed, that need their DDL generated again, and the cache
+        keys and modify dates of all of them
+        """
+        cur.execute("select @@servername")
+        server = cur.fetchone()[0] or ""
+        modified = {
+            (row[0], row[1], row[2]): row[3]
+            for row, _ in self._match_results_to_tables(cur, self._modify_dates_sql())
+        }
+        index = self._table_index()
+        keys = {index_key: cache_key(server, *index_key) for index_key in index}
+        cached = cache.get_many(list(keys.values()))
+        changed, regenerate = {}, {}
+        for index_key, tbl in index.items():
+            entry = cached.get(keys[index_key])
+            modify_date = modified.get(index_key)
+            if entry is not None and modify_date is not None and entry.modify_date == modify_date:
+                tbl.pk = list(entry.pk)
+                tbl.cols = [Column(**col) for col in entry.cols]
+                tbl.sf_ddl = entry.sf_ddl
+                if entry.projection != [col.name for col in tbl.selected_cols()]:
+                    regenerate[index_key] = (keys[index_key], modify_date)
+            else:
+                changed[index_key] = (keys[index_key], modify_date)
+        logger.info(
+            f"{len(keys) - len(changed)} tables unchanged since their metadata was cached,"
+            f" querying the metadata of {len(changed)}"
+        )
+        regenerate.update(changed)
+        return self._subset(set(changed)), self._subset(set(regenerate)), regenerate
+
+    def set_tables_metadata(self, conn: "pymssql.Connection", cache=None) -> None:
+        """
+        Enriches this TableRules instance with Primary Key, Column and size metadata for each table
+
+        Requires a pymssql.Connection handle
+        cache: an optional metadata_cache.MetadataCache, only the tables whose definition
+            changed since they were cached are queried for their primary key and columns,
+            and only those and the tables whose selected columns changed have their DDL
+            generated again. Sizes are always queried.
+        """
+        with closing(conn.cursor()) as cur:
+            changed, regenerate, to_cache = self, self, {}
+            if cache is not None:
+                changed, regenerate, to_cache = self._apply_cache(cur, cache)
+            if changed.databases:
+                changed._set_primary_keys(cur)
+                changed._set_cols(cur)
+            self._set_stats(cur)
+            self._check_metadata()
+            regenerate._set_sf_ddl()
+        if cache is not None:
+            index = self._table_index()
+            fetched = {}
+            for index_key, (key, modify_date) in to_cache.items():
+                tbl = index[index_key]
+                # tables that were not found are left out, to be queried again next time
+                if modify_date is not None and tbl.cols:
+                    fetched[key] = CachedTable(
+                        modify_date,
+                        list(tbl.pk),
+                        [asdict(col) for col in tbl.cols],
+                        tbl.sf_ddl,
+                        [col.name for col in tbl.selected_cols()],
+                    )
+            cache.put_many(fetched)
+
+    def output_ddl(self, f: Path) -> None:
+        """ One create table per Snowflake table, tables that several servers load into are written once """
+        written = {}
+        with open(f, "w") as f:
+            for db, sch, tbl in self._all_tables():
+                if not tbl.sf_ddl:
+                    raise ValueError("The Snowflake DDL has not been set")
+                name = tbl.name.upper()
+                if name in written:
+                    if written[name] != tbl.sf_ddl:
+                        logger.warning(
+                            f"{qualified_name(db, sch, tbl)} differs from the other tables loaded into"
+                            f" {tbl.name}, only the DDL of the first one is written"
+                        )
+                    continue
+                written[name] = tbl.sf_ddl
+                f.write(tbl.sf_ddl + "\n\n")
+
+    def output_rules(self, f: Path) -> None:
+        from . import catalog
+
+        if catalog.is_catalog(f):
+            catalog.save_rules(self, f)
+            return
+        with open(f, "w") as f:
+            d = asdict(self)
+            logger.debug(d)
+            doc = json.dump(d, f, indent=2)
+
+    @staticmethod
+    def _select_expr(col: Column, lob_max_bytes: int = 0) -> str:
+        """
+        The select list entry of a column, converted by SQL Server when it has
+        one of the SELECT_EXPRESSIONS, and truncated to lob_max_bytes if it is a
+        large object column
+        """
+        name = "[" + col.name + "]"
+        if lob_max_bytes > 0 and col.is_lob() and col.data_type in LOB_TRUNCATE_EXPRESSIONS:
+            return LOB_TRUNCATE_EXPRESSIONS[col.data_type].format(name, n=int(lob_max_bytes)) + " as " + name
+        if col.data_type in SELECT_EXPRESSIONS:
+            return SELECT_EXPRESSIONS[col.data_type].format(name) + " as " + name
+        return name
+
+    @staticmethod
+    def _rule_where(tbl: Table, escape: bool = False) -> List[str]:
+        """
+        The where rule of a table as a list of predicates, with any % doubled
+        when escape is set, for a query that pymssql interpolates parameters into
+        """
+        if not tbl.where:
+            return []
+        rule = f"({tbl.where})"
+        return [rule.replace("%", "%%") if escape else rule]
+
+    def table_sql(
+        self,
+        db: Database,
+        sch: Schema,
+        tbl: Table,
+        where: List[str] = (),
+        escape: bool = False,
+        lob_max_bytes: int = 0,
+    ) -> str:
+        """
+        Return the extraction query for the selected columns of a single table,
+        limited by its where rule and optionally filtered by a list of predicates
+        that are and-ed together. Large objects are truncated to the table's
+        lob_max_bytes, or to lob_max_bytes if it has none.
+        escape doubles any % in the names and the rule, for a query run with parameters
+        """
+        limit = tbl.lob_max_bytes or lob_max_bytes
+        qry = f"""select {",".join(self._select_expr(col, limit) for col in tbl.selected_cols())} from [{db.name}].[{sch.name}].[{tbl.name}]"""
+        if escape:
+            qry = qry.replace("%", "%%")
+        where = self._rule_where(tbl, escape) + list(where)
+        if where:
+            qry += " where " + " and ".join(where)
+        return qry
+
+    def watermark_sql(self, db: Database, sch: Schema, tbl: Table) -> str:
+        """
+        Return a query for the current maximum of a table's watermark column
+        """
+        return f"select max([{tbl.watermark}]) from [{db.name}].[{sch.name}].[{tbl.name}]"
+
+    def _watermark_where(
+        self, tbl: Table, mark: Union[Watermark, None]
+    ) -> Tuple[List[str], List]:
+        where, params = [], []
+        if mark is None or not tbl.watermark:
+            return where, params
+        if mark.low is not None:
+            where.append(f"[{tbl.watermark}] > %s")
+            params.append(mark.low)
+        if mark.high is not None:
+            where.append(f"[{tbl.watermark}] <= %s")
+            params.append(mark.high)
+        return where, params
+
+    def _chunk_where(
+        self, tbl: Table, chunk: Chunk, mark: Union[Watermark, None] = None
+    ) -> Tuple[List[str], List]:
+        where, params = self._watermark_where(tbl, mark)
+        col = tbl.split_col()
+        if col is not None and chunk.lower is not None:
+            where.append(f"[{col.name}] >= %s")
+            params.append(chunk.lower)
+        if col is not None and chunk.upper is not None:
+            where.append(f"[{col.name}] < %s")
+            params.append(chunk.upper)
+        return where, params
+
+    def chunk_sql(
+        self,
+        db: Database,
+        sch: Schema,
+        tbl: Table,
+        chunk: Chunk,
+        mark: Union[Watermark, None] = None,
+        lob_max_bytes: int = 0,
+    ) -> Tuple[str, tuple]:
+        """
+        Return the extraction query and its parameters for one pk range of a table,
+        limited to the watermark range for incremental loads
+        """
+        where, params = self._chunk_where(tbl, chunk, mark)
+        # pymssql interpolates parameters with %, so escape any in the names
+        qry = self.table_sql(db, sch, tbl, where, escape=bool(params), lob_max_bytes=lob_max_bytes)
+        return qry, tuple(params)
+
+    def checksum_sql(
+        self, db: Database, sch: Schema, tbl: Table, chunk: Chunk
+    ) -> Tuple[str, tuple]:
+        """
+        Return a query and its parameters for the row count of one pk range of
+        a table, and an order independent checksum of its rows: the sum of the
+        first 4 bytes of the MD5 of every row, taken over the UTF-8 text of its
+        checksum_cols so that Snowflake can compute the same. Needs SQL Server 2019
+        for the UTF-8 collation.
+        """
+        cols = checksum_cols(tbl)
+        checksum = "null"
+        if cols:
+            row = " + nchar(31) + ".join(
+                f"isnull({CHECKSUM_EXPRESSIONS[col.data_type].format('[' + col.name + ']')}, N'\\N')"
+                for col in cols
+            )
+            checksum = (
+                "sum(convert(decimal(38, 0), convert(bigint, convert(binary(4), hashbytes('MD5',"
+                f" convert(varchar(max), ({row}) collate Latin1_General_100_BIN2_UTF8))))))"
+            )
+        qry = f"select count_big(*), {checksum} from [{db.name}].[{sch.name}].[{tbl.name}]"
+        where, params = self._chunk_where(tbl, chunk)
+        if params:
+            # pymssql interpolates parameters with %, so escape any in the names
+            qry = qry.replace("%", "%%")
+        where = self._rule_where(tbl, bool(params)) + where
+        if where:
+            qry += " where " + " and ".join(where)
+        logger.debug(qry)
+        return qry, tuple(params)
+
+    def chunk_boundaries_sql(
+        self,
+        db: Database,
+        sch: Schema,
+        tbl: Table,
+        mark: Union[Watermark, None] = None,
+    ) -> Tuple[str, tuple]:
+        """
+        Return a query and its parameters that find the pk value at every
+        row_split_size-th row, computed on the server from the primary key index
+        and limited to the watermark range for incremental loads.
+        Empty string if the table cannot be split.
+        """
+        col = tbl.split_col()
+        if col is None:
+            return "", ()
+        where, params = self._watermark_where(tbl, mark)
+        where = self._rule_where(tbl, bool(params)) + where
+        qry = f"""
+            select [{col.name}]
+            from (
+                select
+                    [{col.name}]
+                    , row_number() over (order by [{col.name}]) as rn
+                from [{db.name}].[{sch.name}].[{tbl.name}]/*where*/
+            ) as keys
+            where rn % {int(tbl.row_split_size)} = 1
+                and rn > 1
+            order by [{col.name}]
+            """
+        qry = dedent(qry)
+        if params:
+            # pymssql interpolates parameters with %, so escape the rest of the query
+            qry = qry.replace("%", "%%")
+        qry = qry.replace("/*where*/", " where " + " and ".join(where) if where else "")
+        logger.debug(qry)
+        return qry, tuple(params)
+
+    def get_basic_sql(self) -> Generator[Tuple, None, None]:
+        for db, sch, tbl in self._all_tables():
+            yield db, sch, tbl, self.table_sql(db, sch, tbl)
+
+
+def new_table_rules_from_config(infile: str) -> TableRules:
+    """
+    Constructs a TableRules object stub from a table_config.yml file
+    The infile expects a specific format.
+    """
+    import yaml
+
+    with open(infile, "r") as stream:
+        try:
+            table_config = yaml.safe_load(stream)
+        except yaml.YAMLError as e:
+            print(e)
+            sys.exit(1)
+        rules = TableRules(table_config.get("databases"))
+        logger.debug(rules)
+        return rules
+
+
+def new_table_rules(infile: str, tables: Union[List[str], None] = None) -> TableRules:
+    """
+    Constructs a TableRules object stub from a table_rules.json file, or from a
+    rules catalog for a file ending in .sqlite or .db, see flakenews.catalog
+    The infile expects a specific format.
+    tables: shell patterns of the db.schema.table names to keep, default all
+    """
+    from . import catalog
+
+    if catalog.is_catalog(infile):
+        rules = catalog.load_rules(infile, tables)
+        logger.info(f"Loaded {sum(1 for _ in rules._all_tables())} tables from the catalog {infile}")
+        return rules
+    with open(infile, "r") as stream:
+        try:
+            table_config = json.load(stream)
+        except json.JSONDecodeError as e:
+            print(e)
+            sys.exit(1)
+        rules = TableRules(catalog.filter_databases(table_config.get("databases"), tables))
+        logger.debug(rules)
+        return rules
+
+
+def qualified_name(db: Database, sch: Schema, tbl: Table) -> str:
+    """ The db.schema.table name of a table, prefixed by the server profile of its database if any """
+    name = f"{db.name}.{sch.name}.{tbl.name}"
+    return f"{db.server}.{name}" if db.server else name
+
+
+def with_hints(qry: str, hints: List[str] = ()) -> str:
+    """ Add an OPTION clause of query hints, e.g. maxdop 1, to the end of a query """
+    if not hints:
+        return qry
+    return qry + " option (" + ", ".join(hints) + ")"
+
+
+def _estimate_row_bytes(tbl: Table, lob_max_bytes: int = 0) -> int:
+    """ Bytes of one fetched row going by the column types, before any batch has been measured """
+    cols = tbl.selected_cols()
+    size = 56 + 8 * len(cols)  # the row tuple
+    for col in cols:
+        if col.data_type in TYPE_BYTES:
+            size += TYPE_BYTES[col.data_type]
+            continue
+        if col.is_lob():
+            length = tbl.lob_max_bytes or lob_max_bytes or LOB_LENGTH_GUESS
+            # binaries come back as hex, twice their size
+            if col.data_type in ("varbinary", "image"):
+                length *= 2
+            size += VAR_BYTES_OVERHEAD + length
+            continue
+        length = col.character_maximum_length
+        if length is None or length < 0 or length > MAX_LENGTH_GUESS:
+            length = MAX_LENGTH_GUESS
+        # assume the values fill half their declared length on average
+        size += VAR_BYTES_OVERHEAD + length // 2
+    return size
+
+
+class BatchSizer:
+    """
+    Picks the number of rows to fetch per batch of a table so that a batch
+    stays within max_bytes. It starts from an estimate from the column types,
+    then follows the measured size of the batches that were fetched.
+    Never more than the table's row_split_size or max_rows, nor fewer than
+    MIN_BATCH_ROWS, or MIN_LOB_BATCH_ROWS for a table with large object columns.
+    """
+
+    def __init__(
+        self,
+        tbl: Table,
+        max_bytes: int = MAX_BATCH_MB * 1024 * 1024,
+        max_rows: int = 0,
+        lob_max_bytes: int = 0,
+    ):
+        self.max_bytes = max_bytes
+        self.max_rows = max(min(tbl.row_split_size or BATCH_SIZE, max_rows or BATCH_SIZE), 1)
+        self.min_rows = MIN_LOB_BATCH_ROWS if tbl.lob_cols() else MIN_BATCH_ROWS
+        self.row_bytes = _estimate_row_bytes(tbl, lob_max_bytes)
+        self.measured = False
+        self.rows = self._rows()
+        logger.debug(f"{tbl.name}: batches of {self.rows} rows, about {self.row_bytes} bytes a row")
+
+    def _rows(self) -> int:
+        rows = self.max_bytes // max(self.row_bytes, 1)
+        return int(min(max(rows, self.min_rows), self.max_rows))
+
+    def observe(self, batch: List[Tuple], table: Union["pa.Table", None] = None) -> None:
+        """ Measure a fetched batch and the Arrow table built from it if any, and resize the next batches """
+        if not batch:
+            return
+        # sizing the Python objects of every value would cost as much as
+        # building the batch, so measure a sample of rows
+        step = max(len(batch) // 100, 1)
+        sample = batch[::step]
+        python_bytes = sum(
+            sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row if v is not None)
+            for row in sample
+        ) / len(sample)
+        row_bytes = python_bytes
+        if table is not None and table.num_rows:
+            row_bytes += table.nbytes / table.num_rows
+        # jump straight to the first measurement, then smooth out the swings between batches
+        self.row_bytes = row_bytes if not self.measured else (self.row_bytes + row_bytes) / 2
+        self.measured = True
+        self.rows = self._rows()
+
+
+def checksum_cols(tbl: Table) -> List[Column]:
+    """
+    The columns of a table that go into the --verify checksums. Large objects are
+    left out, hashing them would read every blob on both sides and they may have
+    been truncated by a lob_max_bytes
+    """
+    return [
+        col for col in tbl.selected_cols()
+        if col.data_type in CHECKSUM_EXPRESSIONS and not col.is_lob()
+    ]
@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+
+import heapq
+import logging
+import itertools
+import threading
+import tracemalloc
+from time import perf_counter, sleep
+from pathlib import Path
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from collections import Counter
+from typing import Generator, Iterable, List, Union
+from . import mssql
+from . import snowflake as sf
+from . import metrics
+from .pipeline import prefetch
+# print_plan used to live here, and is still imported from here
+from .plan import size_key, print_plan
+from .spill import spilled
+from .throttle import RateLimiter, SourceLimits, holding, source_slot
+from .parquet import TARGET_FILE_MB
+from .stage import new_stage
+from .state import WatermarkState, STATE_FILE
+from .manifest import RunManifest, TablePlan, MANIFEST_FILE, DONE
+from .mssql import TableRules, Database, Schema, Table, Chunk, Watermark
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait before retrying a failed chunk, multiplied by the attempt number
+RETRY_DELAY = 5
+
+# steps of a table load
+PLAN = "plan"
+LOAD = "load"
+FINISH = "finish"
+
+
+@dataclass()
+class RunConfig:
+    """
+    Options for a load run
+    workers: number of tables or chunks to load concurrently
+    retries: times to retry a failed chunk before failing its table
+    queue_depth: batches fetched ahead of the upload per chunk, 0 to fetch and upload in turn
+    max_batch_mb: memory budget of a fetched batch, 0 for fixed batches of mssql.BATCH_SIZE rows
+    stage: empty to append batches with write_pandas,
+        internal or s3 to stage Parquet files and load each table with one COPY INTO.
+        Tables with a csv extract_format or that merge always go through a stage, internal by default
+    compression: Parquet codec for staged files, CSV files take gzip in place of snappy
+    file_mb: target size of staged files
+    state_file: where the high-watermarks of incremental tables are kept
+    manifest_file: where the progress of the run is recorded
+    resume: carry on from the run recorded in the manifest instead of starting over
+    metrics_file: JSON lines of per-stage timings and counters, or a Prometheus textfile if it ends in .prom
+    profile_dir: if set, cProfile and tracemalloc output for every chunk is written here
+    isolation: transaction isolation level of the source queries, one of mssql.ISOLATION_LEVELS,
+        empty for read committed. Tables can set their own
+    query_hints: OPTION hints of the source queries, e.g. ["maxdop 1"], unless a table sets its own
+    max_source_queries: extraction queries running on each source server at once, 0 for one per worker
+    max_rows_per_sec, max_mb_per_sec: limits on how fast the run fetches from each server, 0 for no limit
+    mode: append, or merge to upsert every table on its pk through a transient staging table,
+        unless a table sets its own load_mode. merge tables always go through a stage
+    spill_dir: if set, batches are written to Arrow files here as fast as the source serves them,
+        and loaded from there memory mapped, so a slow load never holds up the source query.
+        In place of queue_depth, for all but csv tables
+    lob_max_bytes: truncate large object values to this many bytes on the source, 0 to load them whole.
+        Tables can set their own
+    """
+
+    workers: int = 1
+    retries: int = 2
+    queue_depth: int = 2
+    max_batch_mb: int = mssql.MAX_BATCH_MB
+    stage: str = ""
+    compression: str = "snappy"
+    file_mb: int = TARGET_FILE_MB
+    state_file: str = STATE_FILE
+    manifest_file: str = MANIFEST_FILE
+    resume: bool = False
+    metrics_file: str = ""
+    profile_dir: str = ""
+    isolation: str = ""
+    query_hints: List[str] = field(default_factory=list)
+    max_source_queries: int = 0
+    max_rows_per_sec: int = 0
+    max_mb_per_sec: float = 0.0
+    mode: str = mssql.APPEND
+    lob_max_bytes: int = 0
+    spill_dir: str = ""
+
+
+class ChunkError(Exception):
+    """ A chunk that failed for good, with the number of rows it had written by then """
+
+    def __init__(self, cause: Exception, rows: int = 0):
+        super().__init__(f"{type(cause).__name__}: {cause}")
+        self.rows = rows
+
+
+@dataclass()
+class TableResult:
+    """ Outcome of loading a single table, used for the end of run summary """
+
+    name: str
+    success: bool = False
+    rows: int = 0
+    seconds: float = 0.0
+    chunks: int = 0
+    failed_chunks: int = 0
+    resumed: int = 0
+    error: str = ""
+
+
+@dataclass()
+class TableJob:
+    """
+    A table to load, the pk range chunks it has been split into,
+    and the watermark range for an incremental load
+    """
+
+    db: Database
+    sch: Schema
+    tbl: Table
+    chunks: List[Chunk] = field(default_factory=list)
+    mark: Union[Watermark, None] = None
+    remaining: int = 0
+    start: float = 0.0
+    result: TableResult = None
+    limiter: RateLimiter = None
+
+    def __post_init__(self):
+        self.result = TableResult(name=self.key)
+        self.limiter = RateLimiter(self.tbl.max_rows_per_sec, self.tbl.max_mb_per_sec)
+
+    @property
+    def key(self) -> str:
+        return mssql.qualified_name(self.db, self.sch, self.tbl)
+
+
+class WorkerConnections:
+    """
+    Gives each worker thread its own Snowflake connection, and one MSSQL connection
+    per server profile it extracts from.
+    Connections are opened on first use by a thread and reused for every
+    table that thread loads; close() shuts them all down at the end of the run.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = []
+
+    def _get(self, attr: str, factory):
+        conn = getattr(self._local, attr, None)
+        if conn is None:
+            conn = factory()
+            setattr(self._local, attr, conn)
+            with self._lock:
+                self._opened.append(conn)
+        return conn
+
+    def ms_conn(self, server: str = ""):
+        return self._get(f"ms_conn.{server}", lambda: mssql.new_conn(server=server))
+
+    def sf_conn(self):
+        return self._get("sf_conn", sf.new_conn)
+
+    def _close(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception as e:
+            logger.warning(f"Error closing connection: {e}")
+
+    def discard(self) -> None:
+        """
+        Drop this thread's connections after a failure, a cursor that died
+        mid-query can leave the connection unusable for the next table
+        """
+        for attr in list(vars(self._local)):
+            conn = getattr(self._local, attr, None)
+            if conn is not None:
+                setattr(self._local, attr, None)
+                with self._lock:
+                    self._opened.remove(conn)
+                self._close(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for conn in opened:
+            self._close(conn)
+
+
+def _merges(job: TableJob, config: RunConfig) -> bool:
+    return (job.tbl.load_mode or config.mode) == mssql.MERGE
+
+
+def _source_conn(job: TableJob, conns: WorkerConnections, config: RunConfig):
+    """ This thread's MSSQL connection in a new transaction at the table's isolation level """
+    conn = conns.ms_conn(job.db.server)
+    mssql.set_isolation(conn, job.tbl.isolation or config.isolation)
+    return conn
+
+
+def _end_read(items: Iterable, conn) -> Generator:
+    """ Commit the source transaction once `items` is exhausted, giving back its locks and row versions """
+    yield from items
+    conn.commit()
+
+
+def plan_table(
+    rules: TableRules,
+    job: TableJob,
+    conns: WorkerConnections,
+    state: WatermarkState,
+    config: RunConfig = None,
+    limits: SourceLimits = None,
+) -> List[Chunk]:
+    """
+    Split a table into pk range chunks on the source server.
+    For an incremental table the watermark range is fixed first,
+    and there are no chunks at all when no new rows have arrived.
+    """
+    config = config or RunConfig()
+    if _merges(job, config) and not job.tbl.pk:
+        raise ValueError("merge needs a primary key, set a pk for the table or load it with append")
+    slots = limits.slots if limits is not None else None
+    try:
+        with metrics.labelled(table=job.key), source_slot(slots), metrics.timer("plan"), closing(
+            _source_conn(job, conns, config).cursor()
+        ) as cur:
+            if job.tbl.watermark:
+                job.mark = mssql.get_watermark(
+                    cur, rules, job.db, job.sch, job.tbl, state.get(job.key)
+                )
+                if not job.mark.has_rows():
+                    return []
+            hints = job.tbl.query_hints or config.query_hints
+            return mssql.get_chunks(cur, rules, job.db, job.sch, job.tbl, job.mark, hints)
+    except Exception:
+        conns.discard()
+        raise
+
+
+def _can_clear(job: TableJob, chunk: Chunk, stage=None) -> bool:
+    """ Whether whatever a chunk wrote can be removed again before reloading it """
+    if stage is not None or job.mark is not None:
+        return True
+    return chunk.is_bounded() and job.tbl.split_col() is not None
+
+
+def _clear_chunk(
+    job: TableJob, chunk: Chunk, conns: WorkerConnections, stage=None
+) -> None:
+    if stage is not None:
+        stage.clear(job.key, job.tbl, chunk, conns.sf_conn())
+    else:
+        sf.delete_chunk(job.tbl, chunk, conns.sf_conn(), job.mark)
+
+
+def load_chunk(
+    rules: TableRules,
+    job: TableJob,
+    chunk: Chunk,
+    conns: WorkerConnections,
+    config: RunConfig,
+    stage=None,
+    dirty: bool = False,
+    limits: SourceLimits = None,
+) -> int:
+    """
+    Extract one chunk of a table from MSSQL and write it to Snowflake,
+    returns the number of rows extracted.
+
+    Without a stage every batch is appended with write_pandas. With a stage
+    the batches are written to Parquet files, or streamed to CSV files for
+    tables with a csv extract_format, and uploaded to the stage,
+    to be loaded later by finish_table.
+
+    Batches are fetched on a separate thread up to queue_depth ahead of the
+    upload, so the source and Snowflake are busy at the same time, or with a
+    spill_dir as far ahead as they come, spilled to disk.
+    The source query runs at the table's isolation level with its query hints,
+    holds one of the source query slots of `limits` until it has been fetched,
+    and is fetched no faster than the rate limits of the table and the run allow.
+    A failed chunk is retried up to `retries` times on fresh connections.
+    Whatever it already wrote is cleared first: its staged files, or its pk
+    or watermark range on Snowflake. A table with neither can only be retried
+    without a stage if nothing was written.
+    `dirty` marks a chunk that an earlier run started but did not finish.
+    """
+    qry, params = rules.chunk_sql(job.db, job.sch, job.tbl, chunk, job.mark, config.lob_max_bytes)
+    lob_max_bytes = job.tbl.lob_max_bytes or config.lob_max_bytes
+    spill = bool(config.spill_dir) and job.tbl.extract_format != mssql.CSV
+    qry = mssql.with_hints(qry, job.tbl.query_hints or config.query_hints)
+    limits = limits or SourceLimits()
+    limiters = (job.limiter, limits.limiter)
+    if dirty:
+        if not _can_clear(job, chunk, stage):
+            raise RuntimeError(
+                "Partially loaded in an earlier run and has no pk or watermark range"
+                " to clear, truncate it on Snowflake and load it without --resume"
+            )
+        _clear_chunk(job, chunk, conns, stage)
+
+    attempt = 0
+    while True:
+        rows = 0
+        try:
+            conn = _source_conn(job, conns, config)
+            with metrics.labelled(table=job.key, chunk=chunk.index), metrics.profiled(
+                f"{job.key}.{chunk.index:05d}", config.profile_dir or None
+            ), closing(conn.cursor()) as cur:
+                sink = stage.sink(job.key, job.tbl, chunk) if stage is not None else None
+                if sink is not None and job.tbl.extract_format == mssql.CSV:
+                    source = mssql.query_to_csv(
+                        cur, job.tbl, qry, sink, params, limiters, config.max_batch_mb, lob_max_bytes
+                    )
+                elif spill:
+                    # converted to DataFrames or Parquet as they are loaded, see below
+                    source = mssql.query_to_arrow(
+                        cur, job.tbl, qry, params, config.max_batch_mb, limiters, lob_max_bytes
+                    )
+                elif sink is None:
+                    source = mssql.query_to_pandas(
+                        cur, job.tbl, qry, params, config.max_batch_mb, limiters, lob_max_bytes
+                    )
+                else:
+                    source = mssql.query_to_parquet(
+                        cur, job.tbl, qry, sink, params, config.max_batch_mb, limiters, lob_max_bytes
+                    )
+                source = _end_read(holding(source, limits.slots), conn)
+
+                if spill:
+                    tables = spilled(source, config.spill_dir, f"{job.key}.{chunk.index:05d}")
+                    if sink is None:
+                        items = (mssql.table_to_pandas(table) for table in tables)
+                    else:
+                        items = mssql.arrow_to_parquet(tables, sink)
+                else:
+                    tables = items = prefetch(source, config.queue_depth)
+
+                with closing(tables), closing(items):
+                    for item in items:
+                        if stage is None:
+                            if not sf.write_df(item, job.tbl, conns.sf_conn()):
+                                raise RuntimeError(f"write_pandas failed for {job.tbl.name}")
+                            rows += len(item)
+                        else:
+                            stage.upload(job.key, job.tbl, chunk, item, conns.sf_conn())
+                            rows += item.rows
+            return rows
+        except Exception as e:
+            conns.discard()
+            attempt += 1
+            if attempt > config.retries or (rows and not _can_clear(job, chunk, stage)):
+                raise ChunkError(e, rows) from e
+            logger.exception(
+                f"Chunk {chunk.index} of {job.result.name} failed, retry {attempt} of {config.retries}"
+            )
+            sleep(RETRY_DELAY * attempt)
+            if rows:
+                _clear_chunk(job, chunk, conns, stage)
+
+
+def merge_table(job: TableJob, conn, stage) -> int:
+    """
+    Copy the staged files of a table into a transient staging table and merge
+    that into the table on its pk, returns the rows inserted or updated
+    """
+    staging = sf.staging_name(job.key, job.tbl)
+    sf.create_staging(job.tbl, staging, conn)
+    try:
+        staged = stage.copy_into(job.key, job.tbl, conn, staging)
+        logger.info(f"Copied {staged} rows into {staging} from {job.result.name}")
+        return sf.merge(job.tbl, staging, conn)
+    finally:
+        sf.drop_table(staging, conn)
+
+
+def finish_table(job: TableJob, conns: WorkerConnections, stage=None, merge: bool = False) -> int:
+    """
+    Once every chunk of a table has been staged, load them all with a single
+    COPY INTO, or merge them on the pk, and clean up the staged files.
+    Returns the rows loaded.
+    """
+    try:
+        with metrics.labelled(table=job.key):
+            if merge:
+                rows = merge_table(job, conns.sf_conn(), stage)
+            else:
+                rows = stage.copy_into(job.key, job.tbl, conns.sf_conn())
+        logger.info(f"{'Merged' if merge else 'Copied'} {rows} rows into {job.tbl.name} from {job.result.name}")
+        with metrics.labelled(table=job.key), metrics.timer("cleanup"):
+            stage.cleanup(job.key, job.tbl, conns.sf_conn())
+        return rows
+    except Exception:
+        conns.discard()
+        raise
+
+
+def _fail(job: TableJob, e: Exception) -> None:
+    if not job.result.error:
+        job.result.error = str(e) if isinstance(e, ChunkError) else f"{type(e).__name__}: {e}"
+
+
+def run_to_snowflake(
+    rules: TableRules, config: RunConfig = None
+) -> List[TableResult]:
+    """
+    Load every table in the rules, spread over a pool of worker threads.
+    Tables are first split into pk range chunks, then every chunk is loaded
+    as its own task so that huge tables are extracted in parallel.
+    With a stage, each table is finished by one COPY INTO over all its files,
+    or by a MERGE on its pk from a transient staging table in merge mode.
+
+    Tasks wait in a queue ordered by table size and are handed to the pool
+    only as workers free up, so the largest tables start first instead of
+    leaving a long single threaded tail at the end of the run.
+
+    Every source server has its own connections and source limits. Tables that
+    databases on several servers load into always go through a stage, so that
+    a failed chunk of one never clears the rows of another.
+
+    Progress is recorded in a run manifest. With resume, tables and chunks
+    that finished in the earlier run are skipped, and chunks it left half
+    done are cleared and loaded again.
+    Returns one TableResult per table in the order of the rules.
+    """
+    if config is None:
+        config = RunConfig()
+
+    jobs = [TableJob(db, sch, tbl) for db, sch, tbl in rules._all_tables()]
+    recorder = metrics.configure(config.metrics_file or None)
+    if config.profile_dir:
+        tracemalloc.start()
+    state = WatermarkState(config.state_file)
+    manifest = RunManifest(config.manifest_file, config.resume)
+    stage = None
+    conns = WorkerConnections()
+    limits = {
+        server: SourceLimits(config.max_source_queries, config.max_rows_per_sec, config.max_mb_per_sec)
+        for server in {job.db.server for job in jobs}
+    }
+    targets = Counter(job.tbl.name.upper() for job in jobs)
+    workers = max(config.workers, 1)
+    pending = {}
+    ready = []
+    order = itertools.count()
+
+    def _schedule(step: str, job: TableJob, chunk: Union[Chunk, None], fn, *args) -> None:
+        # finish tables as soon as possible, otherwise largest first, then in order
+        first = 0 if step == FINISH else 1
+        heapq.heappush(ready, (first, *size_key(job.tbl), next(order), step, job, chunk, fn, args))
+
+    def _submit_ready() -> None:
+        while ready and len(pending) < workers:
+            *_, step, job, chunk, fn, args = heapq.heappop(ready)
+            if not job.start:
+                job.start = perf_counter()
+            if step == LOAD:
+                manifest.chunk_started(job.key, chunk)
+            pending[pool.submit(fn, *args)] = (step, job, chunk)
+
+    def _complete(job: TableJob) -> None:
+        job.result.success = not job.result.error
+        if job.result.success:
+            if job.mark is not None and job.mark.has_rows():
+                state.set(job.key, job.mark.high)
+            manifest.table_done(job.key, job.result.rows)
+        job.result.seconds = perf_counter() - job.start if job.start else 0.0
+        metrics.record("table", job.result.seconds, job.result.rows, table=job.key)
+        logger.info(f"""{"Loaded" if job.result.success else "Failed"} {job.result.name}""")
+
+    def _needs_stage(job: TableJob) -> bool:
+        # csv and merge tables can only be loaded from a stage, and so can tables shared by servers
+        return (
+            bool(config.stage)
+            or job.tbl.extract_format == mssql.CSV
+            or _merges(job, config)
+            or targets[job.tbl.name.upper()] > 1
+        )
+
+    def _stage(job: TableJob):
+        return stage if _needs_stage(job) else None
+
+    def _stage_name(job: TableJob) -> str:
+        # recorded in the manifest, a table can only be resumed through the same stage
+        return (config.stage or "internal") if _needs_stage(job) else ""
+
+    def _chunks_finished(job: TableJob) -> None:
+        if _stage(job) is not None and not job.result.error:
+            _schedule(FINISH, job, None, finish_table, job, conns, stage, _merges(job, config))
+        else:
+            _complete(job)
+
+    def _queue_chunks(job: TableJob, chunks: List[Chunk], plan: TablePlan = None):
+        job.chunks = chunks
+        job.result.chunks = len(chunks)
+        todo = chunks
+        if plan is not None:
+            todo = [c for c in chunks if c.index not in plan.done]
+            job.result.rows += sum(plan.done.values())
+            job.result.resumed = len(chunks) - len(todo)
+        job.remaining = len(todo)
+        if not chunks:
+            logger.info(f"No new rows for {job.result.name}")
+        if not todo:
+            _chunks_finished(job)
+        for c in todo:
+            dirty = plan is not None and c.index in plan.started
+            _schedule(
+                LOAD, job, c, load_chunk, rules, job, c, conns, config, _stage(job), dirty,
+                limits[job.db.server],
+            )
+
+    try:
+        if config.spill_dir:
+            Path(config.spill_dir).mkdir(parents=True, exist_ok=True)
+        manifest.check_stage(config.stage)
+        if any(_needs_stage(job) for job in jobs):
+            stage = new_stage(
+                config.stage or "internal", manifest.run_id, config.compression, config.file_mb
+            )
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="flakenews") as pool:
+            for job in jobs:
+                plan = manifest.get_table(job.key) if config.resume else None
+                if plan is None:
+                    _schedule(
+                        PLAN, job, None, plan_table, rules, job, conns, state, config, limits[job.db.server]
+                    )
+                elif plan.status == DONE:
+                    logger.info(f"Skipping {job.result.name}, loaded in run {manifest.run_id}")
+                    job.result.rows = plan.rows
+                    job.result.chunks = job.result.resumed = len(plan.chunks)
+                    job.result.success = True
+                else:
+                    if plan.stage is not None and plan.stage != _stage_name(job):
+                        how = f"through stage '{plan.stage}'" if plan.stage else "without a stage"
+                        raise ValueError(
+                            f"{job.result.name} was started in run {manifest.run_id} {how},"
+                            " resume it with the same --stage and --mode"
+                        )
+                    job.mark = plan.mark
+                    _queue_chunks(job, plan.chunks, plan)
+            _submit_ready()
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step, job, chunk = pending.pop(future)
+                    error = future.exception()
+
+                    if step == PLAN:
+                        # planning finished, queue up the chunks
+                        if error is not None:
+                            logger.error(f"Failed to plan table {job.result.name}: {error}")
+                            _fail(job, error)
+                            _complete(job)
+                            continue
+                        manifest.plan_table(job.key, job.mark, future.result(), _stage_name(job))
+                        _queue_chunks(job, future.result())
+                        continue
+
+                    if step == FINISH:
+                        if error is not None:
+                            logger.error(f"Failed to copy {job.result.name}: {error}")
+                            _fail(job, error)
+                        _complete(job)
+                        continue
+
+                    job.remaining -= 1
+                    if error is not None:
+                        logger.error(
+                            f"Failed chunk {chunk.index} of {job.result.name}: {error}"
+                        )
+                        job.result.failed_chunks += 1
+                        _fail(job, error)
+                        if isinstance(error, ChunkError) and not error.rows:
+                            # nothing reached Snowflake, no need to clear it on resume
+                            manifest.chunk_pending(job.key, chunk)
+                    else:
+                        job.result.rows += future.result()
+                        manifest.chunk_done(job.key, chunk, future.result())
+
+                    if job.remaining == 0:
+                        _chunks_finished(job)
+                _submit_ready()
+    finally:
+        conns.close()
+        manifest.close()
+        recorder.close()
+        if config.profile_dir:
+            tracemalloc.stop()
+        if stage is not None:
+            stage.close()
+    return [job.result for job in jobs]
+
+
+def print_summary(results: List[TableResult]) -> None:
+    """
+    Per-table summary of which tables succeeded and which failed
+    """
+    width = max((len(r.name) for r in results), default=0)
+    print("\nTable load summary")
+    for r in results:
+        status = "OK" if r.success else "FAILED"
+        line = (
+            f"  {status:<6} {r.name:<{width}}  rows {r.rows:>12,}"
+            f"  chunks {r.chunks - r.failed_chunks:>5}/{r.chunks:<5}  {r.seconds:>9.1f}s"
+        )
+        if r.resumed:
+            line += f"  {r.resumed} chunks from an earlier run"
+        if r.error:
+            line += f"  {r.error}"
+        print(line)
+    failed = sum(1 for r in results if not r.success)
+    print(f"{len(results) - failed} succeeded, {failed} failed\n")
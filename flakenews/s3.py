@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+from os import getenv
+import logging
+import boto3
+from typing import Union
+from dataclasses import dataclass
+from .parquet import ParquetPart
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass()
+class S3Config:
+    """
+    S3 bucket used to stage files for Snowflake
+    stage: a Snowflake external stage pointing at the root of the bucket
+    endpoint_url: optional, e.g. http://localhost:4566 for the localstack container
+    """
+
+    bucket: str = ""
+    prefix: str = ""
+    endpoint_url: Union[str, None] = None
+    stage: str = ""
+
+    def __post_init__(self):
+        self.bucket = getenv("FN_S3_BUCKET")
+        self.prefix = getenv("FN_S3_PREFIX", "flakenews").strip("/")
+        self.endpoint_url = getenv("FN_S3_ENDPOINT_URL")
+        self.stage = getenv("FN_SF_S3_STAGE")
+
+
+def new_client(config: Union[S3Config, None] = None):
+    """
+    Creates a boto3 S3 client, credentials come from the usual AWS environment
+    """
+    if config is None:
+        config = S3Config()
+
+    return boto3.client("s3", endpoint_url=config.endpoint_url)
+
+
+def upload(client, part: ParquetPart, bucket: str, key: str) -> None:
+    """ Upload a finished file, either from local disk or from its in-memory buffer """
+    with metrics.timer("s3_upload") as uploaded:
+        if part.buffer is not None:
+            part.buffer.seek(0)
+            client.upload_fileobj(part.buffer, bucket, key)
+        else:
+            client.upload_file(str(part.path), bucket, key)
+        uploaded["rows"], uploaded["bytes"] = part.rows, part.size
+    logger.info(f"Uploaded s3://{bucket}/{key}")
+
+
+def delete_prefix(client, bucket: str, prefix: str) -> int:
+    """ Delete every object under a prefix, returns the number of objects deleted """
+    deleted = 0
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        if keys:
+            client.delete_objects(Bucket=bucket, Delete={"Objects": keys})
+            deleted += len(keys)
+    logger.info(f"Deleted {deleted} objects from s3://{bucket}/{prefix}")
+    return deleted
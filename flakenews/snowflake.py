@@ -2,16 +2,38 @@
 
 from os import getenv
 import logging
-from typing import Union
+from hashlib import md5
+from typing import List, Tuple, Union
+from pathlib import Path
+from contextlib import closing
 from dataclasses import dataclass, asdict
 import snowflake.connector as snowflake
 from snowflake.connector.network import DEFAULT_AUTHENTICATOR
 from snowflake.connector.pandas_tools import write_pandas
 import pandas as pd
-from .mssql import Table
+from .rules import Table, Chunk, Watermark, checksum_cols
+from . import metrics
 
 logger = logging.getLogger(__name__)
 
+# text of a column for the --verify checksums, the same as mssql.CHECKSUM_EXPRESSIONS
+# gives for the source value, keyed on the SQL Server type
+CHECKSUM_EXPRESSIONS = {
+    **{t: "to_varchar({})" for t in ("bigint", "int", "smallint", "tinyint", "decimal", "numeric")},
+    **{t: "{}" for t in ("varchar", "char", "nvarchar", "nchar", "text", "ntext")},
+    "money": "to_varchar({})",
+    "smallmoney": "to_varchar({})",
+    "bit": "iff({}, '1', '0')",
+    "uniqueidentifier": "{}",
+    "date": "to_varchar({}, 'YYYY-MM-DD')",
+    "time": "to_varchar({}, 'HH24:MI:SS')",
+    **{
+        t: "to_varchar(date_part(epoch_microsecond, {}))"
+        for t in ("datetime", "datetime2", "smalldatetime", "datetimeoffset")
+    },
+    **{t: "to_varchar({}, 'HEX')" for t in ("binary", "varbinary", "rowversion", "timestamp", "image")},
+}
+
 
 @dataclass()
 class SFConfig:
@@ -52,8 +74,190 @@ def write_df(
 ) -> bool:
     """ Thin wrapper over snowflake.write_pandas function """
     logger.info(f"Copying data to table {tbl.name} on Snowflake")
-    success, nchunks, nrows, output = write_pandas(conn, df, tbl.name.upper())
+    with metrics.timer("upload") as uploaded:
+        success, nchunks, nrows, output = write_pandas(conn, df, tbl.name.upper())
+        uploaded["rows"] = nrows
+        uploaded["bytes"] = int(df.memory_usage(index=False).sum())
     logger.info(
         f"""{"Succeeded" if success else "Failed"}: chunks {nchunks}, rows {nrows}, output {output}"""
     )
     return success
+
+
+def _chunk_where(tbl: Table, chunk: Chunk) -> Tuple[List[str], List]:
+    where, params = [], []
+    col = tbl.split_col()
+    if col is not None and chunk.lower is not None:
+        where.append(f"{col.caps_name()} >= %s")
+        params.append(chunk.lower)
+    if col is not None and chunk.upper is not None:
+        where.append(f"{col.caps_name()} < %s")
+        params.append(chunk.upper)
+    return where, params
+
+
+def delete_chunk(
+    tbl: Table,
+    chunk: Chunk,
+    conn: snowflake.SnowflakeConnection = None,
+    mark: Union[Watermark, None] = None,
+) -> int:
+    """
+    Remove the rows of a pk range, and of the watermark range for incremental
+    loads, from the Snowflake table, so that a partially loaded chunk can be
+    loaded again without duplicates
+    """
+    where, params = _chunk_where(tbl, chunk)
+    if tbl.watermark and mark is not None:
+        wm = tbl.watermark.replace(" ", "_").upper()
+        if mark.low is not None:
+            where.append(f"{wm} > %s")
+            params.append(mark.low)
+        if mark.high is not None:
+            where.append(f"{wm} <= %s")
+            params.append(mark.high)
+    if not where:
+        raise ValueError(f"Table {tbl.name} chunk {chunk.index} has no pk or watermark range")
+    qry = f"delete from {tbl.name.upper()} where " + " and ".join(where)
+    logger.info(f"Clearing chunk {chunk.index} of table {tbl.name} on Snowflake")
+    with closing(conn.cursor()) as cur:
+        cur.execute(qry, params)
+        return cur.rowcount
+
+
+def checksum_sql(tbl: Table, chunk: Chunk) -> Tuple[str, list]:
+    """
+    Return a query and its parameters for the row count and checksum of one
+    pk range of a loaded table, matching mssql.TableRules.checksum_sql
+    """
+    cols = checksum_cols(tbl)
+    checksum = "null"
+    if cols:
+        row = " || chr(31) || ".join(
+            f"coalesce({CHECKSUM_EXPRESSIONS[col.data_type].format(col.caps_name())}, '\\\\N')"
+            for col in cols
+        )
+        checksum = f"sum(to_number(upper(substr(md5({row}), 1, 8)), 'XXXXXXXX'))"
+    qry = f"select count(*), {checksum} from {tbl.name.upper()}"
+    where, params = _chunk_where(tbl, chunk)
+    if where:
+        qry += " where " + " and ".join(where)
+    logger.debug(qry)
+    return qry, params
+
+
+def get_checksum(
+    tbl: Table, chunk: Chunk, conn: snowflake.SnowflakeConnection = None
+) -> Tuple[int, int]:
+    """ The row count and checksum of one pk range of a loaded table """
+    qry, params = checksum_sql(tbl, chunk)
+    with closing(conn.cursor()) as cur:
+        cur.execute(qry, params or None)
+        rows, checksum = cur.fetchone()
+    return int(rows), int(checksum or 0)
+
+
+def put_file(
+    path: Path, location: str, conn: snowflake.SnowflakeConnection = None, parallel: int = 4
+) -> None:
+    """ Upload a local file to an internal stage location """
+    qry = (
+        f"put 'file://{Path(path).resolve().as_posix()}' '{location}'"
+        f" auto_compress = false overwrite = true parallel = {int(parallel)}"
+    )
+    logger.debug(qry)
+    with metrics.timer("put") as put, closing(conn.cursor()) as cur:
+        cur.execute(qry)
+        put["bytes"] = Path(path).stat().st_size
+
+
+def remove_files(location: str, conn: snowflake.SnowflakeConnection = None) -> None:
+    """ Remove every file under an internal stage location """
+    with closing(conn.cursor()) as cur:
+        cur.execute(f"remove '{location}'")
+    logger.info(f"Removed staged files from {location}")
+
+
+def copy_into(
+    tbl: Table,
+    location: str,
+    conn: snowflake.SnowflakeConnection = None,
+    file_format: str = "type = parquet",
+    table_name: str = "",
+) -> int:
+    """
+    Load every file under a stage location into the table, or into table_name
+    in its place, with a single COPY INTO, returns the number of rows loaded
+    """
+    table_name = table_name or tbl.name.upper()
+    qry = (
+        f"copy into {table_name} from '{location}'"
+        f" file_format = ({file_format})"
+    )
+    if "parquet" in file_format:
+        qry += " match_by_column_name = case_insensitive"
+    logger.info(f"Copying staged files from {location} into table {table_name} on Snowflake")
+    logger.debug(qry)
+    with metrics.timer("copy") as copied, closing(conn.cursor()) as cur:
+        cur.execute(qry)
+        names = [d[0].lower() for d in cur.description]
+        if "rows_loaded" not in names:
+            # nothing new was found at the location
+            return 0
+        idx = names.index("rows_loaded")
+        copied["rows"] = sum(row[idx] or 0 for row in cur.fetchall())
+        return copied["rows"]
+
+
+def staging_name(key: str, tbl: Table) -> str:
+    """ The transient table a source table's rows are merged from, unique per source table """
+    return f"{tbl.name.upper()}_FN_{md5(key.encode()).hexdigest()[:8].upper()}"
+
+
+def create_staging(tbl: Table, staging: str, conn: snowflake.SnowflakeConnection = None) -> None:
+    """ An empty transient table with the columns of the table, replacing any left by a failed run """
+    with closing(conn.cursor()) as cur:
+        cur.execute(f"create or replace transient table {staging} like {tbl.name.upper()}")
+
+
+def drop_table(name: str, conn: snowflake.SnowflakeConnection = None) -> None:
+    with closing(conn.cursor()) as cur:
+        cur.execute(f"drop table if exists {name}")
+
+
+def merge_sql(tbl: Table, staging: str) -> str:
+    """
+    A MERGE of the staged rows into the table on its pk. A row staged more than
+    once, e.g. by a retried chunk, is only merged once, the latest by watermark
+    """
+    cols = tbl.selected_cols()
+    by_name = {col.name.lower(): col for col in cols}
+    pk = [by_name[name.lower()].caps_name() for name in tbl.pk]
+    order = tbl.watermark.replace(" ", "_").upper() + " desc" if tbl.watermark else ", ".join(pk)
+    names = [col.caps_name() for col in cols]
+    qry = (
+        f"merge into {tbl.name.upper()} as t using ("
+        f" select * from {staging}"
+        f" qualify row_number() over (partition by {', '.join(pk)} order by {order}) = 1"
+        ") as s on " + " and ".join(f"t.{name} = s.{name}" for name in pk)
+    )
+    updates = [name for name in names if name not in pk]
+    if updates:
+        qry += " when matched then update set " + ", ".join(f"t.{name} = s.{name}" for name in updates)
+    qry += (
+        f" when not matched then insert ({', '.join(names)})"
+        f" values ({', '.join('s.' + name for name in names)})"
+    )
+    return qry
+
+
+def merge(tbl: Table, staging: str, conn: snowflake.SnowflakeConnection = None) -> int:
+    """ Upsert the rows of the staging table into the table, returns the rows inserted or updated """
+    qry = merge_sql(tbl, staging)
+    logger.debug(qry)
+    logger.info(f"Merging {staging} into table {tbl.name} on Snowflake")
+    with metrics.timer("merge") as merged, closing(conn.cursor()) as cur:
+        cur.execute(qry)
+        row = cur.fetchone() or ()
+        merged["rows"] = sum(n or 0 for n in row)
+        return merged["rows"]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Connections to SQL Server and the queries that need no pandas or pyarrow: table
+metadata, watermarks, chunk boundaries and checksums. Rules setup and verify only
+import this, extracting batches is left to mssql.py
+"""
+
+from os import getenv
+import pymssql
+import logging
+from contextlib import closing
+from dataclasses import dataclass, asdict, InitVar
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, List, Union
+from .rules import Chunk, Watermark, Table, Schema, Database, TableRules, with_hints
+
+logger = logging.getLogger(__name__)
+
+
+def _profile_env(name: str, profile: str) -> str:
+    """ The environment variable of a server profile, e.g. FN_SQL_SERVER_SHARD1 for shard1 """
+    return name + "_" + "".join(c if c.isalnum() else "_" for c in profile.upper())
+
+
+@dataclass()
+class MSConfig:
+    """
+    Connection to MSSQL
+    profile: a server named by the databases in table_config.yml, read from the
+        FN_SQL_*_<PROFILE> variables, user, password and port default to the FN_SQL_* ones
+    """
+
+    server: str = ""
+    user: str = ""
+    password: str = ""
+    port: int = 0
+    appname: str = ""
+    profile: InitVar[str] = ""
+
+    def __post_init__(self, profile: str):
+        def _env(name, default=None):
+            if profile:
+                value = getenv(_profile_env(name, profile))
+                if value is not None:
+                    return value
+            return getenv(name, default)
+
+        if profile and getenv(_profile_env("FN_SQL_SERVER", profile)) is None:
+            raise ValueError(
+                f"No {_profile_env('FN_SQL_SERVER', profile)} set for the server {profile}"
+            )
+        self.server = _env("FN_SQL_SERVER")
+        self.user = _env("FN_SQL_USER")
+        self.password = _env("FN_SQL_PASSWORD")
+        self.port = _env("FN_SQL_PORT", 1433)
+        self.appname = "flakenews"
+
+
+def new_conn(config: Union[MSConfig, None] = None, server: str = "") -> pymssql.Connection:
+    """
+    Creates a DBAPI connection object for MSSQL Server,
+    the server of a profile if no config is given
+    """
+    if config is None:
+        config = MSConfig(profile=server)
+
+    return pymssql.connect(**asdict(config))
+
+
+def set_servers_metadata(rules: TableRules, cache=None) -> None:
+    """
+    Set the metadata of the tables on every server of the rules, see
+    TableRules.set_tables_metadata, the servers queried in parallel
+    on a connection each
+    """
+
+    def _set(server: str, server_rules: TableRules) -> None:
+        with closing(new_conn(server=server)) as conn:
+            server_rules.set_tables_metadata(conn, cache)
+
+    servers = rules.by_server()
+    if len(servers) > 1:
+        logger.info(f"Setting up the rules of {len(servers)} servers: {', '.join(s or 'default' for s in servers)}")
+    with ThreadPoolExecutor(max_workers=max(len(servers), 1)) as pool:
+        futures = [pool.submit(_set, server, server_rules) for server, server_rules in servers.items()]
+        for future in futures:
+            future.result()
+
+
+def set_isolation(conn: pymssql.Connection, level: str = "") -> None:
+    """
+    Start a new transaction on the connection at an isolation level, read committed
+    for an empty level. pymssql always has a transaction open, and snapshot can only
+    be set before a transaction reads anything, so the current one is committed first.
+    """
+    conn.commit()
+    with closing(conn.cursor()) as cur:
+        cur.execute(f"set transaction isolation level {level or 'read committed'}")
+
+
+def get_watermark(
+    cur: pymssql.Cursor,
+    rules: TableRules,
+    db: Database,
+    sch: Schema,
+    tbl: Table,
+    low: object = None,
+) -> Watermark:
+    """
+    Fix the upper end of an incremental load at the current maximum of the
+    watermark column, so rows arriving during the load are left for the next one
+    """
+    cur.execute(rules.watermark_sql(db, sch, tbl))
+    high = cur.fetchone()[0]
+    logger.info(f"Watermark for {db.name}.{sch.name}.{tbl.name}: {low} to {high}")
+    return Watermark(low=low, high=high)
+
+
+def get_chunks(
+    cur: pymssql.Cursor,
+    rules: TableRules,
+    db: Database,
+    sch: Schema,
+    tbl: Table,
+    mark: Union[Watermark, None] = None,
+    hints: List[str] = (),
+) -> List[Chunk]:
+    """
+    Split a table into pk ranges of about row_split_size rows each.
+    Tables that cannot be split come back as a single unbounded chunk.
+    """
+    qry, params = rules.chunk_boundaries_sql(db, sch, tbl, mark)
+    if not qry:
+        return [Chunk()]
+    qry = with_hints(qry, hints)
+    cur.execute(qry, params or None)
+    bounds = [None] + [row[0] for row in cur] + [None]
+    chunks = [
+        Chunk(index=i, lower=lower, upper=upper)
+        for i, (lower, upper) in enumerate(zip(bounds, bounds[1:]))
+    ]
+    logger.info(f"Split {db.name}.{sch.name}.{tbl.name} into {len(chunks)} chunks")
+    return chunks
+
+
+def get_checksum(
+    cur: pymssql.Cursor, rules: TableRules, db: Database, sch: Schema, tbl: Table, chunk: Chunk
+) -> Tuple[int, int]:
+    """ The row count and checksum of one pk range of a table, see TableRules.checksum_sql """
+    qry, params = rules.checksum_sql(db, sch, tbl, chunk)
+    cur.execute(qry, params or None)
+    rows, checksum = cur.fetchone()
+    return int(rows), int(checksum or 0)
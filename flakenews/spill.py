@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import shutil
+import logging
+import tempfile
+import pyarrow as pa
+from pathlib import Path
+from contextlib import closing
+from typing import Generator, Iterable, Union
+from . import metrics
+from .pipeline import prefetch
+
+logger = logging.getLogger(__name__)
+
+# batches a load can fall behind the extraction by, only their paths are queued
+SPILL_QUEUE_DEPTH = 100000
+
+
+def _write(tables: Iterable[pa.Table], directory: Path) -> Generator[Path, None, None]:
+    for i, table in enumerate(tables):
+        path = directory / f"{i:05d}.arrow"
+        with metrics.timer("spill") as spilled:
+            with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            spilled["rows"], spilled["bytes"] = table.num_rows, table.nbytes
+        del table
+        yield path
+
+
+def read_spilled(path: Union[Path, str]) -> pa.Table:
+    """
+    A spilled batch memory mapped back, its buffers point into the file
+    instead of being read into memory, and stay valid once the file is closed
+    """
+    with pa.memory_map(str(path)) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def spilled(
+    tables: Iterable[pa.Table], spill_dir: Union[Path, str], name: str
+) -> Generator[pa.Table, None, None]:
+    """
+    Write `tables` to Arrow IPC files in a directory of their own under spill_dir
+    as fast as they come, on a separate thread, and yield them back memory mapped
+    in order. The extraction never waits for the load, so the source query finishes
+    and releases its session while a slow load catches up from disk.
+
+    Each file is removed once the next batch is asked for, and the directory with
+    anything left in it once the generator is exhausted or closed.
+    Use it with contextlib.closing.
+    """
+    directory = Path(tempfile.mkdtemp(prefix=f"{name}_", dir=str(spill_dir)))
+    try:
+        with closing(prefetch(_write(tables, directory), SPILL_QUEUE_DEPTH, "spill")) as paths:
+            for path in paths:
+                yield read_spilled(path)
+                try:
+                    path.unlink()
+                except OSError as e:
+                    # still mapped, on Windows
+                    logger.debug(f"Could not remove spilled batch {path}: {e}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
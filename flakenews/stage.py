@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import shutil
+import logging
+from pathlib import Path
+from tempfile import mkdtemp
+from . import snowflake as sf
+from typing import Union
+from .rules import Table, Chunk, CSV, STAGES
+from .parquet import ParquetSink, ParquetPart, TARGET_FILE_MB
+from .delimited import CsvSink, FILE_FORMAT as CSV_FILE_FORMAT, csv_compression
+
+logger = logging.getLogger(__name__)
+
+
+def new_sink(
+    key: str,
+    tbl: Table,
+    chunk: Chunk,
+    out_dir: Union[Path, None],
+    compression: str = "snappy",
+    file_mb: int = TARGET_FILE_MB,
+) -> Union[ParquetSink, CsvSink]:
+    """
+    The sink for the files of a chunk, in the table's extract_format.
+    CSV files take gzip in place of a Parquet only codec
+    """
+    name = f"{key}_{chunk.index:05d}"
+    if tbl.extract_format == CSV:
+        return CsvSink(
+            name,
+            [col.data_type for col in tbl.selected_cols()],
+            out_dir,
+            csv_compression(compression),
+            file_mb * 1024 * 1024,
+        )
+    return ParquetSink(name, out_dir, compression, file_mb * 1024 * 1024)
+
+
+def file_format(tbl: Table) -> str:
+    """ The Snowflake file format to COPY the staged files of a table with """
+    return CSV_FILE_FORMAT if tbl.extract_format == CSV else "type = parquet"
+
+
+class InternalStage:
+    """
+    Stages Parquet or CSV files on each table's Snowflake table stage (@%TABLE),
+    under a folder per run, source table and chunk.
+    Files are written to local_dir, uploaded with PUT and then deleted locally.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        local_dir: Path,
+        compression: str = "snappy",
+        file_mb: int = TARGET_FILE_MB,
+        parallel: int = 4,
+    ):
+        self.run_id = run_id
+        self.local_dir = Path(local_dir)
+        self.compression = compression
+        self.file_mb = file_mb
+        self.parallel = parallel
+
+    def location(self, key: str, tbl: Table, chunk: Chunk = None) -> str:
+        location = f"@%{tbl.name.upper()}/{self.run_id}/{key}/"
+        if chunk is not None:
+            location += f"chunk_{chunk.index:05d}/"
+        return location
+
+    def sink(self, key: str, tbl: Table, chunk: Chunk) -> Union[ParquetSink, CsvSink]:
+        return new_sink(
+            key, tbl, chunk, self.local_dir / key, self.compression, self.file_mb
+        )
+
+    def upload(self, key: str, tbl: Table, chunk: Chunk, part: ParquetPart, conn) -> None:
+        sf.put_file(part.path, self.location(key, tbl, chunk), conn, self.parallel)
+        part.path.unlink()
+
+    def clear(self, key: str, tbl: Table, chunk: Chunk, conn) -> None:
+        """ Remove the files of a failed chunk so that it can be staged again """
+        sf.remove_files(self.location(key, tbl, chunk), conn)
+
+    def copy_into(self, key: str, tbl: Table, conn, table_name: str = "") -> int:
+        return sf.copy_into(tbl, self.location(key, tbl), conn, file_format(tbl), table_name)
+
+    def cleanup(self, key: str, tbl: Table, conn) -> None:
+        sf.remove_files(self.location(key, tbl), conn)
+
+    def close(self) -> None:
+        shutil.rmtree(self.local_dir, ignore_errors=True)
+
+
+class S3Stage:
+    """
+    Stages Parquet or CSV files in an S3 bucket under a folder per run, source table and chunk,
+    loaded through a Snowflake external stage on that bucket.
+    Files are built in memory and uploaded without touching local disk.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        compression: str = "snappy",
+        file_mb: int = TARGET_FILE_MB,
+        config=None,
+    ):
+        from . import s3
+
+        self._s3 = s3
+        self.config = config if config is not None else s3.S3Config()
+        if not self.config.bucket or not self.config.stage:
+            raise ValueError("FN_S3_BUCKET and FN_SF_S3_STAGE are required for the s3 stage")
+        self.client = s3.new_client(self.config)
+        self.run_id = run_id
+        self.compression = compression
+        self.file_mb = file_mb
+
+    def prefix(self, key: str, chunk: Chunk = None) -> str:
+        prefix = f"{self.config.prefix}/{self.run_id}/{key}/"
+        if chunk is not None:
+            prefix += f"chunk_{chunk.index:05d}/"
+        return prefix
+
+    def sink(self, key: str, tbl: Table, chunk: Chunk) -> Union[ParquetSink, CsvSink]:
+        return new_sink(key, tbl, chunk, None, self.compression, self.file_mb)
+
+    def upload(self, key: str, tbl: Table, chunk: Chunk, part: ParquetPart, conn) -> None:
+        self._s3.upload(
+            self.client, part, self.config.bucket, self.prefix(key, chunk) + part.name
+        )
+
+    def clear(self, key: str, tbl: Table, chunk: Chunk, conn) -> None:
+        self._s3.delete_prefix(self.client, self.config.bucket, self.prefix(key, chunk))
+
+    def copy_into(self, key: str, tbl: Table, conn, table_name: str = "") -> int:
+        location = f"@{self.config.stage.lstrip('@')}/{self.prefix(key)}"
+        return sf.copy_into(tbl, location, conn, file_format(tbl), table_name)
+
+    def cleanup(self, key: str, tbl: Table, conn) -> None:
+        self._s3.delete_prefix(self.client, self.config.bucket, self.prefix(key))
+
+    def close(self) -> None:
+        pass
+
+
+def new_stage(
+    kind: str, run_id: str, compression: str = "snappy", file_mb: int = TARGET_FILE_MB
+):
+    """ Creates the stage to load files through, internal or s3 """
+    if kind == "internal":
+        local_dir = Path(mkdtemp(prefix="flakenews_"))
+        return InternalStage(run_id, local_dir, compression, file_mb)
+    if kind == "s3":
+        return S3Stage(run_id, compression, file_mb)
+    raise ValueError(f"Unknown stage {kind}, use one of {STAGES}")
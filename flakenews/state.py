@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+from decimal import Decimal
+from datetime import date, datetime, time
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = "./flakenews_state.json"
+
+
+def encode_value(value) -> dict:
+    """ Tag a watermark or pk value with its type so it comes back as the same Python type """
+    if isinstance(value, bytes):
+        return {"type": "bytes", "value": value.hex()}
+    if isinstance(value, datetime):
+        return {"type": "datetime", "value": value.isoformat()}
+    if isinstance(value, date):
+        return {"type": "date", "value": value.isoformat()}
+    if isinstance(value, time):
+        return {"type": "time", "value": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {"type": "decimal", "value": str(value)}
+    return {"type": "value", "value": value}
+
+
+def decode_value(doc: dict):
+    decoders = {
+        "bytes": bytes.fromhex,
+        "datetime": datetime.fromisoformat,
+        "date": date.fromisoformat,
+        "time": time.fromisoformat,
+        "decimal": Decimal,
+    }
+    decoder = decoders.get(doc["type"])
+    return decoder(doc["value"]) if decoder else doc["value"]
+
+
+class WatermarkState:
+    """
+    High-watermarks of incrementally loaded tables, kept in a local JSON file
+    keyed by db.schema.table. Saved after every update, so a watermark only
+    moves forward once its table has been loaded successfully.
+    """
+
+    def __init__(self, path: Union[Path, str] = STATE_FILE):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._marks = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self._marks = json.load(f)
+
+    def get(self, key: str):
+        with self._lock:
+            doc = self._marks.get(key)
+        return None if doc is None else decode_value(doc)
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            self._marks[key] = encode_value(value)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp, "w") as f:
+                json.dump(self._marks, f, indent=2)
+            os.replace(tmp, self.path)
+        logger.info(f"Saved watermark for {key}: {value}")
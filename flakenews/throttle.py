@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Generator, Iterable, List, Tuple, Union
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# bytes counted for a value that is not a string or binary
+VALUE_BYTES = 8
+
+
+def data_bytes(batch: List[Tuple]) -> int:
+    """
+    Rough bytes of data in a fetched batch, the length of strings and binaries
+    and VALUE_BYTES for anything else, measured on a sample of rows
+    """
+    if not batch:
+        return 0
+    step = max(len(batch) // 100, 1)
+    sample = batch[::step]
+    size = sum(
+        len(v) if isinstance(v, (str, bytes)) else VALUE_BYTES
+        for row in sample
+        for v in row
+        if v is not None
+    )
+    return int(size * len(batch) / len(sample))
+
+
+class RateLimiter:
+    """
+    Paces fetch loops to at most rows_per_sec rows and mb_per_sec MB of data a second,
+    0 for no limit. Every batch books the time it is allowed to take, so a limiter
+    shared by several threads holds them all to the limit together.
+    """
+
+    def __init__(self, rows_per_sec: int = 0, mb_per_sec: float = 0.0):
+        self.rows_per_sec = rows_per_sec
+        self.bytes_per_sec = mb_per_sec * 1024 * 1024
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def __bool__(self) -> bool:
+        return self.rows_per_sec > 0 or self.bytes_per_sec > 0
+
+    def acquire(self, rows: int, nbytes: int) -> None:
+        """ Wait until a batch of this many rows and bytes fits within the limits """
+        seconds = 0.0
+        if self.rows_per_sec > 0:
+            seconds = rows / self.rows_per_sec
+        if self.bytes_per_sec > 0:
+            seconds = max(seconds, nbytes / self.bytes_per_sec)
+        with self._lock:
+            now = time.monotonic()
+            # time not used by a slow fetch is not saved up for a burst later
+            start = max(now, self._next)
+            self._next = start + seconds
+        wait = start - now
+        if wait > 0:
+            with metrics.timer("throttle"):
+                time.sleep(wait)
+
+
+def needs_bytes(limiters: Iterable[RateLimiter]) -> bool:
+    return any(limiter.bytes_per_sec > 0 for limiter in limiters)
+
+
+@contextmanager
+def source_slot(slots: Union[threading.Semaphore, None]):
+    """ Hold one of the source query slots for the block, any number run at once without slots """
+    if slots is None:
+        yield
+        return
+    with metrics.timer("source_wait"):
+        slots.acquire()
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+def holding(items: Iterable, slots: Union[threading.Semaphore, None]) -> Generator:
+    """
+    Iterate over `items` holding one of the source query slots, taken before the
+    first item and given back once `items` is exhausted or closed
+    """
+    with source_slot(slots):
+        yield from items
+
+
+class SourceLimits:
+    """
+    What a run allows itself on the source server: at most max_queries
+    extraction queries at a time, 0 for as many as there are workers,
+    and a rate limit over all of its fetches together
+    """
+
+    def __init__(self, max_queries: int = 0, rows_per_sec: int = 0, mb_per_sec: float = 0.0):
+        self.slots = threading.BoundedSemaphore(max_queries) if max_queries > 0 else None
+        self.limiter = RateLimiter(rows_per_sec, mb_per_sec)
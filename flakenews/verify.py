@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import logging
+from collections import Counter
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Tuple
+from . import snowflake as sf
+from . import metrics
+from .rules import TableRules, Database, Schema, Table, Chunk, qualified_name
+from .runner import WorkerConnections
+from .source import get_chunks, get_checksum
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ChunkCheck:
+    """ The row counts and checksums of one pk range of a table on both sides """
+
+    key: str
+    chunk: Chunk
+    source_rows: int = 0
+    target_rows: int = 0
+    source_hash: int = 0
+    target_hash: int = 0
+    error: str = ""
+
+    @property
+    def matches(self) -> bool:
+        return (
+            not self.error
+            and self.source_rows == self.target_rows
+            and self.source_hash == self.target_hash
+        )
+
+
+def _plan(
+    rules: TableRules, db: Database, sch: Schema, tbl: Table, conns: WorkerConnections
+) -> List[Chunk]:
+    try:
+        with closing(conns.ms_conn(db.server).cursor()) as cur:
+            return get_chunks(cur, rules, db, sch, tbl)
+    except Exception:
+        conns.discard()
+        raise
+
+
+def _source_checksum(
+    rules: TableRules, db: Database, sch: Schema, tbl: Table, chunk: Chunk, conns: WorkerConnections
+) -> Tuple[int, int]:
+    try:
+        with metrics.timer("verify_source"), closing(conns.ms_conn(db.server).cursor()) as cur:
+            return get_checksum(cur, rules, db, sch, tbl, chunk)
+    except Exception:
+        conns.discard()
+        raise
+
+
+def _target_checksum(tbl: Table, chunk: Chunk, conns: WorkerConnections) -> Tuple[int, int]:
+    try:
+        with metrics.timer("verify_target"):
+            return sf.get_checksum(tbl, chunk, conns.sf_conn())
+    except Exception:
+        conns.discard()
+        raise
+
+
+def verify_tables(rules: TableRules, workers: int = 1) -> List[ChunkCheck]:
+    """
+    Compare every table in the rules with its copy on Snowflake, chunk by chunk.
+    Both servers compute the row count and checksum of each pk range themselves,
+    so no rows are transferred, and both sides of every chunk run in parallel.
+    A Snowflake table that several source servers load into is compared whole
+    against the sum of their counts and checksums, which add up.
+    """
+    conns = WorkerConnections()
+    checks = []
+    targets = Counter(tbl.name.upper() for _, _, tbl in rules._all_tables())
+    try:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            shared = {}
+            for db, sch, tbl in rules._all_tables():
+                if targets[tbl.name.upper()] > 1:
+                    shared.setdefault(tbl.name.upper(), (tbl, []))[1].append(
+                        pool.submit(_source_checksum, rules, db, sch, tbl, Chunk(), conns)
+                    )
+            # the columns of the first source table stand for the target's
+            shared_checks = [
+                (ChunkCheck(key=f"{tbl.name} from {len(sources)} sources", chunk=Chunk()), sources,
+                 pool.submit(_target_checksum, tbl, Chunk(), conns))
+                for tbl, sources in shared.values()
+            ]
+            planned = [
+                (qualified_name(db, sch, tbl), db, sch, tbl,
+                 pool.submit(_plan, rules, db, sch, tbl, conns))
+                for db, sch, tbl in rules._all_tables()
+                if targets[tbl.name.upper()] == 1
+            ]
+            pending = []
+            for key, db, sch, tbl, future in planned:
+                try:
+                    chunks = future.result()
+                except Exception as e:
+                    logger.error(f"Could not split {key} to verify it: {e}")
+                    checks.append(ChunkCheck(key=key, chunk=Chunk(), error=str(e)))
+                    continue
+                for chunk in chunks:
+                    pending.append((
+                        ChunkCheck(key=key, chunk=chunk),
+                        pool.submit(_source_checksum, rules, db, sch, tbl, chunk, conns),
+                        pool.submit(_target_checksum, tbl, chunk, conns),
+                    ))
+            for check, source, target in pending:
+                try:
+                    check.source_rows, check.source_hash = source.result()
+                    check.target_rows, check.target_hash = target.result()
+                except Exception as e:
+                    logger.error(f"Could not verify chunk {check.chunk.index} of {check.key}: {e}")
+                    check.error = str(e)
+                checks.append(check)
+            for check, sources, target in shared_checks:
+                try:
+                    for source in sources:
+                        rows, checksum = source.result()
+                        check.source_rows += rows
+                        check.source_hash += checksum
+                    check.target_rows, check.target_hash = target.result()
+                except Exception as e:
+                    logger.error(f"Could not verify {check.key}: {e}")
+                    check.error = str(e)
+                checks.append(check)
+    finally:
+        conns.close()
+    return checks
+
+
+def _bounds(chunk: Chunk) -> str:
+    lower = "start" if chunk.lower is None else chunk.lower
+    upper = "end" if chunk.upper is None else chunk.upper
+    return f"[{lower}, {upper})"
+
+
+def print_verify(checks: List[ChunkCheck]) -> bool:
+    """
+    Print the chunks whose row count or checksum differ, and a per-table summary.
+    Returns False if any chunk differs or could not be checked.
+    """
+    tables = {}
+    for check in checks:
+        tables.setdefault(check.key, []).append(check)
+    width = max((len(key) for key in tables), default=0)
+    print("\nVerify summary")
+    for key, table_checks in tables.items():
+        bad = [check for check in table_checks if not check.matches]
+        source_rows = sum(check.source_rows for check in table_checks)
+        target_rows = sum(check.target_rows for check in table_checks)
+        status = "OK" if not bad else "DIFF"
+        print(
+            f"  {status:<6} {key:<{width}}  rows {source_rows:>12,} / {target_rows:<12,}"
+            f"  chunks {len(table_checks) - len(bad):>5}/{len(table_checks):<5}"
+        )
+        for check in bad:
+            line = f"      chunk {check.chunk.index:>5} {_bounds(check.chunk)}"
+            if check.error:
+                line += f"  {check.error}"
+            else:
+                line += f"  rows {check.source_rows:,} / {check.target_rows:,}"
+                if check.source_hash != check.target_hash:
+                    line += "  checksum differs"
+            print(line)
+    failed = sum(1 for table_checks in tables.values() if not all(c.matches for c in table_checks))
+    print(f"{len(tables) - failed} tables match, {failed} differ\n")
+    return failed == 0
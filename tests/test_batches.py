@@ -0,0 +1,37 @@
+from datetime import date, datetime, timezone
+from flakenews.mssql import build_batch, table_to_pandas
+from flakenews.rules import Table
+
+
+def _col(name: str, data_type: str, position: int) -> dict:
+    return {
+        "name": name,
+        "ordinal_position": position,
+        "data_type": data_type,
+        "numeric_precision": None,
+        "numeric_scale": None,
+    }
+
+
+def test_to_pandas_keeps_dates_beyond_nanoseconds():
+    tbl = Table(
+        name="orders",
+        cols=[
+            _col("id", "int", 1),
+            _col("valid_to", "datetime2", 2),
+            _col("closed", "datetimeoffset", 3),
+            _col("due", "date", 4),
+            _col("created", "datetime2", 5),
+        ],
+    )
+    rows = [
+        (1, "9999-12-31T23:59:59.999999", "9999-12-31T00:00:00Z", "9999-12-31", "2020-01-01T12:30:00.5"),
+        (2, None, None, None, None),
+    ]
+    df = table_to_pandas(build_batch(rows, tbl))
+    assert df["ID"].tolist() == [1, 2]
+    assert df["VALID_TO"][0] == datetime(9999, 12, 31, 23, 59, 59, 999999, tzinfo=timezone.utc)
+    assert df["CLOSED"][0] == datetime(9999, 12, 31, tzinfo=timezone.utc)
+    assert df["DUE"][0] == date(9999, 12, 31)
+    assert df["CREATED"][0] == datetime(2020, 1, 1, 12, 30, 0, 500000, tzinfo=timezone.utc)
+    assert df.iloc[1, 1:].isna().all()
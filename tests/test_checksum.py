@@ -0,0 +1,105 @@
+import pytest
+from flakenews import rules, snowflake
+from flakenews.rules import Chunk, Column, Table, TableRules
+
+# the text of a column named amount on either side, which have to come out the same for a value
+EXPRESSIONS = [
+    ("int", "convert(nvarchar(max), [amount])", "to_varchar(AMOUNT)"),
+    ("bigint", "convert(nvarchar(max), [amount])", "to_varchar(AMOUNT)"),
+    ("decimal", "convert(nvarchar(max), [amount])", "to_varchar(AMOUNT)"),
+    ("numeric", "convert(nvarchar(max), [amount])", "to_varchar(AMOUNT)"),
+    ("money", "convert(nvarchar(max), convert(decimal(19, 4), [amount]))", "to_varchar(AMOUNT)"),
+    ("smallmoney", "convert(nvarchar(max), convert(decimal(10, 4), [amount]))", "to_varchar(AMOUNT)"),
+    ("bit", "convert(nvarchar(1), [amount])", "iff(AMOUNT, '1', '0')"),
+    ("nvarchar", "convert(nvarchar(max), [amount])", "AMOUNT"),
+    ("char", "convert(nvarchar(max), [amount])", "AMOUNT"),
+    ("uniqueidentifier", "lower(convert(nchar(36), [amount]))", "AMOUNT"),
+    ("date", "convert(nchar(10), [amount], 23)", "to_varchar(AMOUNT, 'YYYY-MM-DD')"),
+    ("time", "convert(nchar(8), [amount], 108)", "to_varchar(AMOUNT, 'HH24:MI:SS')"),
+    (
+        "datetime",
+        "convert(nvarchar(20), datediff_big(microsecond, '19700101',"
+        " convert(datetime2, convert(varchar(26), [amount], 126))))",
+        "to_varchar(date_part(epoch_microsecond, AMOUNT))",
+    ),
+    (
+        "datetime2",
+        "convert(nvarchar(20), datediff_big(microsecond, '19700101',"
+        " convert(datetime2, convert(varchar(26), [amount], 126))))",
+        "to_varchar(date_part(epoch_microsecond, AMOUNT))",
+    ),
+    (
+        "datetimeoffset",
+        "convert(nvarchar(20), datediff_big(microsecond, '19700101', convert(datetime2,"
+        " convert(varchar(26), convert(datetime2, switchoffset([amount], '+00:00')), 126))))",
+        "to_varchar(date_part(epoch_microsecond, AMOUNT))",
+    ),
+    ("binary", "convert(nvarchar(max), [amount], 2)", "to_varchar(AMOUNT, 'HEX')"),
+    ("varbinary", "convert(nvarchar(max), [amount], 2)", "to_varchar(AMOUNT, 'HEX')"),
+    ("rowversion", "convert(nvarchar(max), [amount], 2)", "to_varchar(AMOUNT, 'HEX')"),
+    ("image", "convert(nvarchar(max), convert(varbinary(max), [amount]), 2)", "to_varchar(AMOUNT, 'HEX')"),
+]
+
+
+def _col(name: str, data_type: str, position: int = 1, length: int = None) -> dict:
+    return {
+        "name": name,
+        "ordinal_position": position,
+        "data_type": data_type,
+        "numeric_precision": 10 if data_type in ("decimal", "numeric") else None,
+        "numeric_scale": 2 if data_type in ("decimal", "numeric") else None,
+        "character_maximum_length": length,
+    }
+
+
+def _source_sql(tbl: Table, chunk: Chunk = Chunk()):
+    table_rules = TableRules([{"name": "sales", "schemas": [{"name": "dbo", "tables": []}]}])
+    db = table_rules.databases[0]
+    sch = db.schemas[0]
+    return table_rules.checksum_sql(db, sch, tbl, chunk)
+
+
+def test_both_sides_checksum_the_same_types():
+    assert set(rules.CHECKSUM_EXPRESSIONS) == set(snowflake.CHECKSUM_EXPRESSIONS)
+
+
+@pytest.mark.parametrize("data_type, source, target", EXPRESSIONS)
+def test_checksum_expressions(data_type, source, target):
+    col = Column(**_col("amount", data_type))
+    assert rules.CHECKSUM_EXPRESSIONS[data_type].format("[amount]") == source
+    assert snowflake.CHECKSUM_EXPRESSIONS[data_type].format(col.caps_name()) == target
+
+
+def test_checksum_sql_of_a_row():
+    tbl = Table(
+        name="orders",
+        pk=["id"],
+        cols=[
+            _col("id", "int", 1),
+            _col("price", "float", 2),
+            _col("note", "nvarchar", 3, length=-1),
+            _col("code", "varbinary", 4, length=8),
+        ],
+    )
+    qry, params = _source_sql(tbl, Chunk(1, 10, 20))
+    assert qry == (
+        "select count_big(*), sum(convert(decimal(38, 0), convert(bigint, convert(binary(4), hashbytes('MD5',"
+        " convert(varchar(max), (isnull(convert(nvarchar(max), [id]), N'\\N') + nchar(31)"
+        " + isnull(convert(nvarchar(max), [code], 2), N'\\N')) collate Latin1_General_100_BIN2_UTF8))))))"
+        " from [sales].[dbo].[orders] where [id] >= %s and [id] < %s"
+    )
+    assert params == (10, 20)
+
+    qry, params = snowflake.checksum_sql(tbl, Chunk(1, 10, 20))
+    assert qry == (
+        "select count(*), sum(to_number(upper(substr(md5(coalesce(to_varchar(ID), '\\\\N')"
+        " || chr(31) || coalesce(to_varchar(CODE, 'HEX'), '\\\\N')), 1, 8)), 'XXXXXXXX'))"
+        " from ORDERS where ID >= %s and ID < %s"
+    )
+    assert params == [10, 20]
+
+
+def test_checksum_sql_without_columns():
+    tbl = Table(name="readings", cols=[_col("value", "float")])
+    assert _source_sql(tbl)[0] == "select count_big(*), null from [sales].[dbo].[readings]"
+    assert snowflake.checksum_sql(tbl, Chunk())[0] == "select count(*), null from READINGS"
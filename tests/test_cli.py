@@ -0,0 +1,36 @@
+import sys
+import subprocess
+from flakenews.__main__ import new_parser
+
+
+def test_tables_before_rules_file():
+    args = new_parser().parse_args(["plan", "-t", "x.*", "table_rules.json"])
+    assert args.command == "plan"
+    assert args.tables == ["x.*"]
+    assert args.table_rules == "table_rules.json"
+
+
+def test_tables_repeated():
+    args = new_parser().parse_args(["load", "-t", "sales.dbo.*", "--tables", "hr.*", "r.json"])
+    assert args.tables == ["sales.dbo.*", "hr.*"]
+
+
+def test_tables_default_and_legacy_flags():
+    assert new_parser().parse_args(["verify", "r.json"]).tables is None
+    args = new_parser().parse_args(["-r", "r.json", "-t", "x.*", "-w", "4"])
+    assert (args.command, args.table_rules, args.tables, args.workers) == (None, "r.json", ["x.*"], 4)
+
+
+def test_options_before_command_are_kept():
+    args = new_parser().parse_args(["-w", "8", "-t", "x.*", "plan", "r.json"])
+    assert (args.workers, args.tables) == (8, ["x.*"])
+
+
+def test_setup_imports_no_dataframes():
+    # what `setup` and `-c` import, in a fresh interpreter
+    code = (
+        "import sys, flakenews.__main__, flakenews.source;"
+        "print(' '.join(m for m in ('pandas', 'pyarrow', 'numpy') if m in sys.modules))"
+    )
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == ""
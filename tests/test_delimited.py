@@ -0,0 +1,79 @@
+import re
+import gzip
+from datetime import time
+from decimal import Decimal
+from flakenews.delimited import CsvSink, FILE_FORMAT, NULL_MARKER
+
+TYPES = ["int", "nvarchar", "nvarchar", "bit", "time", "decimal", "float"]
+ROWS = [
+    (1, 'say "hi"', "a,b", True, time(1, 2, 3), Decimal("1.50"), 2.5),
+    (2, "line one\nline two", "", False, None, None, None),
+    (3, None, NULL_MARKER, None, time(0, 0), Decimal("-0.01"), 0.0),
+]
+WRITTEN = (
+    b'1,"say ""hi""","a,b",1,"01:02:03",1.50,2.5\n'
+    b'2,"line one\nline two","",0,\\N,\\N,\\N\n'
+    b'3,\\N,"\\N",\\N,"00:00:00",-0.01,0.0\n'
+)
+
+# a field as FILE_FORMAT reads it: enclosed in quotes with quotes doubled, or bare up to the next comma
+_FIELD = re.compile(r'(?:"((?:[^"]|"")*)"|([^,\n"]*))([,\n])')
+
+
+def _read(data: bytes) -> list:
+    """ Parse CSV as FILE_FORMAT is meant to read it: only a bare \\N is NULL, an enclosed one is a string """
+    text = data.decode("utf-8")
+    rows, row, pos = [], [], 0
+    while pos < len(text):
+        match = _FIELD.match(text, pos)
+        enclosed, bare, end = match.groups()
+        if enclosed is not None:
+            row.append(enclosed.replace('""', '"'))
+        else:
+            row.append(None if bare == NULL_MARKER else bare)
+        if end == "\n":
+            rows.append(row)
+            row = []
+        pos = match.end()
+    return rows
+
+
+def _write(compression: str) -> bytes:
+    sink = CsvSink("orders", TYPES, compression=compression)
+    assert sink.write(ROWS) == []
+    (part,) = sink.close()
+    assert part.rows == len(ROWS)
+    return part.buffer.read()
+
+
+def test_csv_bytes():
+    assert _write("none") == WRITTEN
+
+
+def test_csv_gzip_bytes():
+    assert gzip.decompress(_write("gzip")) == WRITTEN
+
+
+def test_csv_round_trip():
+    assert _read(WRITTEN) == [
+        ["1", 'say "hi"', "a,b", "1", "01:02:03", "1.50", "2.5"],
+        ["2", "line one\nline two", "", "0", None, None, None],
+        ["3", None, "\\N", None, "00:00:00", "-0.01", "0.0"],
+    ]
+
+
+def test_file_format():
+    assert FILE_FORMAT == (
+        "type = csv compression = auto field_delimiter = ','"
+        " field_optionally_enclosed_by = '\"' null_if = ('\\\\N')"
+        " empty_field_as_null = false encoding = 'utf8'"
+    )
+    # the Snowflake string literal '\\N' is the two characters \N
+    assert NULL_MARKER == "\\" + "N"
+
+
+def test_csv_unmapped_bytes_as_hex():
+    sink = CsvSink("things", ["hierarchyid", "sql_variant", "sql_variant"], compression="none")
+    sink.write([(b"\x5a\xc0", b"\x00\xff", 7), (None, "text", None)])
+    (part,) = sink.close()
+    assert part.buffer.read() == b'"5AC0","00FF",7\n\\N,"text",\\N\n'
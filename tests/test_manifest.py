@@ -0,0 +1,148 @@
+import pytest
+from flakenews import runner
+from flakenews.manifest import RunManifest, DONE
+from flakenews.rules import Chunk, TableRules
+
+KEY = "sales.dbo.orders"
+CHUNKS = [Chunk(0, None, 10), Chunk(1, 10, 20), Chunk(2, 20, None)]
+
+
+def _rules() -> TableRules:
+    col = {"name": "id", "ordinal_position": 1, "data_type": "int", "numeric_precision": 10, "numeric_scale": 0}
+    return TableRules(
+        [{"name": "sales", "schemas": [{"name": "dbo", "tables": [{"name": "orders", "cols": [col], "pk": ["id"]}]}]}]
+    )
+
+
+def _config(tmp_path, resume: bool = False, **options) -> runner.RunConfig:
+    return runner.RunConfig(
+        manifest_file=str(tmp_path / "manifest.sqlite"),
+        state_file=str(tmp_path / "state.json"),
+        resume=resume,
+        retries=0,
+        **options,
+    )
+
+
+class _Source:
+    """ Stands in for plan_table and load_chunk, recording what the runner asks of them """
+
+    def __init__(self, fail: set = (), written: int = 3):
+        self.fail = set(fail)
+        self.written = written
+        self.planned = 0
+        self.loaded = []
+
+    def plan_table(self, *args):
+        self.planned += 1
+        return list(CHUNKS)
+
+    def load_chunk(self, rules, job, chunk, conns, config, stage=None, dirty=False, limits=None):
+        self.loaded.append((chunk.index, dirty))
+        if chunk.index in self.fail:
+            raise runner.ChunkError(RuntimeError("connection lost"), rows=self.written)
+        return 10
+
+
+def _run(monkeypatch, tmp_path, source: _Source, resume: bool = False, **options) -> runner.TableResult:
+    monkeypatch.setattr(runner, "plan_table", source.plan_table)
+    monkeypatch.setattr(runner, "load_chunk", source.load_chunk)
+    (result,) = runner.run_to_snowflake(_rules(), _config(tmp_path, resume, **options))
+    return result
+
+
+def test_manifest_keeps_chunks_on_resume(tmp_path):
+    path = tmp_path / "manifest.sqlite"
+    manifest = RunManifest(path)
+    run_id = manifest.run_id
+    manifest.plan_table(KEY, None, CHUNKS)
+    manifest.chunk_done(KEY, CHUNKS[0], 10)
+    manifest.chunk_started(KEY, CHUNKS[1])
+    manifest.close()
+
+    manifest = RunManifest(path, resume=True)
+    plan = manifest.get_table(KEY)
+    manifest.close()
+    assert manifest.run_id == run_id
+    assert plan.chunks == CHUNKS
+    assert plan.done == {0: 10}
+    assert plan.started == {1}
+    assert plan.status != DONE
+
+
+def test_manifest_reset_without_resume(tmp_path):
+    path = tmp_path / "manifest.sqlite"
+    manifest = RunManifest(path)
+    run_id = manifest.run_id
+    manifest.plan_table(KEY, None, CHUNKS)
+    manifest.table_done(KEY, 30)
+    manifest.close()
+
+    manifest = RunManifest(path)
+    assert manifest.get_table(KEY) is None
+    assert manifest.run_id != run_id
+    manifest.close()
+
+
+def test_resume_reloads_started_chunk_as_dirty(monkeypatch, tmp_path):
+    result = _run(monkeypatch, tmp_path, _Source(fail={1}))
+    assert not result.success
+
+    source = _Source()
+    result = _run(monkeypatch, tmp_path, source, resume=True)
+    assert source.planned == 0
+    assert source.loaded == [(1, True)]
+    assert result.success
+    assert result.rows == 30
+    assert result.resumed == 2
+
+
+def test_resume_reloads_pending_chunk_as_clean(monkeypatch, tmp_path):
+    # a chunk that failed before writing anything has nothing to clear
+    _run(monkeypatch, tmp_path, _Source(fail={1}, written=0))
+
+    source = _Source()
+    _run(monkeypatch, tmp_path, source, resume=True)
+    assert source.loaded == [(1, False)]
+
+
+def test_resume_skips_done_table(monkeypatch, tmp_path):
+    assert _run(monkeypatch, tmp_path, _Source()).success
+
+    source = _Source()
+    result = _run(monkeypatch, tmp_path, source, resume=True)
+    assert source.planned == 0
+    assert source.loaded == []
+    assert result.success
+    assert result.rows == 30
+    assert result.resumed == 3
+
+
+def test_run_without_resume_starts_over(monkeypatch, tmp_path):
+    _run(monkeypatch, tmp_path, _Source(fail={1}))
+
+    source = _Source()
+    result = _run(monkeypatch, tmp_path, source)
+    assert source.planned == 1
+    assert sorted(source.loaded) == [(0, False), (1, False), (2, False)]
+    assert result.rows == 30
+    assert result.resumed == 0
+
+
+@pytest.mark.parametrize(
+    "before, after",
+    [
+        ({"stage": "internal"}, {}),
+        ({}, {"stage": "internal"}),
+        ({"stage": "internal"}, {"stage": "s3"}),
+        # merge tables go through the internal stage without a --stage
+        ({"mode": "merge"}, {}),
+    ],
+)
+def test_resume_through_another_stage_fails(monkeypatch, tmp_path, before, after):
+    _run(monkeypatch, tmp_path, _Source(fail={1}), **before)
+
+    source = _Source()
+    with pytest.raises(ValueError, match="resume it with the same --stage"):
+        _run(monkeypatch, tmp_path, source, resume=True, **after)
+    assert source.loaded == []
@@ -0,0 +1,72 @@
+import pytest
+from flakenews import runner
+from flakenews.rules import Table, TableRules
+from flakenews.snowflake import merge_sql
+from flakenews.state import WatermarkState
+
+
+def _col(name: str, data_type: str = "int", position: int = 1) -> dict:
+    return {
+        "name": name,
+        "ordinal_position": position,
+        "data_type": data_type,
+        "numeric_precision": None,
+        "numeric_scale": None,
+    }
+
+
+def test_merge_sql_latest_by_watermark():
+    tbl = Table(
+        name="orders",
+        pk=["id"],
+        watermark="last modified",
+        cols=[_col("id", position=1), _col("amount", "decimal", 2), _col("last modified", "datetime2", 3)],
+    )
+    assert merge_sql(tbl, "ORDERS_STAGING") == (
+        "merge into ORDERS as t using ("
+        " select * from ORDERS_STAGING"
+        " qualify row_number() over (partition by ID order by LAST_MODIFIED desc) = 1"
+        ") as s on t.ID = s.ID"
+        " when matched then update set t.AMOUNT = s.AMOUNT, t.LAST_MODIFIED = s.LAST_MODIFIED"
+        " when not matched then insert (ID, AMOUNT, LAST_MODIFIED) values (s.ID, s.AMOUNT, s.LAST_MODIFIED)"
+    )
+
+
+def test_merge_sql_composite_pk():
+    tbl = Table(
+        name="order_lines",
+        pk=["Order_Id", "line"],
+        cols=[_col("order_id", position=1), _col("line", position=2), _col("sku", "varchar", 3)],
+    )
+    assert merge_sql(tbl, "S") == (
+        "merge into ORDER_LINES as t using ("
+        " select * from S"
+        " qualify row_number() over (partition by ORDER_ID, LINE order by ORDER_ID, LINE) = 1"
+        ") as s on t.ORDER_ID = s.ORDER_ID and t.LINE = s.LINE"
+        " when matched then update set t.SKU = s.SKU"
+        " when not matched then insert (ORDER_ID, LINE, SKU) values (s.ORDER_ID, s.LINE, s.SKU)"
+    )
+
+
+def test_merge_sql_insert_only_when_every_column_is_pk():
+    tbl = Table(name="tags", pk=["post_id", "tag"], cols=[_col("post_id", position=1), _col("tag", "varchar", 2)])
+    qry = merge_sql(tbl, "S")
+    assert "when matched" not in qry
+    assert qry.endswith(
+        ") as s on t.POST_ID = s.POST_ID and t.TAG = s.TAG"
+        " when not matched then insert (POST_ID, TAG) values (s.POST_ID, s.TAG)"
+    )
+
+
+@pytest.mark.parametrize("load_mode, mode", [("merge", "append"), ("", "merge")])
+def test_plan_table_rejects_merge_without_pk(tmp_path, load_mode, mode):
+    rules = TableRules([{"name": "sales", "schemas": [{"name": "dbo", "tables": []}]}])
+    db = rules.databases[0]
+    sch = db.schemas[0]
+    job = runner.TableJob(db, sch, Table(name="events", cols=[_col("id")], load_mode=load_mode))
+    conns = runner.WorkerConnections()
+    with pytest.raises(ValueError, match="merge needs a primary key"):
+        runner.plan_table(
+            rules, job, conns, WatermarkState(tmp_path / "state.json"), runner.RunConfig(mode=mode)
+        )
+    conns.close()
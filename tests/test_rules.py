@@ -0,0 +1,57 @@
+from flakenews import rules
+from flakenews.rules import TableRules
+
+
+def _rules(schemas: int, tables: int) -> TableRules:
+    return TableRules([
+        {
+            "name": "Sales",
+            "schemas": [
+                {"name": f"s{i}", "tables": [{"name": f"T{j}"} for j in range(tables)]}
+                for i in range(schemas)
+            ],
+        },
+        {"name": "empty", "schemas": [{"name": "dbo", "tables": []}]},
+    ])
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, qry):
+        self.qry = qry
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+def test_tables_filter_lists_tables():
+    rules_ = _rules(2, 2)
+    db, empty = rules_.databases
+    assert rules_._tables_filter(db, "s", "t") == (
+        "(lower(s) = 's0' and lower(t) in ('t0', 't1'))"
+        " or (lower(s) = 's1' and lower(t) in ('t0', 't1'))"
+    )
+    assert rules_._tables_filter(empty, "s", "t") == "1 = 0"
+
+
+def test_tables_filter_past_the_limit(monkeypatch):
+    monkeypatch.setattr(rules, "METADATA_FILTER_MAX_NAMES", 4)
+    rules_ = _rules(2, 3)
+    assert rules_._tables_filter(rules_.databases[0], "s", "t") == "lower(s) in ('s0', 's1')"
+    rules_ = _rules(5, 1)
+    assert rules_._tables_filter(rules_.databases[0], "s", "t") == "1 = 1"
+    assert rules_._tables_filter(rules_.databases[1], "s", "t") == "1 = 0"
+
+
+def test_metadata_of_other_tables_is_dropped():
+    rules_ = _rules(1, 2)
+    cur = FakeCursor([
+        ("sales", "s0", "t1", "id"),
+        ("sales", "s0", "other", "id"),
+        ("sales", "dbo", "t0", "id"),
+    ])
+    matched = [(row[2], tbl.name) for row, tbl in rules_._match_results_to_tables(cur, "")]
+    assert matched == [("t1", "T1")]